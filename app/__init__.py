@@ -11,6 +11,7 @@ from flask_wtf.csrf import CSRFProtect
 from sqlalchemy import MetaData
 from sqlalchemy.exc import OperationalError
 
+from app.metrics import metrics
 from config import Config
 
 
@@ -38,6 +39,7 @@ def create_app(config_class=Config):
     db.metadata.clear()
     
     csrf.init_app(app)
+    metrics.init_app(app)
     migrate.init_app(app, db, render_as_batch=True)
     
     sess.init_app(app)
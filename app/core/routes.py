@@ -1,9 +1,10 @@
-from flask import render_template, flash, redirect, url_for
+from flask import render_template, flash, redirect, url_for, Response
 
 from app import db
 from app.core import bp
 from app.core.forms import ContactForm
 from app.core.models import Messages
+from app.metrics import metrics
 
 
 @bp.route('/')
@@ -35,4 +36,11 @@ def contact_homepage():
         return redirect(url_for('core.contact_homepage'))
     
     return render_template('core/contact.html',
-                           form=form)
\ No newline at end of file
+                           form=form)
+
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    """ Stage timing histograms in the Prometheus text format """
+    
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,199 @@
+"""Benchmark the production schedule Solver on synthetic problems
+
+Problems are generated from parameters against an in-memory SQLite database,
+so nothing needs the site's database, a request or the network. Run with e.g.
+
+    python -m app.manufacturing.benchmark --machines 8 --products 20 --weeks 8
+
+and a JSON report of the timings for each run is written to stdout, or to
+--output, so that it can be compared between releases.
+"""
+
+import argparse
+import datetime as dt
+import json
+import platform
+import random
+import sys
+
+from flask import Flask
+
+from app import db
+from app.manufacturing.models import (Machines,
+                                      MachineHistory,
+                                      MachineStats,
+                                      Problem,
+                                      Solver)
+from config import Config
+
+import numpy as np
+
+
+class BenchmarkConfig(Config):
+
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+
+
+def create_benchmark_app():
+    """ A bare app with the models on an in-memory database
+
+    The full app would start the machine simulation scheduler and bootstrap
+    weeks of machine history, neither of which the benchmark needs.
+    """
+
+    app = Flask(__name__)
+    app.config.from_object(BenchmarkConfig)
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def seed_machines(num_machines):
+    """ Add machines with a single hour of history to base productivity on """
+
+    db.session.query(Machines).delete()
+    for x in range(1, num_machines + 1):
+        machine_stats = Config.MACHINE_STATS[(x - 1) % len(Config.MACHINE_STATS)
+                                             + 1]
+        machine = Machines(name=f'Machine {x}')
+        db.session.add(machine)
+        db.session.flush()
+        db.session.add(MachineStats(machine_id=machine.id, **machine_stats))
+        db.session.add(MachineHistory(
+                                machine_id=machine.id,
+                                datetime=dt.datetime.utcnow(),
+                                product_count=int(
+                                                machine_stats['ideal_run_rate']
+                                                * 60
+                                                * machine_stats['efficiency']),
+                                down_count=0,
+                                down_secs=0))
+    db.session.commit()
+
+
+def create_problem(num_machines, num_products, num_weeks, shift_patterns,
+                   products_per_machine=3):
+    """ Build a random Problem of the given size
+
+    :param num_machines:         Number of machines
+    :param num_products:         Number of products in the forecast
+    :param num_weeks:            Number of weeks of forecast. The schedule
+                                 covers one more week than this
+    :param shift_patterns:       Shift pattern names, cycled over the machines
+    :param products_per_machine: How many products each machine can make
+    """
+
+    seed_machines(num_machines)
+
+    product_ids = list(range(1, num_products + 1))
+    weekly_forecast = {
+        product_id: [random.randint(50, 200) if random.random() > 0.4 else 0
+                     for week in range(num_weeks)]
+        for product_id in product_ids
+        }
+
+    machines = Machines.get_all()
+    machine_products = {
+        machine.id: random.sample(product_ids,
+                                  min(products_per_machine, num_products))
+        for machine in machines
+        }
+    machine_shifts = {machine.id: shift_patterns[i % len(shift_patterns)]
+                      for i, machine in enumerate(machines)}
+
+    return Problem.from_params(weekly_forecast, machine_products,
+                               machine_shifts)
+
+
+def time_solver(problem, iterations, batch_size):
+    """ Run the solver and report the time it spent in each phase """
+
+    solver = Solver(problem)
+    solver.iterations = iterations
+    solver.batch_size = batch_size
+    solver.run_solver()
+
+    phases = {phase: wall for phase, (wall, cpu)
+              in solver.phase_times.items()}
+    loop_secs = phases['_run_solution_loop']
+
+    return {'phase_secs': phases,
+            'phase_cpu_secs': {phase: cpu for phase, (wall, cpu)
+                               in solver.phase_times.items()},
+            'total_secs': sum(phases.values()),
+            'iterations_per_sec': solver.iterations_run / loop_secs,
+            'final_cost': float(solver.best_ever_cost),
+            'accepted_moves': solver.accepted_moves,
+            'acceptance_rate': solver.accepted_moves / solver.iterations_run,
+            'batch_scored_moves': solver.scored_moves}
+
+
+def run_benchmark(machines=4, products=8, weeks=4,
+                  shift_patterns=('6-2 and 2-10',), iterations=10000,
+                  batch_size=16, repeats=3, seed=0):
+
+    random.seed(seed)
+    np.random.seed(seed)
+
+    app = create_benchmark_app()
+    with app.app_context():
+        problem = create_problem(machines, products, weeks,
+                                 list(shift_patterns))
+        runs = [time_solver(problem, iterations, batch_size)
+                for x in range(repeats)]
+
+    return {
+        'created': dt.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'params': {'machines': machines,
+                   'products': products,
+                   'weeks': weeks,
+                   'hours': len(problem.daterange),
+                   'shift_patterns': list(shift_patterns),
+                   'iterations': iterations,
+                   'batch_size': batch_size,
+                   'repeats': repeats,
+                   'seed': seed},
+        'median_iterations_per_sec': float(np.median(
+                                [run['iterations_per_sec'] for run in runs])),
+        'median_total_secs': float(np.median(
+                                [run['total_secs'] for run in runs])),
+        'runs': runs
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--machines', type=int, default=4)
+    parser.add_argument('--products', type=int, default=8)
+    parser.add_argument('--weeks', type=int, default=4)
+    parser.add_argument('--shift-patterns', nargs='+',
+                        default=['6-2 and 2-10'],
+                        choices=Config.SHIFT_PATTERNS)
+    parser.add_argument('--iterations', type=int, default=10000)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='File to write the JSON report to')
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(machines=args.machines,
+                           products=args.products,
+                           weeks=args.weeks,
+                           shift_patterns=args.shift_patterns,
+                           iterations=args.iterations,
+                           batch_size=args.batch_size,
+                           repeats=args.repeats,
+                           seed=args.seed)
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
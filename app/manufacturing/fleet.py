@@ -0,0 +1,210 @@
+import threading
+
+from flask import current_app
+from sqlalchemy import and_, bindparam
+
+from app import db
+from app.manufacturing.live import live_status
+from app.manufacturing.models import (CurrentMachineStatus,
+                                      Machines,
+                                      MachineStats)
+
+import datetime as dt
+import numpy as np
+
+
+class Fleet:
+    """ Simulates every machine at once, in place of updating each Machine
+
+    The stats and current status of all machines are held in arrays, loaded
+    from the database with one query the first time they're needed. Each
+    tick moves every machine on by UPDATE_CYCLE_SECS in one vectorised step,
+    following the same rules as before: a running machine may go down, or
+    otherwise makes its efficiency x run rate, +/- 10%. A machine that has
+    been down for longer than its min_downtime_secs may come back up, and
+    counts the tick as downtime if it doesn't. The new statuses are written
+    back with a single executemany UPDATE in one transaction, then published
+    to live_status for the PTV screen.
+
+    Each row is only updated if it still holds the values this fleet last
+    loaded or saved. If anything else has changed a machine's status since,
+    e.g. the hourly reset or a scheduler in another process, the whole tick
+    is rolled back and the fleet is loaded again on the next one, rather
+    than writing over the other change. Code in this process that changes
+    current_machine_status should still hold `lock` and call clear(), so
+    that ticks aren't lost to the check.
+    """
+
+    def __init__(self):
+        self.machine_ids = None
+        self.lock = threading.Lock()
+        self.rng = np.random.default_rng()
+
+    def _load(self):
+        rows = (db.session.query(Machines.id,
+                                 Machines.name,
+                                 MachineStats.ideal_run_rate,
+                                 MachineStats.efficiency,
+                                 MachineStats.min_downtime_secs,
+                                 MachineStats.downtime_probability,
+                                 MachineStats.restart_probability,
+                                 CurrentMachineStatus.hourly_product_count,
+                                 CurrentMachineStatus.is_down,
+                                 CurrentMachineStatus.last_down,
+                                 CurrentMachineStatus.hourly_down_count,
+                                 CurrentMachineStatus.total_secs_down)
+                          .join(MachineStats,
+                                MachineStats.machine_id == Machines.id)
+                          .join(CurrentMachineStatus,
+                                CurrentMachineStatus.machine_id == Machines.id)
+                          .order_by(Machines.id)
+                          .all())
+        columns = list(zip(*rows)) or [[] for x in range(12)]
+
+        self.machine_ids = np.array(columns[0], dtype=int)
+        self.names = list(columns[1])
+        self.ideal_run_rate = np.array(columns[2], dtype=float)
+        self.efficiency = np.array(columns[3], dtype=float)
+        self.min_downtime_secs = np.array(columns[4], dtype=float)
+        self.downtime_probability = np.array(columns[5], dtype=float)
+        self.restart_probability = np.array(columns[6], dtype=float)
+        self.hourly_product_count = np.array(columns[7], dtype=int)
+        self.is_down = np.array(columns[8], dtype=bool)
+        self.last_down = np.array(columns[9], dtype='datetime64[us]')
+        self.hourly_down_count = np.array(columns[10], dtype=int)
+        self.total_secs_down = np.array(columns[11], dtype=int)
+        self.saved = self._status_columns()
+
+        # Machines in the order the PTV screen shows them
+        self.display_order = sorted(range(len(self.names)),
+                                    key=lambda i: self.names[i])
+
+    def clear(self):
+        """ Drop the state held, so it's loaded again on the next tick """
+
+        self.machine_ids = None
+
+    def tick(self):
+        """ Move every machine on by one update cycle and save them """
+
+        with self.lock:
+            if self.machine_ids is None:
+                self._load()
+            num_machines = len(self.machine_ids)
+            if not num_machines:
+                return 0
+
+            tick = current_app.config['UPDATE_CYCLE_SECS']
+            now = dt.datetime.utcnow()
+            rolls = self.rng.random(num_machines)
+            noise = self.rng.uniform(0.9, 1.1, num_machines)
+
+            # Machines that are down long enough have a chance of restarting
+            secs_down = ((np.datetime64(now, 'us') - self.last_down)
+                         / np.timedelta64(1, 's'))
+            can_restart = self.is_down & (secs_down > self.min_downtime_secs)
+            restarts = can_restart & (rolls < self.restart_probability)
+            stays_down = can_restart & ~restarts
+
+            # Running machines either go down or produce
+            is_up = ~self.is_down
+            goes_down = is_up & (rolls < self.downtime_probability)
+            produces = is_up & ~goes_down
+
+            per_tick_prod = (self.efficiency * self.ideal_run_rate
+                             * (tick / 60))
+            self.hourly_product_count += np.where(
+                            produces, (noise * per_tick_prod).astype(int), 0)
+            self.total_secs_down += np.where(stays_down, tick, 0)
+            self.hourly_down_count += goes_down
+            self.last_down[goes_down] = np.datetime64(now, 'us')
+            self.is_down = (self.is_down & ~restarts) | goes_down
+
+            try:
+                is_saved = self._save()
+            except Exception:
+                # Start again from whatever the database has
+                db.session.rollback()
+                self.clear()
+                raise
+            if not is_saved:
+                return 0
+            live_status.publish(self._statuses(now))
+            return num_machines
+
+    def _statuses(self, now):
+        """ Status dicts for every machine, as Machines.get_current_status
+        would give them at `now`
+        """
+
+        secs_down = ((np.datetime64(now, 'us') - self.last_down)
+                     // np.timedelta64(1, 's'))
+        secs_down = np.where(self.is_down & ~np.isnat(self.last_down),
+                             secs_down, 0)
+        mins_down = secs_down // 60
+
+        columns = {'is_down': self.is_down.tolist(),
+                   'secs_down': (secs_down % 60).tolist(),
+                   'mins_down': mins_down.tolist(),
+                   'prod_count': self.hourly_product_count.tolist(),
+                   'down_count': self.hourly_down_count.tolist()}
+        return [dict({'machine_name': self.names[i]},
+                     **{key: values[i] for key, values in columns.items()})
+                for i in self.display_order]
+
+    def _status_columns(self):
+        """ The status columns as lists, in the order _save binds them """
+
+        return (self.hourly_product_count.tolist(),
+                self.is_down.tolist(),
+                self.last_down.astype(object).tolist(),
+                self.hourly_down_count.tolist(),
+                self.total_secs_down.tolist())
+
+    def _save(self):
+        """ Write the statuses back, if no one else has changed them
+
+        Returns False, with nothing written and the fleet cleared, if any row
+        no longer holds the values this fleet last saved
+        """
+
+        names = ['_product', '_is_down', '_last_down', '_down_count',
+                 '_secs_down']
+        table = CurrentMachineStatus.__table__
+        columns = [table.c.hourly_product_count,
+                   table.c.is_down,
+                   table.c.last_down,
+                   table.c.hourly_down_count,
+                   table.c.total_secs_down]
+
+        # IS rather than = so that a NULL last_down still matches
+        statement = (table.update()
+                          .where(and_(table.c.machine_id
+                                      == bindparam('_machine_id'),
+                                      *[column.isnot_distinct_from(
+                                                    bindparam(f'_was{name}'))
+                                        for column, name
+                                        in zip(columns, names)]))
+                          .values({column.name: bindparam(name)
+                                   for column, name in zip(columns, names)}))
+
+        current = self._status_columns()
+        rows = [dict({'_machine_id': machine_id},
+                     **dict(zip(names, values)),
+                     **{f'_was{name}': value
+                        for name, value in zip(names, was)})
+                for machine_id, values, was
+                in zip(self.machine_ids.tolist(),
+                       zip(*current),
+                       zip(*self.saved))]
+
+        result = db.session.execute(statement, rows)
+        if result.rowcount != len(rows):
+            db.session.rollback()
+            self.clear()
+            return False
+        db.session.commit()
+        self.saved = current
+        return True
+
+fleet = Fleet()
@@ -0,0 +1,181 @@
+import multiprocessing
+import threading
+import time
+import uuid
+
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+
+from app.metrics import metrics
+
+
+class QueueFull(Exception):
+    pass
+
+
+class SolveJobs:
+    """ Runs schedule solves in a pool of background processes
+    
+    Solves are submitted with a prepared Solver and return a job id straight
+    away. Workers report their progress and check for cancellation through a
+    shared dict every Solver.callback_interval iterations. Job records live 
+    in the memory of the process that accepted the submission, so polling 
+    has to come back to the same process. The app is therefore served from
+    a single process, as set out in the README.
+    
+    Finished jobs are held for RETENTION_SECS so that their results can be 
+    collected, then dropped on the next submission.
+    """
+    
+    RETENTION_SECS = 3600
+    
+    def __init__(self):
+        self.jobs = {}
+        self.executor = None
+        self.manager = None
+        self.progress = None
+        self.cancelled = None
+        self.max_queued = None
+        self.lock = threading.Lock()
+    
+    def _start(self):
+        if self.executor is not None:
+            return
+        self.executor = ProcessPoolExecutor(
+                            max_workers=current_app.config['SOLVE_JOB_WORKERS']
+                            )
+        self.manager = multiprocessing.Manager()
+        self.progress = self.manager.dict()
+        self.cancelled = self.manager.dict()
+        self.max_queued = current_app.config['SOLVE_JOB_QUEUE_DEPTH']
+        
+    def _prune(self):
+        cutoff = time.time() - self.RETENTION_SECS
+        for job_id, job in list(self.jobs.items()):
+            if job['future'].done() and job['finished'] < cutoff:
+                self._forget(job_id)
+    
+    def _forget(self, job_id):
+        self.jobs.pop(job_id, None)
+        self.progress.pop(job_id, None)
+        self.cancelled.pop(job_id, None)
+        
+    def _on_done(self, job_id):
+        def callback(future):
+            job = self.jobs[job_id]
+            job['finished'] = time.time()
+            if not future.cancelled() and future.exception() is None:
+                metrics.record_solver(future.result())
+                metrics.observe('solve_job_seconds', 'submit_to_finish',
+                                job['finished'] - job['submitted'])
+        return callback
+    
+    def submit(self, problem, solver):
+        """ Queue a solve and return its job id
+        
+        :param problem: The finalised Problem, kept to build the Results
+        :param solver:  Solver for the problem, which is run in a worker
+        :raises QueueFull: If SOLVE_JOB_QUEUE_DEPTH solves are already 
+                           waiting or running
+        """
+        
+        with self.lock:
+            self._start()
+            self._prune()
+            
+            active = sum(1 for job in self.jobs.values() 
+                         if not job['future'].done())
+            if active >= self.max_queued:
+                raise QueueFull('Too many schedules are being solved. Please '
+                                'try again shortly')
+            
+            job_id = uuid.uuid4().hex
+            self.progress[job_id] = (0, None)
+            future = self.executor.submit(_run_job, solver, job_id, 
+                                          self.progress, self.cancelled)
+            self.jobs[job_id] = {'problem': problem,
+                                 'iterations': solver.iterations,
+                                 'submitted': time.time(),
+                                 'finished': None,
+                                 'future': future}
+            future.add_done_callback(self._on_done(job_id))
+        
+        return job_id
+    
+    def status(self, job_id):
+        """ Progress of a job, or None if the job id isn't known """
+        
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        
+        future = job['future']
+        iteration, best_cost = self.progress.get(job_id, (0, None))
+        
+        if future.cancelled() or (future.done() and job_id in self.cancelled):
+            status = 'cancelled'
+        elif future.done():
+            if future.exception() is not None:
+                status = 'failed'
+            else:
+                status = 'finished'
+                iteration = job['iterations']
+                best_cost = future.result().best_ever_cost
+        elif best_cost is not None:
+            status = 'running'
+        else:
+            status = 'queued'
+        
+        return {'job_id': job_id,
+                'status': status,
+                'iteration': iteration,
+                'iterations': job['iterations'],
+                'best_cost': None if best_cost is None else float(best_cost)}
+    
+    def result(self, job_id):
+        """ The solved Solver with its problem attached, or None if the job 
+        is unknown, unfinished or was cancelled
+        """
+        
+        job = self.jobs.get(job_id)
+        if job is None or job_id in self.cancelled:
+            return None
+        future = job['future']
+        if not future.done() or future.cancelled() or future.exception():
+            return None
+        
+        solver = future.result()
+        solver.problem = job['problem']
+        return solver
+    
+    def cancel(self, job_id):
+        """ Cancel a queued or running job. Returns False for unknown jobs 
+        and ones that have already finished, which keep their result
+        """
+        
+        job = self.jobs.get(job_id)
+        if job is None or job['future'].done():
+            return False
+        
+        # A queued job never starts. A running one stops at its next callback
+        self.cancelled[job_id] = True
+        job['future'].cancel()
+        return True
+    
+
+def _run_job(solver, job_id, progress, cancelled):
+    """ Run a solve in a worker process, reporting progress as it goes """
+    
+    def report(iteration, current_cost, best_cost):
+        progress[job_id] = (iteration, float(best_cost))
+        return job_id in cancelled
+    
+    if job_id in cancelled:
+        return solver
+    
+    solver.callback = report
+    solver.run_solver()
+    return solver
+
+
+solve_jobs = SolveJobs()
@@ -0,0 +1,180 @@
+import json
+import queue
+import threading
+import uuid
+
+from flask import current_app
+
+from app.manufacturing.models import Machines
+
+
+# Each machine is sent to streams as a row of these
+STREAM_FIELDS = ('machine_name', 'prod_count', 'down_count', 'is_down',
+                 'secs_down')
+
+# Put on a stream's queue when it fell behind, to send the whole snapshot
+RESYNC = object()
+
+
+class StreamsFull(Exception):
+    pass
+
+
+class Snapshot:
+    """ The status of every machine as of one tick
+
+    :param version:  Counts up with each tick published by this process
+    :param etag:     Unique to this process and version
+    :param statuses: Machine status dicts, as from Machines.get_current_status
+    :param previous: The Snapshot before, to work out what changed since
+    """
+
+    def __init__(self, version, etag, statuses, previous=None):
+        self.version = version
+        self.etag = etag
+        self.statuses = statuses
+
+        # The PTV screen for the snapshot, rendered by the first request
+        self.html = None
+
+        rows = [_stream_row(status) for status in statuses]
+        self.event = _event('snapshot', version, rows, fields=STREAM_FIELDS)
+
+        # Just the machines whose counts or state changed. The time down
+        # ticks on by itself, so on its own it doesn't count as a change
+        self.delta = None
+        if previous is not None:
+            before = {row[0]: row[1:4] for row in
+                      map(_stream_row, previous.statuses)}
+            changed = [row for row in rows if before.get(row[0]) != row[1:4]]
+            if changed:
+                self.delta = _event('delta', version, changed)
+
+
+def _stream_row(status):
+    return [status['machine_name'],
+            status['prod_count'],
+            status['down_count'],
+            int(status['is_down']),
+            status['mins_down'] * 60 + status['secs_down']]
+
+
+def _event(name, version, rows, **extra):
+    """ A server-sent event, with the rows as compact JSON """
+
+    data = dict({'v': version, 'm': rows}, **extra)
+    return (f'id: {version}\nevent: {name}\n'
+            f'data: {json.dumps(data, separators=(",", ":"))}\n\n')
+
+
+class Stream:
+    """ One client's queue of events to send
+
+    The queue holds up to LIVE_STATUS_STREAM_BUFFER events. A client that
+    falls that far behind has its queued deltas dropped, and is sent the
+    whole of the latest snapshot instead once it catches up.
+    """
+
+    def __init__(self, buffer):
+        self.events = queue.Queue(maxsize=buffer)
+        self.version = 0
+
+    def push(self, version, event):
+        try:
+            self.events.put_nowait((version, event))
+        except queue.Full:
+            with self.events.mutex:
+                self.events.queue.clear()
+                self.events.queue.append((version, RESYNC))
+                self.events.not_empty.notify()
+
+    def get(self, snapshot, timeout):
+        """ The next event to send, or None if there's nothing new by the
+        timeout
+
+        :param snapshot: Callable giving the latest Snapshot, for resyncs
+        """
+
+        while True:
+            try:
+                version, event = self.events.get(timeout=timeout)
+            except queue.Empty:
+                return None
+
+            if event is RESYNC:
+                latest = snapshot()
+                self.version = latest.version
+                return latest.event
+
+            # Anything already covered by a resync is skipped
+            if version > self.version:
+                self.version = version
+                return event
+
+
+class LiveStatus:
+    """ The latest machine statuses, published by the fleet after each tick
+
+    Pollers are served from the snapshot held here instead of querying the
+    database, and can tell it hasn't changed from its etag. Snapshots are
+    held in the memory of each process. Etags include a token for the
+    process, so a poll that lands on another worker just gets a fresh copy.
+
+    Each snapshot is also fanned out to up to LIVE_STATUS_MAX_STREAMS open
+    streams, as an event with just the machines that changed. The event is
+    encoded once per tick and shared by every stream.
+    """
+
+    def __init__(self):
+        self.snapshot = None
+        self.version = 0
+        self.token = uuid.uuid4().hex[:12]
+        self.streams = set()
+        self.lock = threading.Lock()
+
+    def publish(self, statuses):
+        with self.lock:
+            self.version += 1
+            self.snapshot = Snapshot(self.version,
+                                     f'{self.token}-{self.version}',
+                                     statuses,
+                                     self.snapshot)
+            snapshot = self.snapshot
+            streams = list(self.streams)
+
+        if snapshot.delta is not None:
+            for stream in streams:
+                stream.push(snapshot.version, snapshot.delta)
+        return snapshot
+
+    def get(self):
+        """ The latest Snapshot, from the database if there hasn't been a
+        tick yet
+        """
+
+        snapshot = self.snapshot
+        if snapshot is None:
+            snapshot = self.publish(Machines.get_current_status())
+        return snapshot
+
+    def subscribe(self):
+        """ A new Stream, which starts with the whole latest snapshot
+
+        :raises StreamsFull: If LIVE_STATUS_MAX_STREAMS are already open
+        """
+
+        config = current_app.config
+        stream = Stream(config['LIVE_STATUS_STREAM_BUFFER'])
+        with self.lock:
+            if len(self.streams) >= config['LIVE_STATUS_MAX_STREAMS']:
+                raise StreamsFull()
+            self.streams.add(stream)
+        stream.push(0, RESYNC)
+        return stream
+
+    def unsubscribe(self, stream):
+        with self.lock:
+            self.streams.discard(stream)
+
+
+live_status = LiveStatus()
@@ -1,7 +1,8 @@
 import random
 import sqlite3
+import time
 
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
 from flask import current_app
 from itertools import groupby
 from math import exp
@@ -17,6 +18,30 @@ import numpy as np
 import pandas as pd
 
 
+# SQLite expressions for the start of each rollup's period, formatted as 
+# SQLAlchemy stores datetimes. Weeks start on Monday, with %w counting from 
+# Sunday
+ROLLUP_PERIOD_SQL = {
+    'hour': "strftime('%Y-%m-%d %H:00:00.000000', h.datetime)",
+    'day': "strftime('%Y-%m-%d 00:00:00.000000', h.datetime)",
+    'week': ("strftime('%Y-%m-%d 00:00:00.000000', h.datetime, "
+             "'-' || ((strftime('%w', h.datetime) + 6) % 7) || ' days')")
+    }
+
+ROLLUP_INSERT_SQL = """
+    INSERT INTO machine_rollups (machine_id, resolution, period_start, 
+                                 product_count, down_count, down_secs, hours, 
+                                 oee)
+    SELECT h.machine_id, '{resolution}', {period_start}, 
+           SUM(h.product_count), SUM(h.down_count), SUM(h.down_secs), 
+           COUNT(*), 
+           100.0 * SUM(h.product_count) / (s.ideal_run_rate * 60 * COUNT(*))
+    FROM machine_history h
+    JOIN machine_stats s ON s.machine_id = h.machine_id
+    GROUP BY h.machine_id, {period_start}
+    """
+
+
 class MachineStats(db.Model):
     """ General stats about machines to create a fake history
 
@@ -63,78 +88,179 @@ class MachineHistory(db.Model):
     down_secs = db.Column(db.Integer)
     
     @staticmethod
-    def get_plots(stat):
+    def get_plots(stat, days=None):
+        """ Plot data for each machine over the last `days` days, from the 
+        rollups at the finest resolution that fits PLOT_MAX_POINTS points
+        
+        The data is columnar, to be sent as is as JSON. Every machine shares
+        the one list of times, in epoch seconds, and has a list of values 
+        lined up with it, with None for any period it has no rollup for
+        
+        :param stat: product_count, down_count, down_secs or oee
+        :param days: Days of history to plot. PLOT_DEFAULT_DAYS if not given
+        """
         
         allowed_stats = ('product_count', 'down_count', 'down_secs', 'oee')
         if stat not in allowed_stats:
             # Assume injection attempt and abort
             return {}
         
-        rtn = {}
-        
-        if stat != 'oee':
-            stat_name = stat
-        else:
-            # We need to scale this to ideal runrate
-            stat_name = 'product_count'
+        days = days or current_app.config['PLOT_DEFAULT_DAYS']
+        resolution = MachineRollup.resolution_for(days)
+        since = (dt.datetime.utcnow() - dt.timedelta(days=days)).strftime(
+                                                        MachineRollup.FORMAT)
         
         # Pass query off to raw, to avoid ORM overhead. No need for it here
         data = db.session.execute(
                       f"""
                        SELECT machines.name AS name, 
-                              machine_history.datetime,
-                              machine_history.{stat_name} 
-                       FROM machine_history
-                       JOIN machines ON machines.id = machine_history.machine_id
-                       ORDER BY name, machine_history.datetime
-                       """
+                              machine_rollups.period_start,
+                              machine_rollups.{stat} 
+                       FROM machine_rollups
+                       JOIN machines ON machines.id = machine_rollups.machine_id
+                       WHERE machine_rollups.resolution = :resolution
+                             AND machine_rollups.period_start >= :since
+                       """,
+                       {'resolution': resolution, 'since': since}
                        ).fetchall()
-            
-        df = pd.DataFrame(data, columns=['name', 'datetime', 'value'])
-        
-        if stat == 'oee':
-            ideal_run_rates = db.session.execute(
-                         """
-                         SELECT machines.name AS name,
-                                machine_stats.ideal_run_rate
-                         FROM machine_stats
-                         JOIN machines ON machines.id = machine_stats.machine_id
-                         """
-                         ).fetchall()
-            
-            mapper = {name: run_rate * 60 for name, run_rate in ideal_run_rates}
-            df['value'] = df.apply(lambda x: x['value'] / mapper.get(x['name']),
-                                   axis=1)
-            df['value'] *= 100
-        
-        max_val = 0
-        
-        # Make JSON serializable
-        for name, data in df.groupby('name'):
-            rtn[name] = {'datetimes': data['datetime'].tolist(),
-                         'plot_values': data['value'].astype(int).tolist()}
-            if data['value'].max() > max_val:
-                max_val = data['value'].max()
-        
+        names, period_starts, values = (list(zip(*data)) 
+                                        or [[] for x in range(3)])
+        
+        # Lay the values out as a machine x time grid
+        names, name_idx = np.unique(np.array(names, dtype=str), 
+                                    return_inverse=True)
+        times, time_idx = np.unique(np.array(period_starts, 
+                                             dtype='datetime64[s]'),
+                                    return_inverse=True)
+        grid = np.full((len(names), len(times)), np.nan)
+        grid[name_idx, time_idx] = values
+        
+        # Make JSON serializable, with whole numbers as before
+        plot_values = np.trunc(np.nan_to_num(grid)).astype(int).astype(object)
+        plot_values[np.isnan(grid)] = None
+        max_val = int(np.nanmax(grid)) if grid.size else 0
+        
+        per = MachineRollup.RESOLUTION_NAMES[resolution]
         stat_map = {'product_count': {'title': 'Product Count',
                                       'x_axis': 'Datetime',
-                                      'y_axis': 'Items Produced'},
+                                      'y_axis': f'{per} Items Produced'},
                     'down_count':    {'title': 'Machine Stoppages',
                                       'x_axis': 'Datetime',
-                                      'y_axis': 'Hourly Machine Stoppages'},
+                                      'y_axis': f'{per} Machine Stoppages'},
                     'down_secs':     {'title': 'Machine Downtime',
                                       'x_axis': 'Datetime',
-                                      'y_axis': 'Hourly Downtime (secs)'},
+                                      'y_axis': f'{per} Downtime (secs)'},
                     'oee':           {'title': 'Operational Efficiency',
                                       'x_axis': 'Datetime',
                                       'y_axis': 'Operational Efficiency (%)'}
                     }
-        rtn['chart_details'] = stat_map[stat]
-        rtn['max_val'] = max_val  
-         
-        return rtn
+        return {'names': names.tolist(),
+                'times': times.astype(int).tolist(),
+                'values': plot_values.tolist(),
+                'chart_details': stat_map[stat],
+                'max_val': max_val}
     
 
+class MachineRollup(db.Model):
+    """ Machine history summed by hour, day and week, for plotting
+    
+    Each hour's history is added to the rollups when the hour closes, so 
+    plots only read as many rows as they show. OEE is worked out as the 
+    rollup is updated, as the product count over what the ideal run rate 
+    would make in the hours it covers.
+    
+    :param resolution:   hour, day or week
+    :param period_start: Start of the hour, the day, or the Monday of the 
+                         week
+    :param hours:        Hours of history summed into the rollup
+    """
+    
+    __tablename__ = 'machine_rollups'
+    __table_args__ = (db.UniqueConstraint('machine_id', 'resolution', 
+                                          'period_start'),
+                      db.Index('ix_machine_rollups_resolution_period_start',
+                               'resolution', 'period_start'))
+    
+    RESOLUTIONS = ('hour', 'day', 'week')
+    RESOLUTION_NAMES = {'hour': 'Hourly', 'day': 'Daily', 'week': 'Weekly'}
+    
+    # How SQLAlchemy stores datetimes in SQLite, for raw queries to match
+    FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    machine_id = db.Column(db.Integer,
+                           db.ForeignKey('machines.id',
+                                         ondelete='CASCADE'),
+                           index=True)
+    machine = db.relationship('Machines', backref='rollups')
+    resolution = db.Column(db.String(4))
+    period_start = db.Column(db.DateTime)
+    product_count = db.Column(db.Integer)
+    down_count = db.Column(db.Integer)
+    down_secs = db.Column(db.Integer)
+    hours = db.Column(db.Integer)
+    oee = db.Column(db.Float)
+    
+    @staticmethod
+    def resolution_for(days):
+        """ The finest resolution with at most PLOT_MAX_POINTS in `days` """
+        
+        max_points = current_app.config['PLOT_MAX_POINTS']
+        if days * 24 <= max_points:
+            return 'hour'
+        if days <= max_points:
+            return 'day'
+        return 'week'
+    
+    @staticmethod
+    def period_starts(hour):
+        """ The start of each resolution's period that `hour` falls in """
+        
+        day = hour.replace(hour=0, minute=0, second=0, microsecond=0)
+        week = day - dt.timedelta(days=day.weekday())
+        return {'hour': hour, 'day': day, 'week': week}
+    
+    @staticmethod
+    def add_hour(machine, history):
+        """ Add a closed hour of MachineHistory to the machine's rollups """
+        
+        ideal_hourly = machine.stats.ideal_run_rate * 60
+        starts = MachineRollup.period_starts(history.datetime)
+        for resolution, period_start in starts.items():
+            rollup = (MachineRollup.query
+                                   .filter_by(machine_id=machine.id,
+                                              resolution=resolution,
+                                              period_start=period_start)
+                                   .first())
+            if rollup is None:
+                rollup = MachineRollup(machine_id=machine.id,
+                                       resolution=resolution,
+                                       period_start=period_start,
+                                       product_count=0,
+                                       down_count=0,
+                                       down_secs=0,
+                                       hours=0)
+                db.session.add(rollup)
+            
+            rollup.product_count += history.product_count
+            rollup.down_count += history.down_count
+            rollup.down_secs += history.down_secs
+            rollup.hours += 1
+            rollup.oee = (100 * rollup.product_count 
+                          / (ideal_hourly * rollup.hours))
+    
+    @staticmethod
+    def rebuild():
+        """ Build every rollup again from the whole machine history """
+        
+        db.session.execute('DELETE FROM machine_rollups')
+        for resolution, period_start in ROLLUP_PERIOD_SQL.items():
+            db.session.execute(ROLLUP_INSERT_SQL.format(
+                                                resolution=resolution,
+                                                period_start=period_start))
+        db.session.commit()
+
+
 class CurrentMachineStatus(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
@@ -156,49 +282,31 @@ class Machines(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20))
     
-    def update_status(self):
-        
-        tick = current_app.config['UPDATE_CYCLE_SECS']
-        
-        if self.status.is_down:
-            if ((dt.datetime.utcnow() - self.status.last_down).total_seconds() 
-                > self.stats.min_downtime_secs):
-                # Check to see if we come back up
-                if random.random() < self.stats.restart_probability:
-                    self.status.is_down = False
-                else:
-                    self.status.total_secs_down += tick
-        else:
-            # See if machine is going to go down
-            if random.random() < self.stats.downtime_probability:
-                self.status.is_down = True
-                self.status.last_down = dt.datetime.utcnow()
-                self.status.hourly_down_count += 1
-            else:
-                per_tick_prod_base = self.stats.ideal_run_rate * (tick / 60)
-                per_tick_prod = self.stats.efficiency * per_tick_prod_base
-                noise = random.uniform(0.9, 1.1)                    
-                self.status.hourly_product_count += int(noise * per_tick_prod)
-                
-        db.session.commit()
-    
     def reset_status(self):
         
-        # Clear out old data
+        # Clear out old data. Daily and weekly rollups are small enough to 
+        # keep for long range plots
         cutoff = dt.date.today() - dt.timedelta(weeks=12)
         old = (MachineHistory.query
                              .filter(and_(MachineHistory.datetime<=cutoff,
                                           MachineHistory.machine_id==self.id))
                              .delete())
+        old = (MachineRollup.query
+                            .filter(and_(MachineRollup.resolution=='hour',
+                                         MachineRollup.period_start<=cutoff,
+                                         MachineRollup.machine_id==self.id))
+                            .delete())
         db.session.commit()
         
-        self.history.append(
-            MachineHistory(datetime=dt.datetime.utcnow().replace(minute=0, 
-                                                                 second=0, 
-                                                                 microsecond=0),
-                           product_count=self.status.hourly_product_count,
-                           down_count=self.status.hourly_down_count,
-                           down_secs=self.status.total_secs_down))
+        history = MachineHistory(
+                    datetime=dt.datetime.utcnow().replace(minute=0, 
+                                                          second=0, 
+                                                          microsecond=0),
+                    product_count=self.status.hourly_product_count,
+                    down_count=self.status.hourly_down_count,
+                    down_secs=self.status.total_secs_down)
+        self.history.append(history)
+        MachineRollup.add_hour(self, history)
         
         db.session.commit()
         
@@ -394,6 +502,7 @@ class Machines(db.Model):
         db.session.commit()
         Machines._backdate_production()
         db.session.commit()
+        MachineRollup.rebuild()
         Machines._set_status()
     
     @staticmethod
@@ -413,6 +522,7 @@ class Problem:
         
         self.forecast = {}
         self.daterange = None
+        self.num_weeks = None
         
         self.productivity_map = {}
 
@@ -467,17 +577,31 @@ class Problem:
         except ValueError:
             return False, "Forecast entries must be numeric"
         
+        self._set_forecast(forecast)
+        
+        return True, 'success'
+    
+    def _set_forecast(self, forecast):
+        """ Interpolate the weekly forecast up to hourly cumulative demand
+        
+        :param forecast: DataFrame with a 'Product Name' column followed by a 
+                         column of demand for each week
+        """
+        
+        num_weeks = len(forecast.columns) - 1
+        
         # Add in an additional "week" so that interpolation starts at 0
         forecast.insert(1, 'Week 0', 0)
         
         # Add in a final "week" so that we have something to interp up to
-        forecast['Week 5'] = 0
+        forecast[f'Week {num_weeks + 1}'] = 0
         
         # Grab start date for the next Monday
         today = dt.date.today()
         days_to_add = 7 - today.weekday()
         next_monday = today + dt.timedelta(days=days_to_add)
-        date_range = pd.date_range(start=next_monday, periods=6, freq='W-MON')
+        date_range = pd.date_range(start=next_monday, periods=num_weeks + 2, 
+                                   freq='W-MON')
         
         # Transpose the df and get it at hourly granulatity using interpolate
         forecast = (forecast.set_index('Product Name')
@@ -487,12 +611,11 @@ class Problem:
         forecast = forecast.resample(rule='H').interpolate()
         
         self.daterange = forecast.index.astype(str).tolist()[:-1]
+        self.num_weeks = num_weeks + 1
         
         for product_name in forecast.columns:
             product_id = int(product_name.split()[1])
             self.forecast[product_id] = forecast[product_name].values
-        
-        return True, 'success'
     
     def _build_productivity_array(self, ave_production, shift_overlay, 
                                   num_weeks):
@@ -521,7 +644,7 @@ class Problem:
             expanded = self._build_productivity_array(
                                         self.machine_productivity[machine.id],
                                         shift_overlay,
-                                        5)
+                                        self.num_weeks)
             # Add the productivity but scale down by 1000 to match the units 
             # that the forecast is specified in
             self.productivity_map[machine.id] = expanded / 1000
@@ -529,6 +652,45 @@ class Problem:
             
     def finalise_build(self):
         self._build_productivity_map()
+    
+    @classmethod
+    def from_params(cls, weekly_forecast, machine_products, machine_shifts):
+        """ Build a problem directly rather than from a front-end request
+        
+        Products are named as in the config, 'Product <id>'. Machines are 
+        taken from the database as usual.
+        
+        :param weekly_forecast:  {product_id: [demand for each week]}
+        :param machine_products: {machine_id: [product ids it can make]}
+        :param machine_shifts:   {machine_id: shift pattern name}
+        """
+        
+        problem = cls(None)
+        problem.products = sorted(weekly_forecast)
+        problem.product_name_map = {product_id: f'Product {product_id}' 
+                                    for product_id in problem.products}
+        
+        for machine in problem.machines:
+            problem.machine_products[machine.id] = machine_products.get(
+                                                                machine.id, [])
+            problem.machine_productivity[machine.id] = (
+                                    machine.get_average_hourly_production()
+                                    )
+            shift_name = machine_shifts.get(machine.id)
+            if shift_name:
+                problem.machine_shifts[machine.id] = (
+                                   current_app.config['SHIFT_HOURS'][shift_name]
+                                   )
+        
+        forecast = pd.DataFrame(
+                        [[problem.product_name_map[product_id]] + list(demand) 
+                         for product_id, demand in weekly_forecast.items()])
+        forecast.columns = (['Product Name'] 
+                            + [f'Week {x}' for x in 
+                               range(1, len(forecast.columns))])
+        problem._set_forecast(forecast)
+        problem.finalise_build()
+        return problem
         
     @staticmethod
     def create_forecast():
@@ -555,16 +717,24 @@ class Solver:
         # ======================================================================
         self.min_swap_hours = 8    
         
+        self.machine_ids = [item.id for item in self.problem.machines]
+        self.product_ids = self.problem.products
+        
+        # All solver state is held in dense (machines x hours) and 
+        # (products x hours) matrices. These map the database/config ids onto 
+        # the matrix rows so that lookups in the solution loop are just indexing
+        self.machine_index = {machine_id: i for i, machine_id 
+                              in enumerate(self.machine_ids)}
+        self.product_index = {product_id: i for i, product_id 
+                              in enumerate(self.product_ids)}
+        
         # Hours lost due to product switchover
         self.knockout_hours = {product_id: 1 for product_id
                                in self.problem.products}
         
         # Add a null product to all machine capabilities
-        self.machine_products = {product_id: products + [0] 
-                                 for product_id, products in 
-                                 self.problem.machine_products.items()}
-        self.machine_ids = [item.id for item in self.problem.machines]
-        self.product_ids = self.problem.products
+        self.machine_products = [self.problem.machine_products[machine_id] + [0]
+                                 for machine_id in self.machine_ids]
         
         # How far ahead to look before penalising over-production (hours)
         self.lookahead_hours_penalty_dict = {product_id: 24 for product_id 
@@ -579,39 +749,85 @@ class Solver:
         
         self.default_knockout = 1
         
-        # Swaps
-        self.machine_swaps = np.random.choice(self.machine_ids, 
-                                              self.iterations,
-                                              replace=True).tolist()
-        self.row_swaps = [0 for x in range(self.iterations)]
-        self.product_swaps = [0 for x in range(self.iterations)]
+        # Recompute every incremental cost in full and check they agree. Slow;
+        # only for testing changes to the cost function
+        self.validate_costs = False
+        
+        # Optional hook called every callback_interval iterations with 
+        # (iteration, current cost, best cost). Returning True stops the solve
+        self.callback = None
+        self.callback_interval = 100
+        
+        # Number of upcoming moves to cost at once. Moves on a machine or 
+        # product that an earlier move in the batch changed are costed again on
+        # their own. 1 costs every move on its own
+        self.batch_size = 16
+        
+        # Swaps. Machines are stored by their row in the solution matrix
+        self.machine_swaps = []
+        self.row_swaps = []
+        self.product_swaps = []
         
         # Container to store individual product cost contributions to solution
-        self.wip_cost_contributions = np.full(len(self.problem.products) + 1, 
+        self.wip_cost_contributions = np.full(len(self.product_ids), 
                                               0).astype(np.float64)
         
-        self.swap_indices = {}
-        self.solution_max_index = (len(self.problem.daterange) - 
-                                   (self.min_swap_hours + 1))
-        self.solution = {machine.id: np.full(len(self.problem.daterange), 0)
-                         for machine in self.problem.machines}          
+        num_hours = len(self.problem.daterange)
+        
+        self.swap_indices = [[] for machine_id in self.machine_ids]
+        self.solution_max_index = num_hours - (self.min_swap_hours + 1)
+        self.solution = np.full((len(self.machine_ids), num_hours), 0)
 
         self.best_ever_cost = np.inf
-        self.best_ever_production = {}
-        self.best_ever_solution = {}
+        self.best_ever_production = np.zeros((len(self.product_ids), 
+                                              num_hours))
+        self.best_ever_solution = np.zeros_like(self.solution)
         
         # To store what a machine could be making at any time
-        self.productivity_map = deepcopy(self.problem.productivity_map)
+        self.productivity_map = np.vstack([
+                                    self.problem.productivity_map[machine_id]
+                                    for machine_id in self.machine_ids
+                                    ]).astype(np.float64)
         
         # To store the WIP production per hour
-        self.wip_production = {product_id: np.full(len(self.problem.daterange), 
-                                                   0)
-                               for product_id in self.problem.products}
-        self.wip_demands = {product_id: self.problem.forecast[product_id][1:]
-                            for product_id in self.problem.products}
+        self.wip_production = np.zeros((len(self.product_ids), num_hours))
+        self.wip_demands = np.vstack([
+                                    self.problem.forecast[product_id][1:]
+                                    for product_id in self.product_ids
+                                    ]).astype(np.float64)
+        
+        # Per-product lookups indexed directly by product id, so the solution
+        # loop never has to go through a dict
+        max_product_id = max(self.product_ids, default=0)
+        self._product_rows = [-1 for x in range(max_product_id + 1)]
+        self._knockouts = [0 for x in range(max_product_id + 1)]
+        for product_id, wip in self.product_index.items():
+            self._product_rows[product_id] = wip
+            self._knockouts[product_id] = self.knockout_hours.get(
+                                           product_id, self.default_knockout)
+        
+        # Scratch buffers to roll back a rejected move without copying rows
+        self._production_backup = np.zeros((2, num_hours))
+        self._solution_backup = np.zeros(self.min_swap_hours, 
+                                         dtype=self.solution.dtype)
+        self._touched = []
+        
+        # Hourly cost of each product, plus a running total of those costs 
+        # with a leading 0 so that the cost up to any hour is a single lookup
+        self._hourly_costs = np.zeros((len(self.product_ids), num_hours))
+        self._hourly_cost_prefix = np.zeros((len(self.product_ids), 
+                                             num_hours + 1))
+        self._cost_tails = np.zeros((2, num_hours))
         
         self.convergence = []
         
+        # Filled in as the solver runs, for instrumentation. Phase times are 
+        # (wall secs, CPU secs) keyed by the name of the phase method
+        self.phase_times = {}
+        self.iterations_run = 0
+        self.accepted_moves = 0
+        self.scored_moves = 0
+        
              
     def _get_swap_indices(self):
         """ Return list of swappable indices for each machine 
@@ -627,7 +843,7 @@ class Solver:
         on shifts being generally regular in rotation. This is generally true.
         """
         
-        for machine_id, productivity in self.problem.productivity_map.items():
+        for machine, productivity in enumerate(self.productivity_map):
             arr = productivity.nonzero()[0].tolist()
 
             swaps = []
@@ -642,52 +858,47 @@ class Solver:
                 # Drop the last index in case a swap here would go over the 
                 # end of the array. We just have to live with this last item
                 # being made
-                self.swap_indices[machine_id] = start_indices[:-1]
+                self.swap_indices[machine] = start_indices[:-1]
     
     def _build_initial_solution(self):
         
-        for machine in self.problem.machines:
-            swap_indices = self.swap_indices.get(machine.id)
+        for machine, swap_indices in enumerate(self.swap_indices):
             if not swap_indices:
                 continue
+            machine_soln = self.solution[machine]
             for index in swap_indices:
-                product = random.choice(self.machine_products[machine.id])
-                self.solution[machine.id][index:index+self.min_swap_hours] = (
-                                                                        product
-                                                                        )
+                product = random.choice(self.machine_products[machine])
+                machine_soln[index:index+self.min_swap_hours] = product
     
     def _get_initial_productivity(self):
         
-        solution_matrix = pd.DataFrame(self.solution).values
-        production_matrix = pd.DataFrame(self.productivity_map).values
-        
-        for product_id in self.problem.products:
+        for product_id in self.product_ids:
             knockout_hours = self.knockout_hours.get(product_id, 0)
             
-            if knockout_hours:
-                local_solution = deepcopy(solution_matrix)
-                local_productivity = deepcopy(production_matrix)
-                
-                rolled = np.roll(local_solution, knockout_hours, axis=0)
-                indices = np.where(local_solution != rolled) 
-                                
-                local_productivity[indices[0], indices[1]] = 0
-                
-                production = np.where(local_solution == product_id, 
-                                      local_productivity, 0).astype(np.float64)
-            
-            production = production.cumsum(axis=1)
-            production = production[:, -1].cumsum()
+            # Knock out the first hours of every run where the product changes
+            rolled = np.roll(self.solution, knockout_hours, axis=1)
+            production = np.where((self.solution == product_id) 
+                                  & (self.solution == rolled), 
+                                  self.productivity_map, 0)
             
-            self.wip_production[product_id] = production.copy()
+            self.wip_production[self.product_index[product_id]] = (
+                                                  production.sum(axis=0)
+                                                            .cumsum()
+                                                  )
     
     def _generate_profiles(self):
         
-        for i, machine_id in enumerate(self.machine_swaps):
-            index_list = self.swap_indices.get(machine_id)
+        self.machine_swaps = np.random.choice(len(self.machine_ids), 
+                                              self.iterations,
+                                              replace=True).tolist()
+        self.row_swaps = [0 for x in range(self.iterations)]
+        self.product_swaps = [0 for x in range(self.iterations)]
+        
+        for i, machine in enumerate(self.machine_swaps):
+            index_list = self.swap_indices[machine]
             if not index_list:
                 continue
-            product_list = self.machine_products[machine_id]
+            product_list = self.machine_products[machine]
             
             self.row_swaps[i] = random.choice(index_list)
             self.product_swaps[i] = random.choice(product_list)
@@ -696,6 +907,11 @@ class Solver:
         
     
     def _soft_solution_costs(self, wip, production):
+        """ Cost of a single product row of the production matrix
+        
+        :param wip:        Row of the product in the production matrix
+        :param production: Cumulative production for the product 
+        """
         
         cost = 0
 
@@ -704,7 +920,8 @@ class Solver:
         cost += missed_demand
         
         # OVERPRODUCTION
-        lookahead_hours = self.lookahead_hours_penalty_dict.get(wip, 24)
+        lookahead_hours = self.lookahead_hours_penalty_dict.get(
+                                                     self.product_ids[wip], 24)
         buffered_demand = demand * self.buffer_stock_percentage
         
         production_window = production[:-lookahead_hours]
@@ -724,171 +941,297 @@ class Solver:
         
         return cost
     
+    def _build_cost_tables(self):
+        """ Lay out the demand that each hour of production is compared to
+        
+        Each penalty in _soft_solution_costs compares production in one hour
+        with (buffered) demand in one hour, so the cost can be split out per 
+        hour. Hours beyond the lookahead are compared against an infinite 
+        demand so that they always clip to 0. The final day is compared 
+        against the buffered demand in _get_hourly_costs.
+        """
+        
+        buffered_demand = self.wip_demands * self.buffer_stock_percentage
+        
+        self._lookahead_demands = np.full_like(buffered_demand, np.inf)
+        for wip, product_id in enumerate(self.product_ids):
+            lookahead_hours = self.lookahead_hours_penalty_dict.get(product_id, 
+                                                                    24)
+            if lookahead_hours > 0:
+                self._lookahead_demands[wip, :-lookahead_hours] = (
+                                      buffered_demand[wip, lookahead_hours:]
+                                      )
+            else:
+                self._lookahead_demands[wip] = buffered_demand[wip]
+        
+        self._final_demands = buffered_demand
+        
+    def _get_hourly_costs(self, wip, start, production, out):
+        """ Per-hour cost of a product from hour `start` to the end 
+        
+        :param wip:        Row of the product in the production matrix
+        :param start:      First hour to cost
+        :param production: Cumulative production from `start` onwards
+        :param out:        Array to write the hourly costs to
+        """
+        
+        np.subtract(self.wip_demands[wip, start:], production, out=out)
+        out.clip(0, out=out)
+        out *= 5
+        out += (production - self._lookahead_demands[wip, start:]).clip(0)
+        
+        # Only the final day is compared to the demand at the same hour
+        final_hours = min(24, out.shape[-1])
+        out[..., -final_hours:] += (
+                            production[..., -final_hours:] 
+                            - self._final_demands[wip, -final_hours:]).clip(0)
+        return out
+        
     def _get_initial_solution_cost(self):
-        for product_id in self.problem.products:
-            production = self.wip_production[product_id]
-            initial_cost = self._soft_solution_costs(product_id, 
-                                                     production)
-            self.wip_cost_contributions[product_id] = initial_cost
+        self._build_cost_tables()
+        
+        for wip, production in enumerate(self.wip_production):
+            self._get_hourly_costs(wip, 0, production, self._hourly_costs[wip])
+        
+        self._hourly_costs.cumsum(axis=1, out=self._hourly_cost_prefix[:, 1:])
+        self.wip_cost_contributions[:] = self._hourly_cost_prefix[:, -1]
+        
+        if self.validate_costs:
+            for wip, production in enumerate(self.wip_production):
+                self._check_cost(wip, self.wip_cost_contributions[wip])
+    
+    def _check_cost(self, wip, cost):
+        full_cost = self._soft_solution_costs(wip, self.wip_production[wip])
+        if not np.isclose(cost, full_cost):
+            raise AssertionError(f'Incremental cost {cost} for product row '
+                                 f'{wip} does not match full cost {full_cost}')
+    
+    def _get_delta_cost(self, wip, row, slot):
+        """ Cost of a product where production has only changed from `row`
+        
+        Everything before `row` is unchanged, so comes straight from the 
+        running total and only the remaining hours are re-costed. The hourly 
+        costs are kept in `slot` of the scratch buffer in case the move is
+        accepted.
+        """
+        
+        tail = self._get_hourly_costs(wip, row, self.wip_production[wip, row:], 
+                                      self._cost_tails[slot, row:])
+        cost = self._hourly_cost_prefix[wip, row] + tail.sum()
+        
+        if self.validate_costs:
+            self._check_cost(wip, cost)
+        
+        return cost
+    
+    def _commit_costs(self, row):
+        """ Fold the hourly costs of an accepted move into the running totals 
+        """
+        
+        for slot, wip in enumerate(self._touched):
+            self._hourly_costs[wip, row:] = self._cost_tails[slot, row:]
+            prefix = self._hourly_cost_prefix[wip]
+            self._cost_tails[slot, row:].cumsum(out=prefix[row + 1:])
+            prefix[row + 1:] += prefix[row]
+        self._touched = []
+    
+    def _backup_production(self, product_id, row):
+        """ Keep a copy of the tail of a product row before a move edits it """
+        
+        wip = self._product_rows[product_id]
+        if wip not in self._touched:
+            self._production_backup[len(self._touched), row:] = (
+                                                self.wip_production[wip, row:]
+                                                )
+            self._touched.append(wip)
+        return self.wip_production[wip]
        
-    def _add_remove_production(self, wip_modified):
+    def _add_remove_production(self, machine, row, new_wip, old_wip, 
+                               prior_product, next_product):
+        """
+        Applies a single move to the solution and production matrices in place
+        and costs the products that it changed. The move can be undone with 
+        _revert_production if it's rejected.
+        
+        Takes the same arguments as _apply_move
+            
+        Returns:
+            {product row: new cost contribution} for the modified products
+        """
+        
+        self._apply_move(machine, row, new_wip, old_wip, prior_product, 
+                         next_product)
+        
+        return {wip: self._get_delta_cost(wip, row, slot)
+                for slot, wip in enumerate(self._touched)}
+    
+    def _apply_move(self, machine, row, new_wip, old_wip, prior_product, 
+                    next_product):
         """
-        Takes a list of dictionaries for wip codes that are added or removed
-        from the production plan. Copies only the affected rows and returns
-        the results of modification.
+        Applies a single move to the solution and production matrices in place.
+        Only the rows of the products that are added or removed are touched,
+        with their previous values stashed so that the move can be undone.
         
         Takes:
-            {'new_wip_code': int, 'machine_index': int, 'start_row': int,
-            'previous_wip_code': int, 'prior_product': int or None}
+            machine:       row of the machine in the solution matrix
+            row:           hour at which the swap starts
+            new_wip:       product id being swapped in
+            old_wip:       product id being swapped out
+            prior_product: product id running the hour before the swap, or None
+            next_product:  product id running after the swap, or None
         """
         
-        modified_wip_production = {}
-        modified_solution = {}
-        wip_cost_contributions = self.wip_cost_contributions.copy()
-        
-        for bundle in wip_modified:
-            new_wip = bundle['new_wip_code']
-            old_wip = bundle['previous_wip_code']
-            machine = bundle['machine_index']
-            row = bundle['start_row']
-            prior_product = bundle['prior_product']
-            next_product = bundle['next_product']
+        self._touched = []
+        
+        if new_wip == old_wip:
+            # Can't alter solution cost, short-circuit
+            return
+        
+        _stop = row + self.min_swap_hours
+        machine_productivity = self.productivity_map[machine]
+        machine_production = machine_productivity[row:_stop]
+        
+        if old_wip != 0:
+            # Do we have to account for knockout on the wip we're removing?
+            if old_wip != prior_product:
+                old_knockout = self._knockouts[old_wip]
+            else:
+                old_knockout = 0
             
-            _stop = row + self.min_swap_hours
-            machine_production = self.productivity_map[machine][row:_stop]
+            wip_production = self._backup_production(old_wip, row)
             
-            if new_wip == old_wip:
-                # Can't alter solution cost, short-circuit
-                continue
+            produced = machine_production[old_knockout:]
+            wip_production[row + old_knockout:_stop] -= produced.cumsum()
+            wip_production[_stop:] -= produced.sum()
             
-            if old_wip != 0:
-                # Do we have to account for knockout on the wip we're removing?
-                if old_wip != prior_product:
-                    old_knockout = self.knockout_hours.get(old_wip, 
-                                                           self.default_knockout
-                                                           )
-                else:
-                    old_knockout = 0
-                
-                # Get the current production. Check first whether we've already
-                # made some alteration on a previous iteration
-                wip_production = modified_wip_production.get(
-                                                    old_wip,
-                                                    self.wip_production[old_wip]
-                                                    ).copy()
-                
-                cumsum = machine_production[old_knockout:].cumsum()
-                final_sum = machine_production[old_knockout:].sum()
-                
-                _start = row + old_knockout
-                _stop = row + self.min_swap_hours
-                wip_production[_start:_stop] -= cumsum
-                wip_production[row + self.min_swap_hours:] -= final_sum
-                
-                # Store the modified values
-                modified_wip_production[old_wip] = wip_production
-                
-            if new_wip != 0:
-                # See whether this new product represents a product change
-                if new_wip != prior_product:
-                    new_knockout = self.knockout_hours.get(new_wip, 
-                                                           self.default_knockout
-                                                           )
-                else:
-                    new_knockout = 0
-                
-                # Get the current production. Check first whether we've already
-                # made some alteration on a previous iteration
-                wip_production = modified_wip_production.get(
-                                                    new_wip,
-                                                    self.wip_production[new_wip]
-                                                    ).copy()
-                
-                cumsum = machine_production[new_knockout:].cumsum()
-                final_sum = machine_production[new_knockout:].sum()
-                
-                _start = row+new_knockout
-                _stop = row + self.min_swap_hours
-                wip_production[_start:_stop] += cumsum
-                
-                wip_production[row + self.min_swap_hours:] += final_sum
-                
-                # Store the modified values
-                modified_wip_production[new_wip] = wip_production
-                machine_soln = modified_solution.get(machine,
-                                                     self.solution[machine]
-                                                     ).copy()
-                
-                machine_soln[row:row + self.min_swap_hours] = new_wip
-                
-                modified_solution[machine] = machine_soln
+        if new_wip != 0:
+            # See whether this new product represents a product change
+            if new_wip != prior_product:
+                new_knockout = self._knockouts[new_wip]
+            else:
+                new_knockout = 0
             
-            if next_product and (next_product == new_wip): 
-                    
-                next_prod_knockout = self.knockout_hours.get(
-                                            next_product, self.default_knockout
-                                            )
-                    
-                if next_prod_knockout:
-                    next_prod_production = (
-                                modified_wip_production.get(next_product).copy()
-                                )
-                    
-                    _start = row + self.min_swap_hours
-                    _stop = row + self.min_swap_hours + next_prod_knockout
-                    machine_productivity = (
-                                    self.productivity_map[machine][_start:_stop]
-                                    )
-                    
-                    _start = row + self.min_swap_hours
-                    _stop = row + self.min_swap_hours+next_prod_knockout
-                    _increment = machine_productivity.cumsum()
-                    next_prod_production[_start:_stop] += _increment
-                    next_prod_production[_stop:] += machine_productivity.sum()
-                    
-                    modified_wip_production[next_product] = next_prod_production    
+            wip_production = self._backup_production(new_wip, row)
             
-            if next_product and (next_product == old_wip):
-                    
-                next_prod_knockout = self.knockout_hours.get(
-                                            next_product, self.default_knockout
-                                            )
-                    
-                if next_prod_knockout:
-                    next_prod_production = modified_wip_production.get(
-                                next_product, self.wip_production[next_product]
-                                ).copy()
-                    
-                    _start = row + self.min_swap_hours
-                    _stop = row + self.min_swap_hours + next_prod_knockout
-                    machine_productivity = (
-                                    self.productivity_map[machine][_start:_stop]
-                                    )
-
-                    _start = row + self.min_swap_hours
-                    _stop = row + self.min_swap_hours+next_prod_knockout
-                    _increment = machine_productivity.cumsum()
-                    next_prod_production[_start:_stop] -= _increment
-                    next_prod_production[_stop:] -= machine_productivity.sum()
+            produced = machine_production[new_knockout:]
+            wip_production[row + new_knockout:_stop] += produced.cumsum()
+            wip_production[_stop:] += produced.sum()
+        
+        if next_product and next_product in (new_wip, old_wip):
+            # The following run either gains or loses its own knockout
+            next_prod_knockout = self._knockouts[next_product]
+            if next_prod_knockout:
+                next_prod_production = self._backup_production(next_product, 
+                                                               row)
                 
-                    modified_wip_production[next_product] = next_prod_production
-            
-            machine_soln = modified_solution.get(machine,
-                                      self.solution[machine]).copy()
-                
-            machine_soln[row:row+self.min_swap_hours] = new_wip
-                
-            modified_solution[machine] = machine_soln
-            
-        # Now get the new costs
-        for wip_code, production in modified_wip_production.items():
-            wip_cost_contributions[wip_code] = (
-                                self._soft_solution_costs(wip_code, production)
-                                )
+                _next_stop = _stop + next_prod_knockout
+                produced = machine_productivity[_stop:_next_stop]
+                if next_product == new_wip:
+                    next_prod_production[_stop:_next_stop] += produced.cumsum()
+                    next_prod_production[_next_stop:] += produced.sum()
+                else:
+                    next_prod_production[_stop:_next_stop] -= produced.cumsum()
+                    next_prod_production[_next_stop:] -= produced.sum()
+        
+        machine_soln = self.solution[machine]
+        self._solution_backup[:] = machine_soln[row:_stop]
+        machine_soln[row:_stop] = new_wip
+    
+    def _revert_production(self, machine, row):
+        """ Roll back the last call to _add_remove_production """
         
-        return (modified_wip_production, 
-                modified_solution, 
-                wip_cost_contributions)
+        if not self._touched:
+            return
+        for i, wip in enumerate(self._touched):
+            self.wip_production[wip, row:] = self._production_backup[i, row:]
+        self.solution[machine, row:row + self.min_swap_hours] = (
+                                                        self._solution_backup
+                                                        )
+        self._touched = []
+    
+    def _score_moves(self, start, stop):
+        """ Cost the moves from iteration `start` to `stop` in one go
+        
+        Every move is costed against the current state, as if it were the next
+        move to be made. Each move is split into two edits: removing the old 
+        product and adding the new one. The change in cumulative production 
+        for every edit is laid out in a matrix so that the whole batch is 
+        costed with array operations rather than a move at a time. Hours 
+        before the earliest swap in the batch are unchanged, so costing starts
+        from there.
+        
+        Returns:
+            costs:      new cost contribution for each edit. Edit i removes the
+                        old product for move i, edit i + len(moves) adds the 
+                        new one
+            rows:       product row for each edit
+            valid:      whether each edit changes anything
+            hourly:     hourly costs for each edit, for _commit_costs
+            first_hour: hour that the first column of `hourly` refers to
+        """
+        
+        machines = self._machine_swap_array[start:stop]
+        rows = self._row_swap_array[start:stop]
+        new_products = self._product_swap_array[start:stop]
+        num_hours = self.solution.shape[1]
+        
+        old_products = self.solution[machines, rows]
+        prior_products = np.where(rows > 0, self.solution[machines, rows - 1], 
+                                  -1)
+        next_index = np.minimum(rows + self.min_swap_hours + 1, num_hours - 1)
+        next_products = np.where(rows < self.solution_max_index, 
+                                 self.solution[machines, next_index], 0)
+        
+        products = np.concatenate([old_products, new_products])
+        signs = np.repeat([-1.0, 1.0], len(rows))[:, None]
+        machines = np.tile(machines, 2)[:, None]
+        rows = np.tile(rows, 2)
+        prior_products = np.tile(prior_products, 2)
+        next_products = np.tile(next_products, 2)
+        valid = (products != 0) & np.tile(old_products != new_products, 2)
+        
+        knockouts = np.where(products != prior_products, 
+                             self._knockout_array[products], 0)
+        next_knockouts = np.where(products == next_products, 
+                                  self._knockout_array[next_products], 0)
+        
+        # Production over the swap, then over the start of the following run 
+        # if it gains or loses its knockout
+        offsets = np.arange(self.min_swap_hours + self._knockout_array.max())
+        hours = rows[:, None] + offsets
+        is_produced = ((offsets >= knockouts[:, None])
+                       & (offsets < self.min_swap_hours 
+                                    + next_knockouts[:, None])
+                       & (hours < num_hours))
+        produced = self.productivity_map[machines, 
+                                         np.minimum(hours, num_hours - 1)]
+        produced *= is_produced
+        produced *= signs
+        produced.cumsum(axis=1, out=produced)
+        
+        # Cumulative production is unchanged before the swap, follows the
+        # running total through it and then holds at the total. The end is
+        # padded so that the scatter never has to be clipped
+        first_hour = rows.min()
+        window_ends = rows + len(offsets) - first_hour
+        delta = np.empty((len(products), num_hours - first_hour + len(offsets)))
+        np.multiply(np.arange(delta.shape[1]) >= window_ends[:, None], 
+                    produced[:, -1:], out=delta)
+        delta[np.arange(len(products))[:, None], hours - first_hour] = produced
+        
+        product_rows = self._product_row_array[products]
+        production = self.wip_production[product_rows, first_hour:]
+        production += delta[:, :num_hours - first_hour]
+        hourly = self._get_hourly_costs(product_rows, first_hour, production, 
+                                        delta[:, :num_hours - first_hour])
+        costs = hourly.sum(axis=1) + self._hourly_cost_prefix[product_rows, 
+                                                              first_hour]
+        
+        return (costs.tolist(), 
+                product_rows.tolist(), 
+                valid.tolist(), 
+                hourly,
+                first_hour)
         
     def _run_solution_loop(self):
         
@@ -897,53 +1240,115 @@ class Solver:
         current_best_cost = self.wip_cost_contributions.sum()
         best_ever_cost = current_best_cost
         
-        self.best_ever_production = deepcopy(self.wip_production)
-        self.best_ever_solution = deepcopy(self.solution)
+        np.copyto(self.best_ever_production, self.wip_production)
+        np.copyto(self.best_ever_solution, self.solution)
+        
+        solution = self.solution
+        cost_contributions = self.wip_cost_contributions
+        min_swap_hours = self.min_swap_hours
+        solution_max_index = self.solution_max_index
+        callback = self.callback
+        callback_interval = self.callback_interval
+        
+        batch_size = self.batch_size
+        batch_start = batch_stop = 0
+        scored_moves = 0
+        iterations_run = self.iterations
+        changed_machines = set()
+        changed_products = set()
+        if batch_size > 1:
+            self._machine_swap_array = np.array(self.machine_swaps, dtype=int)
+            self._row_swap_array = np.array(self.row_swaps, dtype=int)
+            self._product_swap_array = np.array(self.product_swaps, dtype=int)
+            self._knockout_array = np.array(self._knockouts, dtype=int)
+            self._product_row_array = np.array(self._product_rows, dtype=int)
         
         for x in range(self.iterations):
             
+            if callback and not x % callback_interval:
+                if callback(x, current_best_cost, best_ever_cost):
+                    iterations_run = x
+                    break
+            
             machine = self.machine_swaps[x]
             row = self.row_swaps[x]
             new_product = self.product_swaps[x]
-            previous_product = self.solution[machine][row]
+            machine_soln = solution[machine]
+            previous_product = machine_soln[row]
             
             if row > 0:
-                prior_running = self.solution[machine][row - 1]
+                prior_running = machine_soln[row - 1]
             else:
                 prior_running = None
             
             # Prevent us indexing beyond the length of the solution
-            if row < self.solution_max_index:
-                next_product = (self.solution[machine][row+self.min_swap_hours+1])
+            if row < solution_max_index:
+                next_product = machine_soln[row + min_swap_hours + 1]
             else:
                 next_product = None
+        
+            is_scored = False
+            if batch_size > 1:
+                if x >= batch_stop:
+                    batch_start = x
+                    batch_stop = min(x + batch_size, self.iterations)
+                    (batch_costs, batch_rows, batch_valid, 
+                     batch_hourly, first_hour) = self._score_moves(batch_start,
+                                                                   batch_stop)
+                    changed_machines.clear()
+                    changed_products.clear()
                 
-            bundle = [{'new_wip_code': new_product, 
-                       'machine_index': machine, 
-                       'start_row': row,
-                       'previous_wip_code': previous_product,
-                       'prior_product': prior_running,
-                       'next_product': next_product}]
-        
-            mod_prod, mod_soln, costs = self._add_remove_production(bundle)
-            new_cost = costs.sum()
+                # The batch cost is stale if an accepted move has since changed
+                # this machine or either product
+                is_scored = not (machine in changed_machines
+                                 or previous_product in changed_products
+                                 or new_product in changed_products)
+                
+            if is_scored:
+                scored_moves += 1
+                edits = (x - batch_start, x - batch_start + batch_stop 
+                         - batch_start)
+                costs = {batch_rows[i]: batch_costs[i] for i in edits 
+                         if batch_valid[i]}
+                
+                is_applied = self.validate_costs
+                if is_applied:
+                    self._apply_move(machine, row, new_product, 
+                                     previous_product, prior_running, 
+                                     next_product)
+                    for wip, cost in costs.items():
+                        self._check_cost(wip, cost)
+            else:
+                costs = self._add_remove_production(machine, row, new_product, 
+                                                    previous_product, 
+                                                    prior_running, next_product)
+                is_applied = True
+            
+            candidate_costs = cost_contributions.copy()
+            for wip, cost in costs.items():
+                candidate_costs[wip] = cost
+            new_cost = candidate_costs.sum()
             
             if new_cost < current_best_cost:
                 current_best_cost = new_cost
                 
-                self.wip_cost_contributions = costs.copy()
+                if is_scored:
+                    self._accept_scored_move(machine, row, new_product, 
+                                             previous_product, prior_running, 
+                                             next_product, is_applied, 
+                                             batch_rows, edits,
+                                             batch_hourly[:, row - first_hour:])
+                if batch_size > 1 and costs:
+                    changed_machines.add(machine)
+                    changed_products.update((previous_product, new_product))
+                self._commit_costs(row)
+                cost_contributions[:] = candidate_costs
                 self.convergence.append([x, new_cost])
-                
-                for k, v in mod_prod.items():
-                    self.wip_production[k] = v.copy()
-                
-                for k, v in mod_soln.items():
-                    self.solution[k] = v.copy()
                     
                 if new_cost < best_ever_cost:
                     best_ever_cost = new_cost
-                    self.best_ever_production = deepcopy(self.wip_production)
-                    self.best_ever_solution = deepcopy(self.solution)
+                    np.copyto(self.best_ever_production, self.wip_production)
+                    np.copyto(self.best_ever_solution, solution)
             
             else:
                 acceptance = exp(
@@ -953,23 +1358,134 @@ class Solver:
                 if acceptance > self.acceptance_rolls[x]:
                     current_best_cost = new_cost
                     
-                    self.wip_cost_contributions = costs.copy()
+                    if is_scored:
+                        self._accept_scored_move(
+                                    machine, row, new_product, previous_product,
+                                    prior_running, next_product, is_applied, 
+                                    batch_rows, edits,
+                                    batch_hourly[:, row - first_hour:])
+                    if batch_size > 1 and costs:
+                        changed_machines.add(machine)
+                        changed_products.update((previous_product, 
+                                                 new_product))
+                    self._commit_costs(row)
+                    cost_contributions[:] = candidate_costs
                     self.convergence.append([x, new_cost])
-                    
-                    for k, v in mod_prod.items():
-                        self.wip_production[k] = v.copy()
-                    
-                    for k, v in mod_soln.items():
-                        self.solution[k] = v.copy()
+                elif is_applied:
+                    self._revert_production(machine, row)
                 
             self.temperature *= self.alpha
+        
+        self.best_ever_cost = best_ever_cost
+        self.iterations_run = iterations_run
+        self.accepted_moves = len(self.convergence)
+        self.scored_moves = scored_moves
+    
+    def _accept_scored_move(self, machine, row, new_wip, old_wip, prior_product,
+                            next_product, is_applied, batch_rows, edits, 
+                            hourly_costs):
+        """ Make a move that was costed by _score_moves
+        
+        The hourly costs from `row` onwards for the batch are put where 
+        _commit_costs expects them so that the move doesn't have to be costed
+        again
+        """
+        
+        if not is_applied:
+            self._apply_move(machine, row, new_wip, old_wip, prior_product, 
+                             next_product)
+        
+        edit_rows = {batch_rows[i]: i for i in edits}
+        for slot, wip in enumerate(self._touched):
+            self._cost_tails[slot, row:] = hourly_costs[edit_rows[wip]]
     
     def run_solver(self):
-        self._get_swap_indices()
-        self._build_initial_solution()
-        self._get_initial_productivity()
-        self._generate_profiles()
-        self._run_solution_loop()   
+        self._run_phase(self._get_swap_indices)
+        self._run_phase(self._build_initial_solution)
+        self._run_phase(self._get_initial_productivity)
+        self._run_phase(self._generate_profiles)
+        self._run_phase(self._run_solution_loop)
+    
+    def _run_phase(self, phase):
+        """ Run one phase of the solver, recording its wall and CPU time """
+        
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        phase()
+        self.phase_times[phase.__name__] = (time.perf_counter() - wall,
+                                            time.thread_time() - cpu)
+    
+    def run_parallel_solver(self, workers, chains=None):
+        """ Run independent annealing chains across a pool of processes
+        
+        Each chain gets its own random seed and starting temperature, spread 
+        around the configured temperature. The solver takes on the state of 
+        whichever chain found the cheapest solution.
+        
+        :param workers: Number of worker processes
+        :param chains:  Number of chains to run, defaults to one per worker
+        """
+        
+        chains = chains or workers
+        seeds = np.random.randint(0, 2**31 - 1, chains).tolist()
+        if chains > 1:
+            temperatures = (self.temperature 
+                            * np.geomspace(0.5, 2, chains)).tolist()
+        else:
+            temperatures = [self.temperature]
+        
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_run_chain, 
+                                        [self] * chains, 
+                                        seeds, 
+                                        temperatures))
+            
+        best = min(results, key=lambda x: x.best_ever_cost)
+        self.__dict__.update(best.__dict__)
+        
+        self.chain_convergence = [result.convergence for result in results]
+        self.convergence = self._merge_convergence(self.chain_convergence)
+    
+    @staticmethod
+    def _merge_convergence(traces):
+        """ Combine the convergence of several chains into a single trace
+        
+        At each iteration where any chain accepted a move, the merged trace 
+        holds the lowest current cost across all of the chains
+        """
+        
+        current_costs = [np.inf for trace in traces]
+        steps = sorted((x, i, cost) for i, trace in enumerate(traces)
+                       for x, cost in trace)
+        
+        merged = []
+        for x, i, cost in steps:
+            current_costs[i] = cost
+            best_cost = min(current_costs)
+            if merged and merged[-1][0] == x:
+                merged[-1][1] = best_cost
+            else:
+                merged.append([x, best_cost])
+        
+        return merged
+    
+    def __getstate__(self):
+        # The problem holds ORM objects that can't be sent to worker processes. 
+        # Everything the chains need is copied onto the solver in __init__
+        state = self.__dict__.copy()
+        state.pop('problem', None)
+        state['callback'] = None
+        return state
+
+
+def _run_chain(solver, seed, temperature):
+    """ Run a single annealing chain in a worker process """
+    
+    random.seed(seed)
+    np.random.seed(seed)
+    solver.temperature = temperature
+    solver.run_solver()
+    return solver
     
     
 class Results:
@@ -985,6 +1501,8 @@ class Results:
         self.best_ever_production = self.solver.best_ever_production
         self.best_ever_solution = self.solver.best_ever_solution
         self.productivity_map = self.solver.productivity_map
+        self.machine_ids = self.solver.machine_ids
+        self.product_ids = self.solver.product_ids
         
         self.machine_name_map = dict(zip(self.solver.machine_ids,
                                      current_app.config['MACHINE_NAMES'])
@@ -992,7 +1510,8 @@ class Results:
        
     def _get_shift_rotation(self):
         
-        soln_df = pd.DataFrame(self.best_ever_solution)
+        soln_df = pd.DataFrame(self.best_ever_solution.T, 
+                               columns=self.machine_ids)
         soln_df = soln_df.rename(columns=self.machine_name_map)
         soln_df = soln_df.applymap(self.product_name_map.get)
         soln_df.insert(0, 'Shift Start', self.daterange)
@@ -1009,27 +1528,29 @@ class Results:
                                             .ravel()
                                             .tolist())
         
-        utilisation = []
+        # Work on the whole (machines x hours) matrices at once, rolled up
+        # into (machines x weeks)
+        num_machines = len(self.machine_ids)
+        can_produce = ((self.productivity_map > 0)
+                         .reshape((num_machines, -1, 168))
+                         .sum(axis=2)
+                         .astype(float))
+        did_produce = ((self.best_ever_solution > 0)
+                         .reshape((num_machines, -1, 168))
+                         .sum(axis=2)
+                         .astype(float))
+        
+        weekly_utilisation = np.divide(did_produce, 
+                                       can_produce, 
+                                       out=np.zeros_like(can_produce), 
+                                       where=can_produce!=0)
+        weekly_utilisation = (weekly_utilisation * 100).tolist()
         
-        for machine_id, possible_production in self.productivity_map.items():
-            actual_production = self.best_ever_solution[machine_id]
-            can_produce = (np.where(possible_production > 0, 1, 0)
-                             .reshape((-1, 168))
-                             .sum(axis=1)
-                             .astype(float))
-            did_produce = (np.where(actual_production > 0, 1, 0)
-                             .reshape((-1, 168))
-                             .sum(axis=1)
-                             .astype(float))
-            
-            weekly_utilisation = np.divide(did_produce, 
-                                           can_produce, 
-                                           out=np.zeros_like(can_produce), 
-                                           where=can_produce!=0)
-            weekly_utilisation = (weekly_utilisation * 100).tolist()
-            
+        utilisation = []
+        for machine_id, machine_utilisation in zip(self.machine_ids,
+                                                   weekly_utilisation):
             utilisation.append({'machine_name': self.machine_name_map[machine_id],
-                                'utilisation': weekly_utilisation})
+                                'utilisation': machine_utilisation})
             
         return utilisation, wc_dates
      
@@ -1041,22 +1562,22 @@ class Results:
         shift_table, table_headers = self._get_shift_rotation()
         utilisation, wc_dates = self._get_machine_utilisation()
         
-        for product_id, production in self.best_ever_production.items():
+        demands = self.wip_demands.astype(int).tolist()
+        productions = self.best_ever_production.astype(int).tolist()
+        for i, product_id in enumerate(self.product_ids):
             results.append({
                     'product_name': self.product_name_map[product_id],
-                    'demand': self.wip_demands[product_id].astype(int).tolist(),
-                    'production': production.astype(int).tolist()
+                    'demand': demands[i],
+                    'production': productions[i]
                     })
         rtn['productivity_graphs'] = results
         rtn['datetimes'] = self.daterange
         rtn['convergence'] = {'x': [item[0] for item in self.convergence][::20],
                               'cost': [int(item[1]) for item in self.convergence][::20]
                               }
-        print("x", len(rtn['convergence']['x']))
-        print("cost", len(rtn['convergence']['cost']))
         rtn['shift_table'] = shift_table
         rtn['shift_table_headers'] = table_headers
         rtn['utilisation'] = utilisation
         rtn['wc_dates'] = wc_dates
         
-        return rtn
\ No newline at end of file
+        return rtn
@@ -1,7 +1,12 @@
-from flask import request, render_template, current_app, jsonify
+from flask import (abort, request, render_template, current_app, jsonify, 
+                   make_response, Response, stream_with_context)
 
 from app import scheduler
+from app.metrics import metrics
 from app.manufacturing import bp
+from app.manufacturing.fleet import fleet
+from app.manufacturing.live import StreamsFull, live_status
+from app.manufacturing.jobs import QueueFull, solve_jobs
 from app.manufacturing.models import (Machines, 
                                       MachineHistory, 
                                       Problem, 
@@ -12,27 +17,31 @@ from app.manufacturing.models import (Machines,
 @scheduler.task('interval', id='update_machine_status', seconds=3)
 def update_machine_status():
     with scheduler.app.app_context():
-        machines = Machines.query.all()
-        for machine in machines:
-            machine.update_status()
+        with metrics.timer('machine_tick'):
+            fleet.tick()
             
 
 @scheduler.task('cron', id='reset_machine_status', hour='*')
 def reset_status():
     with scheduler.app.app_context():
-        machines = Machines.query.all()
-        for machine in machines:
-            machine.reset_status()
+        # Hold off ticks until the fleet has the reset statuses
+        with fleet.lock:
+            machines = Machines.query.all()
+            for machine in machines:
+                machine.reset_status()
+            fleet.clear()
 
 
 @bp.route('/homepage', methods=['GET'])
 def homepage():
-    ptv_status = Machines.get_current_status()
+    ptv_status = live_status.get().statuses
     plot = MachineHistory.get_plots('product_count')
     shifts = [item for item in current_app.config['SHIFT_HOURS']
               if item != 'null']
     machines = current_app.config['MACHINE_NAMES']
     products = current_app.config['PRODUCT_NAMES']
+    plot_ranges = current_app.config['PLOT_RANGES']
+    plot_days = current_app.config['PLOT_DEFAULT_DAYS']
     forecast = Problem.create_forecast()
     return render_template('manufacturing/homepage.html',
                            ptv_status=ptv_status,
@@ -40,46 +49,156 @@ def homepage():
                            shifts=shifts,
                            products=products,
                            machines=machines,
-                           forecast=forecast)
+                           forecast=forecast,
+                           plot_ranges=plot_ranges,
+                           plot_days=plot_days)
     
 
-@bp.route('/get_ptv_update', methods=['POST'])
+@bp.route('/get_ptv_update', methods=['GET', 'POST'])
 def get_ptv_update():
-    """ Called from the front-end at 3 sec intervals to get current status"""
+    """ Called from the front-end at 3 sec intervals to get current status. 
     
-    ptv_status = Machines.get_current_status()
-    return render_template('manufacturing/ptv_screen.html',
-                           ptv_status=ptv_status)
+    Served from the latest live status snapshot, which is rendered once. GETs 
+    with the snapshot's ETag in If-None-Match get a 304 back
+    """
+    
+    snapshot = live_status.get()
+    if snapshot.html is None:
+        snapshot.html = render_template('manufacturing/ptv_screen.html',
+                                        ptv_status=snapshot.statuses)
+    
+    response = make_response(snapshot.html)
+    response.set_etag(snapshot.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+@bp.route('/ptv_stream', methods=['GET'])
+def ptv_stream():
+    """ Server-sent events with machine statuses, pushed after each tick. 
+    
+    The first event is a `snapshot` of every machine, then each `delta` has 
+    just the machines that changed. Both have rows of the `fields` given in 
+    the snapshot
+    """
+    
+    try:
+        stream = live_status.subscribe()
+    except StreamsFull:
+        abort(503)
+    heartbeat = current_app.config['LIVE_STATUS_HEARTBEAT_SECS']
+    
+    def generate():
+        try:
+            yield f'retry: {current_app.config["UPDATE_CYCLE_SECS"] * 1000}\n\n'
+            while True:
+                event = stream.get(live_status.get, heartbeat)
+                yield event if event is not None else ': keep-alive\n\n'
+        finally:
+            live_status.unsubscribe(stream)
+    
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
     
     
 @bp.route('/plot_historical_data', methods=['POST'])
 def plot_historical_data():
     req = request.json
     stat = req.get('stat')
-    plot = MachineHistory.get_plots(stat)
-    return render_template('manufacturing/machine_history_graphs.html',
-                           plot=plot)
+    days = req.get('days', current_app.config['PLOT_DEFAULT_DAYS'])
+    if days not in current_app.config['PLOT_RANGES']:
+        abort(400)
+    plot = MachineHistory.get_plots(stat, days)
+    if not plot:
+        abort(400)
+    return jsonify(plot)
+    
+    
+def render_solution(solver):
+    with metrics.timer('get_solution'):
+        results = Results(solver)
+        solution = results.get_solution()
+    with metrics.timer('render'):
+        response = render_template(
+                'manufacturing/results_parent.html',
+                num_panels=int(len(solution['productivity_graphs']) / 2),
+                solution=solution)
+    return jsonify({
+        'success': True,
+        'response': response
+        })
+    
+    
+def render_error(message):
+    return jsonify({
+        'success': False,
+        'response': f'<center><font color="red">{ message }</font></center><br>'
+        })
     
     
 @bp.route('/create_problem', methods=['POST'])
 def create_problem():
     problem = Problem(request.form)
-    is_valid, message = problem.parse_request()
+    with metrics.timer('parse_request'):
+        is_valid, message = problem.parse_request()
     if is_valid:
         # In the process of validating the req, we set half the params anyway
-        problem.finalise_build()
+        with metrics.timer('finalise_build'):
+            problem.finalise_build()
         solver = Solver(problem)
-        solver.run_solver()
-        results = Results(solver)
-        solution = results.get_solution()
-        return jsonify({
-            'success': True,
-            'response': render_template(
-                    'manufacturing/results_parent.html',
-                    num_panels=int(len(solution['productivity_graphs']) / 2),
-                    solution=solution)
-            })
-    return jsonify({
-        'success': False,
-        'response': f'<center><font color="red">{ message }</font></center><br>'
-        })
\ No newline at end of file
+        workers = current_app.config['SOLVER_WORKERS']
+        with metrics.timer('run_solver', workers=workers):
+            if workers > 1:
+                solver.run_parallel_solver(workers)
+            else:
+                solver.run_solver()
+        metrics.record_solver(solver)
+        return render_solution(solver)
+    return render_error(message)
+
+
+@bp.route('/submit_problem', methods=['POST'])
+def submit_problem():
+    """ Queue the solve in the background and return a job id to poll """
+    
+    problem = Problem(request.form)
+    with metrics.timer('parse_request'):
+        is_valid, message = problem.parse_request()
+    if is_valid:
+        with metrics.timer('finalise_build'):
+            problem.finalise_build()
+        try:
+            job_id = solve_jobs.submit(problem, Solver(problem))
+        except QueueFull as e:
+            return render_error(str(e))
+        return jsonify({'success': True,
+                        'job_id': job_id})
+    return render_error(message)
+
+
+@bp.route('/solve_status/<job_id>', methods=['GET'])
+def solve_status(job_id):
+    status = solve_jobs.status(job_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
+@bp.route('/solve_result/<job_id>', methods=['GET'])
+def solve_result(job_id):
+    solver = solve_jobs.result(job_id)
+    if solver is None:
+        return render_error('The solution is not available')
+    return render_solution(solver)
+
+
+@bp.route('/cancel_solve/<job_id>', methods=['POST'])
+def cancel_solve(job_id):
+    if solve_jobs.status(job_id) is None:
+        abort(404)
+    
+    # A job that has already finished is left as it is
+    solve_jobs.cancel(job_id)
+    return jsonify(solve_jobs.status(job_id))
\ No newline at end of file
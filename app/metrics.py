@@ -0,0 +1,150 @@
+import bisect
+import json
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, roughly doubling from 1ms to 2 minutes
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                   2.5, 5, 10, 30, 60, 120)
+
+
+class Histogram:
+    """ Cumulative counts of observations under each bucket bound """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0 for x in range(len(self.buckets) + 1)]
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    """ Records wall and CPU time for each stage of a pipeline
+
+    Every record is kept in a histogram per stage, for the /metrics endpoint,
+    and passed to each sink. Sinks are callables taking a dict of the stage,
+    its timings and any extra fields, so that records can be shipped
+    elsewhere. The log sink is added by default.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.sinks = []
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """ Log the log sink's records to stderr as JSON lines, at
+        METRICS_LOG_LEVEL. Nothing else configures logging, so without a
+        handler and level here they'd be dropped at the default WARNING
+        """
+
+        if not logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+            logger.propagate = False
+        logger.setLevel(app.config['METRICS_LOG_LEVEL'])
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def observe(self, name, stage, value, buckets=None):
+        with self.lock:
+            key = (name, stage)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets or self.buckets)
+            self.histograms[key].observe(value)
+
+    def record(self, stage, wall, cpu, **fields):
+        """ Record the timings of a stage that has already been measured """
+
+        self.observe('stage_wall_seconds', stage, wall)
+        self.observe('stage_cpu_seconds', stage, cpu)
+
+        event = {'stage': stage, 'wall_secs': wall, 'cpu_secs': cpu}
+        event.update(fields)
+        for sink in self.sinks:
+            sink(event)
+
+    @contextmanager
+    def timer(self, stage, **fields):
+        """ Time the wrapped block as `stage`. CPU time is for this thread """
+
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.record(stage,
+                        time.perf_counter() - wall,
+                        time.thread_time() - cpu,
+                        **fields)
+
+    def record_solver(self, solver):
+        """ Record the phase timings and move counts from a finished Solver """
+
+        for phase, (wall, cpu) in solver.phase_times.items():
+            self.record(f'solver.{phase.lstrip("_")}', wall, cpu)
+
+        iterations = solver.iterations_run
+        accepted = solver.accepted_moves
+        acceptance_rate = accepted / iterations if iterations else 0
+        self.observe('solver_iterations', 'run_solution_loop', iterations,
+                     buckets=(100, 1000, 5000, 10000, 50000, 100000))
+        self.observe('solver_acceptance_rate', 'run_solution_loop',
+                     acceptance_rate,
+                     buckets=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.75, 1))
+
+        event = {'stage': 'solver.summary',
+                 'iterations': iterations,
+                 'accepted': accepted,
+                 'acceptance_rate': acceptance_rate,
+                 'batch_scored_moves': solver.scored_moves,
+                 'best_cost': float(solver.best_ever_cost)}
+        for sink in self.sinks:
+            sink(event)
+
+    def render(self):
+        """ Histograms in the Prometheus text exposition format """
+
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, stage in self.histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (_name, stage), histogram in sorted(self.histograms.items()):
+                    if _name != name:
+                        continue
+                    for bound, count in histogram.cumulative_counts():
+                        lines.append(f'{name}_bucket{{stage="{stage}",'
+                                     f'le="{bound}"}} {count}')
+                    lines.append(f'{name}_sum{{stage="{stage}"}} '
+                                 f'{histogram.sum}')
+                    lines.append(f'{name}_count{{stage="{stage}"}} '
+                                 f'{histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def log_sink(event):
+    logger.info(json.dumps(event))
+
+
+metrics = Metrics()
+metrics.add_sink(log_sink)
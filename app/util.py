@@ -1,13 +1,53 @@
+import numpy as np
+
+
+# "HH:MM" for every minute of the day
+CLOCK_TIMES = np.array([f'{minute // 60:02d}:{minute % 60:02d}'
+                        for minute in range(1440)])
+
+
 def jsprit_to_readable_time(num):
+    """ "HH:MM" for minutes past midnight. Takes a number, or an array of
+    them and gives back an array of strings
+    """
+
+    values = np.asarray(num, dtype=float)
+    minutes = np.floor(values).astype(int)
+    in_day = (minutes >= 0) & (minutes < 1440)
+    if in_day.all():
+        times = CLOCK_TIMES[minutes]
+    else:
+        # Past midnight the hours carry on counting up, i.e. 24:10
+        times = np.array([CLOCK_TIMES[minute] if is_in_day
+                          else _readable_time(value)
+                          for value, minute, is_in_day
+                          in zip(values.ravel().tolist(),
+                                 minutes.ravel().tolist(),
+                                 in_day.ravel().tolist())]).reshape(
+                                                                values.shape)
+
+    if times.ndim == 0:
+        return str(times)
+    return times
+
+
+def _readable_time(num):
     hours = str(int(float(num) / 60))
     mins = str(int(float(num) % 60))
     return str.zfill(hours, 2) + ':' + str.zfill(mins, 2)
 
 
 def readable_to_jsprit(string):
-    hours, mins = string.split(':')
-    num_time = int(hours) * 60 + int(mins)
-    return num_time
+    """ Minutes past midnight for "HH:MM". Takes a string, or an array of
+    them and gives back an array of ints
+    """
+
+    if isinstance(string, str):
+        hours, mins = string.split(':')
+        return int(hours) * 60 + int(mins)
+
+    parts = np.char.partition(np.asarray(string, dtype=str), ':')
+    return parts[..., 0].astype(int) * 60 + parts[..., 2].astype(int)
 
 
 def chunk(l, n):
@@ -0,0 +1,124 @@
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from flask import current_app
+
+from app.vehicle_routing.result_cache import route_cache
+
+
+def solve_batch(problems, matrix_workers=None, solve_workers=None):
+    """ Solve many RoutingProblems, yielding each result as it finishes
+
+    Matrices are built up to matrix_workers at a time, and problems with the
+    same locations share one matrix. Solves go to jsprit up to solve_workers
+    at a time, starting as soon as their matrix is ready. Problems big 
+    enough to be split up by ClusteredProblem are solved by solve_route 
+    instead, which builds a matrix per cluster. Problems that were solved 
+    before come straight from the route cache.
+
+    Yields one dict per problem with its `index` in `problems`, `success`,
+    `cached`, `secs`, and either `routes` and `stats` or an `error`. The
+    last dict yielded has just a `summary` of the whole batch.
+
+    :param problems:       List of RoutingProblems
+    :param matrix_workers: Matrices to build at once. Defaults to
+                           OSRM_CONCURRENCY
+    :param solve_workers:  Problems to have with jsprit at once. Defaults to
+                           JSPRIT_POOL_SIZE
+    """
+
+    app = current_app._get_current_object()
+    matrix_workers = matrix_workers or app.config['OSRM_CONCURRENCY']
+    solve_workers = solve_workers or app.config['JSPRIT_POOL_SIZE']
+
+    def build(problem):
+        with app.app_context():
+            return problem.build_matrix()
+
+    def solve(problem, cache_key, matrix_future):
+        with app.app_context():
+            matrix, location_dict = matrix_future.result()
+            routes, stats = problem.solve_with_matrix(matrix, location_dict)
+            if not matrix.is_fallback:
+                route_cache.set(cache_key, (routes, stats))
+            return routes, stats
+
+    def solve_clustered(problem):
+        with app.app_context():
+            return problem.solve_route()
+
+    start = time.perf_counter()
+    summary = {'problems': len(problems),
+               'solved': 0,
+               'cached': 0,
+               'failed': 0,
+               'stops': 0}
+
+    matrix_executor = ThreadPoolExecutor(max_workers=matrix_workers)
+    solve_executor = ThreadPoolExecutor(max_workers=solve_workers)
+    try:
+        matrices = {}
+        pending = {}
+        for i, problem in enumerate(problems):
+            problem_start = time.perf_counter()
+            cache_key = problem.cache_key()
+            cached = route_cache.get(cache_key)
+            if cached is not None:
+                summary['cached'] += 1
+                summary['stops'] += len(problem.locations)
+                yield _result(i, problem_start, *cached, is_cached=True)
+                continue
+
+            if problem.should_decompose():
+                future = solve_executor.submit(solve_clustered, problem)
+                pending[future] = (i, problem, problem_start)
+                continue
+
+            coords = (problem.get_matrix_source(),
+                      tuple((item['lat'], item['lon'])
+                            for item in problem.locations))
+            if coords not in matrices:
+                matrices[coords] = matrix_executor.submit(build, problem)
+
+            # Waits in the solve pool until its matrix is ready
+            future = solve_executor.submit(solve, problem, cache_key,
+                                           matrices[coords])
+            pending[future] = (i, problem, problem_start)
+
+        while pending:
+            done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, problem, problem_start = pending.pop(future)
+                try:
+                    routes, stats = future.result()
+                except Exception as e:
+                    summary['failed'] += 1
+                    yield {'index': i,
+                           'success': False,
+                           'error': str(e) or type(e).__name__,
+                           'secs': round(time.perf_counter() - problem_start,
+                                         3)}
+                    continue
+                summary['solved'] += 1
+                summary['stops'] += len(problem.locations)
+                yield _result(i, problem_start, routes, stats)
+    finally:
+        # Stop work on anything left if the caller gives up on the batch
+        matrix_executor.shutdown(wait=False, cancel_futures=True)
+        solve_executor.shutdown(wait=False, cancel_futures=True)
+
+    elapsed = time.perf_counter() - start
+    summary['unique_matrices'] = len(matrices)
+    summary['elapsed_secs'] = round(elapsed, 3)
+    summary['problems_per_sec'] = round(len(problems) / elapsed, 2)
+    summary['stops_per_sec'] = round(summary['stops'] / elapsed, 2)
+    yield {'summary': summary}
+
+
+def _result(index, start, routes, stats, is_cached=False):
+    return {'index': index,
+            'success': True,
+            'cached': is_cached,
+            'secs': round(time.perf_counter() - start, 3),
+            'routes': routes,
+            'stats': stats}
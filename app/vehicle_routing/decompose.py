@@ -0,0 +1,283 @@
+import math
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+import numpy as np
+
+
+class GridIndex:
+    """ Points bucketed into square cells, for nearest neighbour lookups
+
+    :param points:    (n, 2) array of x, y
+    :param cell_size: Width of each cell, in the units of the points
+    """
+
+    def __init__(self, points, cell_size):
+        self.points = np.asarray(points, dtype=np.float64)
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
+
+        cells = np.floor(self.points / cell_size).astype(int)
+        for i, (x, y) in enumerate(cells.tolist()):
+            self.cells[(x, y)].append(i)
+
+        self.min_cell = cells.min(axis=0)
+        self.max_cell = cells.max(axis=0)
+
+    def _ring(self, x, y, ring):
+        """ Points in the cells `ring` cells out from (x, y) """
+
+        if ring == 0:
+            return list(self.cells.get((x, y), []))
+
+        found = []
+        for dx in range(-ring, ring + 1):
+            for dy in (-ring, ring):
+                found += self.cells.get((x + dx, y + dy), [])
+        for dy in range(-ring + 1, ring):
+            for dx in (-ring, ring):
+                found += self.cells.get((x + dx, y + dy), [])
+        return found
+
+    def nearest(self, point, k):
+        """ Indices of the k points nearest to point, closest first """
+
+        point = np.asarray(point, dtype=np.float64)
+        x, y = np.floor(point / self.cell_size).astype(int).tolist()
+        k = min(k, len(self.points))
+        max_ring = int(max(np.abs(self.max_cell - [x, y]).max(),
+                           np.abs(self.min_cell - [x, y]).max()))
+
+        candidates = []
+        for ring in range(max_ring + 1):
+            candidates += self._ring(x, y, ring)
+            if len(candidates) < k:
+                continue
+
+            # Anything further out is at least `ring` cells away
+            distances = np.hypot(*(self.points[candidates] - point).T)
+            if np.partition(distances, k - 1)[k - 1] <= ring * self.cell_size:
+                break
+
+        distances = np.hypot(*(self.points[candidates] - point).T)
+        return [candidates[i] for i in np.argsort(distances)[:k]]
+
+
+class ClusteredProblem:
+    """ Solve a large RoutingProblem as clusters of nearby customers
+
+    Customers are clustered by k-means on where they are and when their time
+    window opens, with about ROUTING_CLUSTER_SIZE customers per cluster and
+    at most one cluster per driver. Drivers are shared out by cluster size,
+    and each cluster is solved as its own problem, ROUTING_CLUSTER_WORKERS
+    at a time. Matrices only cover each cluster, so they grow with the
+    cluster size rather than the whole problem.
+
+    A repair pass then offers the customers that a cluster couldn't fit to
+    the cluster of their nearest neighbours, found through a GridIndex. A
+    repaired cluster is only kept if it serves more customers than before.
+    Repairing isn't cheap: each cluster offered customers is solved again in
+    full with them added, so it is bounded by the ROUTING_CLUSTER_REPAIR_*
+    settings to about one more round of cluster solves.
+    """
+
+    def __init__(self, problem):
+        self.problem = problem
+        self.locations = problem.locations
+        self.cluster_size = current_app.config['ROUTING_CLUSTER_SIZE']
+        self.time_weight = current_app.config['ROUTING_CLUSTER_TIME_WEIGHT']
+        self.workers = current_app.config['ROUTING_CLUSTER_WORKERS']
+        self.repair_clusters = current_app.config[
+                                        'ROUTING_CLUSTER_REPAIR_CLUSTERS']
+        self.repair_moves = current_app.config['ROUTING_CLUSTER_REPAIR_MOVES']
+        self.unassigned = []
+        self.is_fallback = False
+
+    def _points(self):
+        """ Customer positions in km on a local flat projection """
+
+        lats = np.array([item['lat'] for item in self.locations], dtype=float)
+        lons = np.array([item['lon'] for item in self.locations], dtype=float)
+        lat_scale = 110.57
+        lon_scale = 111.32 * math.cos(math.radians(lats.mean()))
+        return np.column_stack([lons * lon_scale, lats * lat_scale])
+
+    @staticmethod
+    def _cluster(features, k, iterations=25):
+        """ Label each row of features with one of k clusters by k-means """
+
+        rng = np.random.default_rng(0)
+
+        # k-means++ seeding spreads the starting centres out
+        centres = [features[rng.integers(len(features))]]
+        for x in range(1, k):
+            distances = ((features[:, None, :] - np.array(centres)[None])
+                         ** 2).sum(axis=2).min(axis=1)
+            centres.append(features[rng.choice(len(features),
+                                               p=distances / distances.sum())])
+        centres = np.array(centres)
+
+        for x in range(iterations):
+            distances = ((features[:, None, :] - centres[None]) ** 2).sum(axis=2)
+            labels = distances.argmin(axis=1)
+            new_centres = np.array([features[labels == c].mean(axis=0)
+                                    if (labels == c).any() else centres[c]
+                                    for c in range(k)])
+            if np.allclose(new_centres, centres):
+                break
+            centres = new_centres
+
+        return labels
+
+    @staticmethod
+    def _allot_drivers(sizes, num_drivers):
+        """ Share the drivers out by cluster size, at least one each """
+
+        shares = np.asarray(sizes) / sum(sizes) * num_drivers
+        drivers = np.maximum(np.floor(shares).astype(int), 1)
+        while drivers.sum() < num_drivers:
+            drivers[np.argmax(shares - drivers)] += 1
+        while drivers.sum() > num_drivers:
+            drivers[np.argmax(np.where(drivers > 1, drivers - shares,
+                                       -np.inf))] -= 1
+        return drivers.tolist()
+
+    def _solve_cluster(self, members, num_drivers):
+        params = dict(self.problem.params,
+                      number_of_drivers=str(num_drivers),
+                      decompose='No')
+        problem = type(self.problem)([self.locations[i] for i in members],
+                                     params)
+        matrix, location_dict = problem.build_matrix()
+        result = problem.solve_raw(matrix)
+        return {'members': members,
+                'drivers': num_drivers,
+                'problem': problem,
+                'matrix': matrix,
+                'location_dict': location_dict,
+                'result': result}
+
+    @staticmethod
+    def _unassigned(cluster):
+        """ Indices into the full problem of customers left off every route """
+
+        served = {job['tracking'] for route in cluster['result']['routes'].values()
+                  for job in route}
+        return [member for i, member in enumerate(cluster['members'])
+                if str(i) not in served]
+
+    def _solve_all(self, executor, jobs):
+        app = current_app._get_current_object()
+
+        def solve(job):
+            with app.app_context():
+                return self._solve_cluster(*job)
+
+        return list(executor.map(solve, jobs))
+
+    def solve(self):
+        num_drivers = int(self.problem.params['number_of_drivers'])
+        points = self._points()
+        starts = np.array([item['jsprit_start'] for item in self.locations],
+                          dtype=float)
+        features = np.column_stack([points, starts * self.time_weight])
+
+        k = max(1, min(num_drivers,
+                       math.ceil(len(self.locations) / self.cluster_size)))
+        labels = self._cluster(features, k)
+        members = [np.flatnonzero(labels == c).tolist() for c in range(k)]
+        members = [item for item in members if item]
+        drivers = self._allot_drivers([len(item) for item in members],
+                                      num_drivers)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            clusters = self._solve_all(executor, list(zip(members, drivers)))
+            clusters = self._repair(executor, clusters, points)
+
+        # A customer repaired into another cluster is still unassigned in
+        # the cluster it came from
+        served = set()
+        for cluster in clusters:
+            served |= set(cluster['members']) - set(self._unassigned(cluster))
+        self.unassigned = sorted(set(range(len(self.locations))) - served)
+        self.is_fallback = any(cluster['matrix'].is_fallback
+                               for cluster in clusters)
+        return self._merge(clusters)
+
+    def _repair(self, executor, clusters, points):
+        """ Offer unassigned customers to the cluster of their neighbours
+
+        Each cluster offered customers is re-solved from scratch with them
+        added. Only the repair_clusters clusters offered the most are
+        repaired, with up to repair_moves customers each, so the pass costs
+        at most repair_clusters more cluster solves
+        """
+
+        cluster_of = {}
+        for c, cluster in enumerate(clusters):
+            for member in cluster['members']:
+                cluster_of[member] = c
+
+        index = GridIndex(points, cell_size=2)
+        moves = defaultdict(list)
+        for c, cluster in enumerate(clusters):
+            for customer in self._unassigned(cluster):
+                for neighbour in index.nearest(points[customer], 10)[1:]:
+                    if cluster_of[neighbour] != c:
+                        moves[cluster_of[neighbour]].append(customer)
+                        break
+
+        if not moves or not self.repair_clusters:
+            return clusters
+
+        targets = sorted(moves, key=lambda c: len(moves[c]),
+                         reverse=True)[:self.repair_clusters]
+        offered = {c: moves[c][:self.repair_moves] for c in targets}
+
+        # A customer offered to another cluster leaves its own, so that a
+        # source cluster that is also re-solved can't serve it as well
+        moved = {customer for customers in offered.values()
+                 for customer in customers}
+        jobs = [([member for member in clusters[c]['members']
+                  if member not in moved] + offered[c],
+                 clusters[c]['drivers'])
+                for c in targets]
+        repaired = self._solve_all(executor, jobs)
+
+        for c, cluster in zip(targets, repaired):
+            served = (len(cluster['members'])
+                      - len(self._unassigned(cluster)))
+            served_before = (len(clusters[c]['members'])
+                             - len(self._unassigned(clusters[c])))
+            if served <= served_before:
+                continue
+            clusters[c] = cluster
+        return clusters
+
+    def _merge(self, clusters):
+        """ Processed routes and stats, with drivers numbered across all of
+        the clusters
+        """
+
+        routes = {}
+        stats = defaultdict(dict)
+        offset = 0
+        for cluster in clusters:
+            cluster_routes, cluster_stats = cluster['problem'].process_results(
+                                                    cluster['result'],
+                                                    cluster['matrix'],
+                                                    cluster['location_dict'])
+            for driver_number, route in cluster_routes.items():
+                if route:
+                    routes[offset + driver_number] = route
+                    stats[offset + driver_number] = cluster_stats[driver_number]
+            offset += cluster['drivers']
+
+        num_drivers = int(self.problem.params['number_of_drivers'])
+        for driver_number in (list(range(1, num_drivers + 1))
+                              + list(current_app.config['NUM_DRIVERS'])):
+            routes.setdefault(driver_number, [])
+
+        return routes, stats
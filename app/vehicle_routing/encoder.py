@@ -0,0 +1,90 @@
+import base64
+import json
+
+
+MATRIX_FORMATS = ('entries', 'dense')
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+def iter_request(matrix, orders, driver_config, algo_config,
+                 matrix_format='entries'):
+    """ Yield the JSON for a jsprit request a piece at a time
+
+    The output has no whitespace between tokens. String values are escaped
+    as normal JSON rather than stripped, so names with spaces survive.
+
+    :param matrix:        DistanceMatrix for the problem
+    :param orders:        The rest of ordersToSolve (pickups, deliveries, ...)
+    :param driver_config: Drivers and vehicle types from build_drivers
+    :param algo_config:   jsprit algorithm parameters
+    :param matrix_format: 'entries' for the list of {loc_from, loc_to,
+                          distance, time} objects that the jsprit server has
+                          always read, written out a row at a time. 'dense'
+                          for {locations, encoding, distances, times}, with
+                          the row-major float32 arrays base64 encoded, which
+                          is far smaller and quicker to build for large
+                          problems but needs a server that reads it
+    """
+
+    if matrix_format not in MATRIX_FORMATS:
+        raise ValueError(f'Unknown jsprit matrix format: {matrix_format}')
+
+    yield '{"ordersToSolve":{"matrix":'
+    if matrix_format == 'dense':
+        yield _dense_matrix(matrix)
+    else:
+        yield from _iter_matrix_entries(matrix)
+    for key, value in orders.items():
+        yield f',{_dumps(key)}:{_dumps(value)}'
+    yield '},"driverConfig":' + _dumps(driver_config)
+    yield ',"algoParams":' + _dumps(algo_config) + '}'
+
+
+def encode_request(matrix, orders, driver_config, algo_config,
+                   matrix_format='entries'):
+    """ The jsprit request as chunks of UTF-8 bytes, to be streamed to the
+    file or socket rather than held whole. See iter_request
+    """
+
+    for chunk in iter_request(matrix, orders, driver_config, algo_config,
+                              matrix_format):
+        yield chunk.encode()
+
+
+def _iter_matrix_entries(matrix):
+    """ The matrix as a list of entries, one row of the matrix per chunk
+
+    Everything that doesn't depend on the row is formatted once up front, and
+    each row's floats are formatted together by NumPy. float32 to str gives
+    the shortest string that round-trips.
+    """
+
+    location_ids = [_dumps(location_id) for location_id in matrix.location_ids]
+    columns = [f',"loc_to":{location_id},"distance":"'
+               for location_id in location_ids]
+
+    yield '['
+    for i, location_id in enumerate(location_ids):
+        head = '{"loc_from":' + location_id
+        distances = matrix.distances[i].astype(str).tolist()
+        durations = matrix.durations[i].astype(str).tolist()
+        row = ','.join([head + column + distance + '","time":"'
+                        + duration + '"}'
+                        for column, distance, duration
+                        in zip(columns, distances, durations)])
+        yield row if i == 0 else ',' + row
+    yield ']'
+
+
+def _dense_matrix(matrix):
+    def encode(values):
+        return base64.b64encode(
+                    values.astype('<f4', copy=False).tobytes()).decode()
+
+    return ('{"locations":' + _dumps(matrix.location_ids)
+            + ',"encoding":"float32-le-base64"'
+            + ',"distances":"' + encode(matrix.distances)
+            + '","times":"' + encode(matrix.durations) + '"}')
@@ -0,0 +1,334 @@
+import numpy as np
+
+
+class NativeSolver:
+    """ Vehicle routing with time windows, solved in-process
+
+    Takes the same inputs that are sent to jsprit and returns a response in
+    the same shape, so it can stand in for the jsprit server. Customers are
+    put into routes by cheapest feasible insertion, in order of their time
+    windows, and the routes are then improved by 2-opt within each route and
+    by relocating customers within or between routes. Costs per km, per
+    minute and per vehicle used come from the vehicle types, as they do for
+    jsprit.
+
+    Every move is checked against the delivery time windows, each driver's
+    shift, their lunch break and the vehicle capacity. Each delivery takes
+    one unit of capacity dimension 0. The lunch break is taken as soon as
+    the next delivery would start after the break window opens, and must
+    start before the window closes. Customers that can't be fitted in are
+    left unassigned, as jsprit does.
+
+    :param matrix:         DistanceMatrix for the problem
+    :param orders:         The orders sent to jsprit, of which only the
+                           deliveries are used
+    :param driver_config:  Drivers and vehicle types from build_drivers
+    :param max_moves:      Most local search moves to make
+    """
+
+    def __init__(self, matrix, orders, driver_config, max_moves=2000):
+        self.matrix = matrix
+        self.max_moves = max_moves
+        self.times = matrix.durations.astype(np.float64)
+        num_nodes = len(matrix.location_ids)
+
+        # Time windows and service times by matrix row
+        self.tw_from = np.zeros(num_nodes)
+        self.tw_to = np.full(num_nodes, np.inf)
+        self.service = np.zeros(num_nodes)
+        self.customers = []
+        for delivery in orders['deliveries'].values():
+            node = matrix.index[delivery['r_id']]
+            self.tw_from[node] = float(delivery['r_tw_from'])
+            self.tw_to[node] = float(delivery['r_tw_to'])
+            self.service[node] = float(delivery.get('service_time') or 0)
+            self.customers.append(node)
+
+        # Each vehicle type gets its own cost matrix
+        costs = {}
+        for vtype in driver_config['vtypes']:
+            costs[vtype['type_id']] = (
+                    float(vtype['cost_per_km']) * matrix.distances
+                    + float(vtype['cost_per_min']) * matrix.durations
+                    ).astype(np.float64)
+
+        vtypes = {vtype['type_id']: vtype for vtype in driver_config['vtypes']}
+        self.vehicles = []
+        for driver in driver_config['drivers']:
+            vtype = vtypes[driver['vehicle_type']]
+            capacities = dict(vtype['capacities'])
+            self.vehicles.append({
+                'name': driver['driver_name'],
+                'depot': matrix.index[driver['departure_loc']],
+                'start': float(driver['start_time']),
+                'end': float(driver['end_time']),
+                'lunch_start': (float(driver['lunch_start'])
+                                if driver['lunch_start'] else None),
+                'lunch_end': (float(driver['lunch_end'])
+                              if driver['lunch_end'] else None),
+                'lunch_duration': float(driver['lunch_duration'] or 0),
+                'capacity': capacities.get(0, np.inf),
+                'fixed_cost': float(vtype['fixed_cost']),
+                'costs': costs[vtype['type_id']]
+                })
+
+    def solve(self):
+        routes = [[] for vehicle in self.vehicles]
+        unassigned = []
+
+        for node in sorted(self.customers, key=lambda x: self.tw_from[x]):
+            if not self._insert(node, routes):
+                unassigned.append(node)
+
+        moves = 0
+        is_improved = True
+        while is_improved and moves < self.max_moves:
+            is_improved = (self._two_opt(routes) or self._relocate(routes))
+            if unassigned:
+                unassigned = [node for node in unassigned
+                              if not self._insert(node, routes)]
+            moves += 1
+
+        return self._to_response(routes, unassigned)
+
+    # ==========================================================================
+    # Feasibility
+    # ==========================================================================
+
+    def _schedule(self, route, vehicle):
+        """ Times for a vehicle to serve the route in order, or None if it
+        breaks a time window, the shift or the lunch window
+
+        Returns (departure, [(node, arrival, departure)], lunch, return time)
+        with lunch as (start, number of stops before it) or None.
+        """
+
+        times = self.times
+        depot = vehicle['depot']
+        lunch_start = vehicle['lunch_start']
+        has_lunch = lunch_start is None
+        lunch = None
+
+        # Leave the depot late enough that there's no wait at the first stop
+        t = vehicle['start']
+        if route:
+            t = max(t, self.tw_from[route[0]] - times[depot, route[0]])
+        departure = t
+
+        here = depot
+        stops = []
+        for node in route:
+            travel = times[here, node]
+            if not has_lunch and max(t + travel,
+                                     self.tw_from[node]) > lunch_start:
+                lunch_time = max(t, lunch_start)
+                if lunch_time > vehicle['lunch_end']:
+                    return None
+                lunch = (lunch_time, len(stops))
+                t = lunch_time + vehicle['lunch_duration']
+                has_lunch = True
+
+            arrival = t + travel
+            begin = max(arrival, self.tw_from[node])
+            if begin > self.tw_to[node]:
+                return None
+            t = begin + self.service[node]
+            stops.append((node, arrival, t))
+            here = node
+
+        if not has_lunch and t + times[here, depot] > lunch_start:
+            lunch_time = max(t, lunch_start)
+            if lunch_time > vehicle['lunch_end']:
+                return None
+            lunch = (lunch_time, len(stops))
+            t = lunch_time + vehicle['lunch_duration']
+
+        returned = t + times[here, depot]
+        if returned > vehicle['end']:
+            return None
+        return departure, stops, lunch, returned
+
+    def _is_feasible(self, route, vehicle):
+        return (len(route) <= vehicle['capacity']
+                and self._schedule(route, vehicle) is not None)
+
+    def _edges(self, route, vehicle):
+        """ The (from, to) nodes of each leg of the route, depot to depot """
+
+        nodes = np.array([vehicle['depot']] + route + [vehicle['depot']])
+        return nodes[:-1], nodes[1:]
+
+    # ==========================================================================
+    # Construction and local search
+    # ==========================================================================
+
+    def _insert(self, node, routes):
+        """ Put the node where it adds least cost, if it fits anywhere """
+
+        deltas = []
+        candidates = []
+        for k, (route, vehicle) in enumerate(zip(routes, self.vehicles)):
+            costs = vehicle['costs']
+            prev, nxt = self._edges(route, vehicle)
+            delta = costs[prev, node] + costs[node, nxt] - costs[prev, nxt]
+            if not route:
+                delta = delta + vehicle['fixed_cost']
+            deltas.append(delta)
+            candidates += [(k, position) for position in range(len(delta))]
+
+        for i in np.argsort(np.concatenate(deltas), kind='stable'):
+            k, position = candidates[i]
+            route = routes[k][:position] + [node] + routes[k][position:]
+            if self._is_feasible(route, self.vehicles[k]):
+                routes[k] = route
+                return True
+        return False
+
+    def _two_opt(self, routes):
+        """ Make the first feasible improving reversal of a segment of a
+        route. Costs can be asymmetric, so a reversed segment is costed
+        with its legs the other way round
+        """
+
+        for k, (route, vehicle) in enumerate(zip(routes, self.vehicles)):
+            if len(route) < 3:
+                continue
+            costs = vehicle['costs']
+            nodes = np.array([vehicle['depot']] + route + [vehicle['depot']])
+            forward = np.concatenate(
+                                [[0], np.cumsum(costs[nodes[:-1], nodes[1:]])])
+            backward = np.concatenate(
+                                [[0], np.cumsum(costs[nodes[1:], nodes[:-1]])])
+
+            # Reverse nodes[i + 1:j + 1] for every i < j
+            i, j = np.triu_indices(len(nodes) - 1, k=1)
+            delta = (costs[nodes[i], nodes[j]]
+                     + costs[nodes[i + 1], nodes[j + 1]]
+                     + backward[j] - backward[i + 1]
+                     - costs[nodes[i], nodes[i + 1]]
+                     - costs[nodes[j], nodes[j + 1]]
+                     - forward[j] + forward[i + 1])
+
+            for move in np.argsort(delta):
+                if delta[move] > -1e-9:
+                    break
+                start, stop = i[move], j[move]
+                new_route = (route[:start] + route[start:stop][::-1]
+                             + route[stop:])
+                if self._is_feasible(new_route, vehicle):
+                    routes[k] = new_route
+                    return True
+        return False
+
+    def _relocate(self, routes):
+        """ Make the first feasible improving move of a customer to another
+        place in its own route or another route
+        """
+
+        # Cost saved by taking each customer out of its route
+        nodes, from_route, from_position, savings = [], [], [], []
+        for k, (route, vehicle) in enumerate(zip(routes, self.vehicles)):
+            if not route:
+                continue
+            costs = vehicle['costs']
+            prev, nxt = self._edges(route, vehicle)
+            members = np.array(route)
+            saving = (costs[prev[:-1], members] + costs[members, nxt[1:]]
+                      - costs[prev[:-1], nxt[1:]])
+            if len(route) == 1:
+                saving = saving + vehicle['fixed_cost']
+            nodes.append(members)
+            from_route += [k] * len(route)
+            from_position += list(range(len(route)))
+            savings.append(saving)
+        if not nodes:
+            return False
+        nodes = np.concatenate(nodes)
+        savings = np.concatenate(savings)
+        from_route = np.array(from_route)
+        from_position = np.array(from_position)
+
+        # Cost added by putting each customer into each leg of each route
+        for k, (route, vehicle) in enumerate(zip(routes, self.vehicles)):
+            costs = vehicle['costs']
+            prev, nxt = self._edges(route, vehicle)
+            added = (costs[prev][:, nodes] + costs[:, nxt][nodes].T
+                     - costs[prev, nxt][:, None])
+            if not route:
+                added = added + vehicle['fixed_cost']
+            delta = added - savings[None, :]
+
+            # A customer can't go back into either leg next to it
+            same = from_route == k
+            legs = np.arange(len(prev))[:, None]
+            delta[(legs == from_position[None, :]) & same[None, :]] = np.inf
+            delta[(legs == from_position[None, :] + 1) & same[None, :]] = np.inf
+
+            order = np.argsort(delta, axis=None)
+            for flat in order:
+                leg, customer = np.unravel_index(flat, delta.shape)
+                if delta[leg, customer] > -1e-9:
+                    break
+                if self._apply_relocate(routes, nodes[customer],
+                                        from_route[customer],
+                                        from_position[customer], k, leg):
+                    return True
+        return False
+
+    def _apply_relocate(self, routes, node, source, position, target, leg):
+        source_route = routes[source][:position] + routes[source][position + 1:]
+        if source == target:
+            # The legs were numbered before the customer was taken out
+            if leg > position:
+                leg -= 1
+            target_route = source_route[:leg] + [node] + source_route[leg:]
+            if self._is_feasible(target_route, self.vehicles[target]):
+                routes[target] = target_route
+                return True
+            return False
+
+        target_route = routes[target][:leg] + [node] + routes[target][leg:]
+        if (self._is_feasible(source_route, self.vehicles[source])
+                and self._is_feasible(target_route, self.vehicles[target])):
+            routes[source] = source_route
+            routes[target] = target_route
+            return True
+        return False
+
+    # ==========================================================================
+    # Output
+    # ==========================================================================
+
+    def _to_response(self, routes, unassigned):
+        """ The routes in the shape of a jsprit server response """
+
+        location_ids = self.matrix.location_ids
+        response = {'routes': {}, 'unassigned': [location_ids[node]
+                                                 for node in unassigned]}
+        for route, vehicle in zip(routes, self.vehicles):
+            if not route:
+                continue
+            departure, stops, lunch, returned = self._schedule(route, vehicle)
+
+            jobs = [{'tracking': 'start', 'num_departure': departure}]
+            for i, (node, arrival, leave) in enumerate(stops):
+                if lunch is not None and lunch[1] == i:
+                    jobs.append(self._lunch_job(lunch, vehicle))
+                jobs.append({'tracking': location_ids[node],
+                             'num_arrival': arrival,
+                             'num_departure': leave})
+            if lunch is not None and lunch[1] == len(stops):
+                jobs.append(self._lunch_job(lunch, vehicle))
+
+            # jsprit gives the arrival back at the depot in seconds
+            jobs.append({'tracking': 'end',
+                         'arrival': f'{returned * 60}:00'})
+            response['routes'][vehicle['name']] = jobs
+
+        return response
+
+    @staticmethod
+    def _lunch_job(lunch, vehicle):
+        return {'tracking': 'lunch',
+                'num_arrival': lunch[0],
+                'num_departure': lunch[0] + vehicle['lunch_duration']}
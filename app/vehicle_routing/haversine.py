@@ -0,0 +1,39 @@
+from flask import current_app
+
+import numpy as np
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_table(coords):
+    """ Estimated road distances (km) and durations (mins) between every pair
+    of coords, without OSRM
+
+    Distances are great-circle distances times HAVERSINE_CIRCUITY, for the
+    roads not going in a straight line. Durations come from the speed model
+    in HAVERSINE_SPEED_BANDS, which gives the average speed for journeys of
+    up to each distance, so short hops are slower than long ones.
+
+    :param coords: List of (lat, lon) tuples
+    """
+
+    coords = np.radians(np.asarray(coords, dtype=np.float64))
+    lats = coords[:, 0]
+    lons = coords[:, 1]
+
+    half_dlat = (lats[:, None] - lats[None, :]) / 2
+    half_dlon = (lons[:, None] - lons[None, :]) / 2
+    a = (np.sin(half_dlat) ** 2
+         + np.cos(lats)[:, None] * np.cos(lats)[None, :]
+         * np.sin(half_dlon) ** 2)
+    distances = (2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+                 * current_app.config['HAVERSINE_CIRCUITY'])
+
+    # The last band covers any distance
+    bands = current_app.config['HAVERSINE_SPEED_BANDS']
+    limits = np.array([limit for limit, speed in bands[:-1]])
+    speeds = np.array([speed for limit, speed in bands], dtype=np.float64)
+    durations = distances / speeds[np.searchsorted(limits, distances)] * 60
+
+    return distances, durations
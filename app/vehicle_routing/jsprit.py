@@ -0,0 +1,219 @@
+import asyncio
+import datetime as dt
+import json
+import math
+import os
+import queue
+import threading
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+import zmq
+
+
+class JspritError(Exception):
+    pass
+
+
+class JspritTimeout(JspritError):
+    pass
+
+
+class JspritClient:
+    """ Process-wide connection pool for the jsprit server
+
+    One ZMQ context is shared by a pool of up to JSPRIT_POOL_SIZE DEALER
+    sockets, so that as many solves can be in flight at once. A request that
+    gets no reply within JSPRIT_TIMEOUT_SECS raises JspritTimeout. Its
+    socket is thrown away, so a late reply can never be read as the answer
+    to the next request, and a new socket reconnects in its place.
+
+    ZMQ contexts don't survive a fork, so the pool is rebuilt if it's used
+    from a different process to the one that created it.
+
+    Requests are sent by solve() in one of two transports:
+
+    - 'path', the default: the payload is written under REQUEST_PATH and 
+      only the file path is sent, as the jsprit server expects today
+    - 'inline': a two-part message of a JSON header and the payload, zlib 
+      compressed if JSPRIT_COMPRESS is set. The header gives the problem_id 
+      and the payload's encoding, 'identity' or 'zlib'. Opt in once the 
+      server reads the inline message
+
+    With JSPRIT_AUDIT set, inline requests are also written to REQUEST_PATH. 
+    Written requests are pruned to the newest JSPRIT_AUDIT_MAX_FILES and 
+    those younger than JSPRIT_AUDIT_MAX_AGE_DAYS, at most once every 
+    JSPRIT_AUDIT_PRUNE_SECS.
+    """
+
+    def __init__(self):
+        self.context = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            config = current_app.config
+            self.address = config['JSPRIT_SOCKET']
+            self.timeout_ms = int(config['JSPRIT_TIMEOUT_SECS'] * 1000)
+            self.pool_size = config['JSPRIT_POOL_SIZE']
+            self.transport = config['JSPRIT_TRANSPORT']
+            self.compress = config['JSPRIT_COMPRESS']
+            self.audit = config['JSPRIT_AUDIT']
+            self.request_path = config['REQUEST_PATH']
+            self.audit_max_files = config['JSPRIT_AUDIT_MAX_FILES']
+            self.audit_max_age = config['JSPRIT_AUDIT_MAX_AGE_DAYS'] * 86400
+            self.prune_interval = config['JSPRIT_AUDIT_PRUNE_SECS']
+            self.last_pruned = None
+
+            self.context = zmq.Context()
+            self.idle = queue.LifoQueue()
+            self.slots = threading.BoundedSemaphore(self.pool_size)
+            self.executor = ThreadPoolExecutor(max_workers=self.pool_size)
+            self.pid = os.getpid()
+
+    def _connect(self):
+        socket = self.context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.RECONNECT_IVL, 100)
+        socket.setsockopt(zmq.RECONNECT_IVL_MAX, 5000)
+        socket.connect(self.address)
+        return socket
+
+    def request(self, *frames, timeout=None):
+        """ Send a request and wait for the reply
+
+        :param frames:  The message, as one or more bytes frames
+        :param timeout: Seconds to wait for the reply, including any wait for
+                        a free connection. Defaults to JSPRIT_TIMEOUT_SECS
+        :raises JspritTimeout: If there's no reply in time
+        """
+
+        self._start()
+        timeout_ms = (self.timeout_ms if timeout is None
+                      else int(timeout * 1000))
+        deadline = time.monotonic() + timeout_ms / 1000
+
+        if not self.slots.acquire(timeout=timeout_ms / 1000):
+            raise JspritTimeout('All jsprit connections are busy')
+        try:
+            try:
+                socket = self.idle.get_nowait()
+            except queue.Empty:
+                socket = self._connect()
+
+            # The empty frame stands in for the envelope a REQ socket would
+            # add, so the server can stay a plain REP socket
+            try:
+                socket.send_multipart([b''] + list(frames))
+                remaining_ms = max(0, math.ceil((deadline - time.monotonic())
+                                                * 1000))
+                is_ready = socket.poll(remaining_ms, zmq.POLLIN)
+                reply = socket.recv_multipart() if is_ready else None
+            except zmq.ZMQError as e:
+                socket.close()
+                raise JspritError(f'jsprit request failed: {e}') from e
+
+            if reply is None:
+                socket.close()
+                raise JspritTimeout(f'No reply from jsprit within '
+                                    f'{timeout_ms / 1000:g} seconds')
+            self.idle.put(socket)
+        finally:
+            self.slots.release()
+
+        return reply[-1]
+
+    def solve(self, chunks, problem_id, timeout=None):
+        """ Send an encoded request by the configured transport and return 
+        the decoded reply
+
+        :param chunks:     The JSON request as an iterable of bytes, which is
+                           streamed to the file or compressor as it comes
+        :param problem_id: Identifies the request to the server and in the 
+                           name of any file written for it
+        """
+
+        self._start()
+        if self.transport == 'path':
+            path = self._write_request(chunks, problem_id)
+            reply = self.request(path.encode(), timeout=timeout)
+        else:
+            if self.audit:
+                path = self._write_request(chunks, problem_id)
+                chunks = self._read_request(path)
+
+            header = {'problem_id': problem_id, 'encoding': 'identity'}
+            if self.compress:
+                compressor = zlib.compressobj(1)
+                chunks = ([compressor.compress(chunk) for chunk in chunks]
+                          + [compressor.flush()])
+                header['encoding'] = 'zlib'
+
+            # The payload goes in a single frame, so it's only put together 
+            # here, after any compression
+            reply = self.request(json.dumps(header).encode(), 
+                                 b''.join(chunks), timeout=timeout)
+
+        return json.loads(reply)
+
+    def _write_request(self, chunks, problem_id):
+        os.makedirs(self.request_path, exist_ok=True)
+        today = dt.datetime.now().strftime('%Y_%m_%d')
+        path = os.path.join(self.request_path, f'{today}_{problem_id}.txt')
+        with open(path, 'wb') as outfile:
+            for chunk in chunks:
+                outfile.write(chunk)
+
+        # Two threads may both prune at the turn of an interval, which is 
+        # harmless
+        now = time.monotonic()
+        if (self.last_pruned is None 
+                or now - self.last_pruned >= self.prune_interval):
+            self.last_pruned = now
+            self._prune_requests()
+        return path
+
+    @staticmethod
+    def _read_request(path, size=1 << 20):
+        """ A written request, read back a block at a time """
+
+        with open(path, 'rb') as infile:
+            yield from iter(lambda: infile.read(size), b'')
+
+    def _prune_requests(self):
+        """ Remove written requests past the age or count limits """
+
+        entries = []
+        for entry in os.scandir(self.request_path):
+            if entry.is_file() and entry.name.endswith('.txt'):
+                entries.append((entry.stat().st_mtime, entry.path))
+        entries.sort(reverse=True)
+
+        cutoff = time.time() - self.audit_max_age
+        for i, (modified, path) in enumerate(entries):
+            if i >= self.audit_max_files or modified < cutoff:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    # Another worker got there first
+                    pass
+
+    async def request_async(self, *frames, timeout=None):
+        """ request() for asyncio code. Waits in a worker thread so that the
+        event loop keeps running
+        """
+
+        self._start()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+                            self.executor,
+                            lambda: self.request(*frames, timeout=timeout))
+
+
+jsprit_client = JspritClient()
@@ -0,0 +1,398 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from flask import current_app
+
+import numpy as np
+
+
+class MatrixCache:
+    """ Road distances and durations between pairs of points
+
+    Entries are (km, minutes) keyed by the (from, to) coordinates, rounded to
+    OSRM_CACHE_PRECISION decimal places. The most recently used pairs are
+    held in memory and every pair is written through to a SQLite file, so
+    they survive restarts and are shared between worker processes. Both
+    stores drop their least recently used pairs once they hit their caps.
+
+    Because the cache holds pairs rather than whole matrices, a problem that
+    only adds a few new locations only has to ask OSRM for the rows and
+    columns of those locations.
+
+    Pairs cost Python work each, so matrices of more than
+    OSRM_CACHE_PAIR_MAX_STOPS points are cached whole instead, as arrays
+    keyed by all of their coordinates in order. They share the memory cap
+    with the pairs, and on disk are capped at OSRM_CACHE_DISK_MATRIX_PAIRS
+    entries between them.
+
+    Pairs served from memory have their time last used on disk brought up
+    to date at most every OSRM_CACHE_TOUCH_SECS, so the disk doesn't drop
+    them first just because they're always found in memory.
+
+    Pairs OSRM can't route come back as NaN. They are never cached, so are
+    asked for again next time, and are given the OSRM_UNROUTABLE_KM and
+    OSRM_UNROUTABLE_MINS penalties in the matrix returned.
+    """
+
+    def __init__(self):
+        self.pairs = OrderedDict()
+        self.matrices = OrderedDict()
+        self.memory_matrix_pairs = 0
+        self.path = None
+        self.max_memory_pairs = None
+        self.max_disk_pairs = None
+        self.max_disk_matrix_pairs = None
+        self.pair_max_stops = None
+        self.touch_secs = None
+        self.precision = None
+        self.unroutable_penalty = None
+        self.disk_pairs = None
+        self.disk_matrix_pairs = None
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.unroutable = 0
+        self.requests = 0
+
+    def _start(self):
+        if self.path is not None:
+            return
+        config = current_app.config
+        self.path = config['OSRM_CACHE_PATH']
+        self.max_memory_pairs = config['OSRM_CACHE_MEMORY_PAIRS']
+        self.max_disk_pairs = config['OSRM_CACHE_DISK_PAIRS']
+        self.max_disk_matrix_pairs = config['OSRM_CACHE_DISK_MATRIX_PAIRS']
+        self.pair_max_stops = config['OSRM_CACHE_PAIR_MAX_STOPS']
+        self.touch_secs = config['OSRM_CACHE_TOUCH_SECS']
+        self.precision = config['OSRM_CACHE_PRECISION']
+        self.unroutable_penalty = (config['OSRM_UNROUTABLE_KM'],
+                                   config['OSRM_UNROUTABLE_MINS'])
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS osrm_pairs ('
+                         'from_key TEXT NOT NULL, '
+                         'to_key TEXT NOT NULL, '
+                         'distance REAL NOT NULL, '
+                         'duration REAL NOT NULL, '
+                         'accessed REAL NOT NULL, '
+                         'PRIMARY KEY (from_key, to_key))')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_osrm_pairs_accessed '
+                         'ON osrm_pairs (accessed)')
+            conn.execute('CREATE TABLE IF NOT EXISTS osrm_matrices ('
+                         'matrix_key TEXT PRIMARY KEY, '
+                         'size INTEGER NOT NULL, '
+                         'distances BLOB NOT NULL, '
+                         'durations BLOB NOT NULL, '
+                         'accessed REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_osrm_matrices_accessed '
+                         'ON osrm_matrices (accessed)')
+            self.disk_pairs = conn.execute(
+                                'SELECT COUNT(*) FROM osrm_pairs').fetchone()[0]
+            self.disk_matrix_pairs = conn.execute(
+                                'SELECT COALESCE(SUM(size * size), 0) '
+                                'FROM osrm_matrices').fetchone()[0]
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def key(self, lat, lon):
+        return f'{lat:.{self.precision}f},{lon:.{self.precision}f}'
+
+    def get_matrix(self, coords, fetch):
+        """ Return (distances, durations) matrices between all of the coords
+
+        :param coords: List of (lat, lon) tuples
+        :param fetch:  Called as fetch(coords, sources, destinations) for any
+                       pairs that aren't cached. Returns (distances, durations)
+                       arrays of shape (len(sources), len(destinations)) in
+                       km and minutes, with NaN for pairs it can't route
+        """
+
+        with self.lock:
+            self._start()
+            keys = [self.key(lat, lon) for lat, lon in coords]
+            num_coords = len(keys)
+            if num_coords > self.pair_max_stops:
+                matrix_key = hashlib.sha1(
+                                    ';'.join(keys).encode()).hexdigest()
+                cached = self._read_matrix(matrix_key, num_coords)
+            else:
+                distances = np.full((num_coords, num_coords), np.nan)
+                durations = np.full((num_coords, num_coords), np.nan)
+                missing = self._read_memory(keys, distances, durations)
+                if missing:
+                    self._read_disk(keys, distances, durations)
+
+        if num_coords > self.pair_max_stops:
+            if cached is not None:
+                return cached
+            return self._fetch_matrix(coords, fetch, matrix_key)
+
+        gaps = np.isnan(distances)
+        if not gaps.any():
+            return distances, durations
+
+        # New locations leave most of their row empty, and a gap in the
+        # column of every other row. Fetch the rows of the new locations in
+        # full, then whichever columns still have gaps for the rest
+        new_rows = gaps.sum(axis=1) > num_coords / 2
+        rows = np.flatnonzero(new_rows).tolist()
+        other_rows = np.flatnonzero(~new_rows).tolist()
+        columns = np.flatnonzero(gaps[~new_rows].any(axis=0)).tolist()
+
+        if rows:
+            self._fetch(coords, fetch, rows, list(range(num_coords)),
+                        distances, durations)
+        if columns and other_rows:
+            self._fetch(coords, fetch, other_rows, columns,
+                        distances, durations)
+
+        routable = np.isfinite(distances) & np.isfinite(durations)
+        with self.lock:
+            self._write(keys, distances, durations, routable, rows,
+                        other_rows, columns)
+
+        return self._penalise(distances, durations, routable)
+
+    def _penalise(self, distances, durations, routable):
+        """ Give pairs that can't be routed the unroutable penalties """
+
+        if not routable.all():
+            self.unroutable += int((~routable).sum())
+            distances[~routable], durations[~routable] = self.unroutable_penalty
+        return distances, durations
+
+    def _read_memory(self, keys, distances, durations):
+        missing = 0
+        now = time.time()
+        stale = now - self.touch_secs
+        touched = []
+        for i, from_key in enumerate(keys):
+            for j, to_key in enumerate(keys):
+                pair = self.pairs.get((from_key, to_key))
+                if pair is None:
+                    missing += 1
+                    continue
+                self.pairs.move_to_end((from_key, to_key))
+                distances[i, j], durations[i, j], accessed = pair
+                if accessed < stale:
+                    self.pairs[(from_key, to_key)] = pair[:2] + (now,)
+                    touched.append((now, from_key, to_key))
+        self.hits += len(keys) ** 2 - missing
+
+        if touched:
+            with self._connect() as conn:
+                conn.executemany('UPDATE osrm_pairs SET accessed = ? '
+                                 'WHERE from_key = ? AND to_key = ?', touched)
+        return missing
+
+    def _read_disk(self, keys, distances, durations):
+        """ Fill the gaps left in memory from disk, promoting what's found """
+
+        positions = {}
+        for i, key in enumerate(keys):
+            positions.setdefault(key, []).append(i)
+        missing_keys = [keys[i] for i in
+                        np.flatnonzero(np.isnan(distances).any(axis=1))]
+
+        found = []
+        with self._connect() as conn:
+            # Keep inside SQLite's limit on the number of query parameters
+            for x in range(0, len(missing_keys), 500):
+                batch = missing_keys[x:x + 500]
+                rows = conn.execute(
+                            'SELECT from_key, to_key, distance, duration '
+                            'FROM osrm_pairs WHERE from_key IN ({})'.format(
+                                                    ','.join('?' * len(batch))),
+                            batch).fetchall()
+                found += [row for row in rows if row[1] in positions]
+
+            now = time.time()
+            conn.executemany('UPDATE osrm_pairs SET accessed = ? '
+                             'WHERE from_key = ? AND to_key = ?',
+                             [(now, row[0], row[1]) for row in found])
+
+        for from_key, to_key, distance, duration in found:
+            for i in positions[from_key]:
+                for j in positions[to_key]:
+                    if np.isnan(distances[i, j]):
+                        self.disk_hits += 1
+                    distances[i, j] = distance
+                    durations[i, j] = duration
+            self._remember(from_key, to_key, distance, duration, now)
+
+    def _fetch(self, coords, fetch, sources, destinations, distances,
+               durations):
+        self.requests += 1
+        self.misses += int(np.isnan(distances[np.ix_(sources,
+                                                     destinations)]).sum())
+        block_distances, block_durations = fetch(coords, sources, destinations)
+        distances[np.ix_(sources, destinations)] = block_distances
+        durations[np.ix_(sources, destinations)] = block_durations
+
+    def _remember(self, from_key, to_key, distance, duration, now):
+        self.pairs[(from_key, to_key)] = (distance, duration, now)
+        self.pairs.move_to_end((from_key, to_key))
+        self._trim_memory()
+
+    def _trim_memory(self):
+        """ Drop whole matrices, then pairs, until back under the cap """
+
+        while (self.matrices and len(self.pairs) + self.memory_matrix_pairs
+                                    > self.max_memory_pairs):
+            matrix_key, (distances, durations) = self.matrices.popitem(
+                                                                last=False)
+            self.memory_matrix_pairs -= distances.size
+        while len(self.pairs) + self.memory_matrix_pairs > self.max_memory_pairs:
+            self.pairs.popitem(last=False)
+
+    def _write(self, keys, distances, durations, routable, rows, other_rows,
+               columns):
+        """ Store the pairs that were fetched and routed, in memory and on
+        disk
+        """
+
+        fetched = [(i, j) for i in rows for j in range(len(keys))]
+        fetched += [(i, j) for i in other_rows for j in columns]
+
+        now = time.time()
+        entries = {}
+        for i, j in fetched:
+            if routable[i, j]:
+                entries[(keys[i], keys[j])] = (float(distances[i, j]),
+                                               float(durations[i, j]))
+        for (from_key, to_key), (distance, duration) in entries.items():
+            self._remember(from_key, to_key, distance, duration, now)
+
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO osrm_pairs '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             [(from_key, to_key, distance, duration, now)
+                              for (from_key, to_key), (distance, duration)
+                              in entries.items()])
+            self.disk_pairs += len(entries)
+
+            # The count over-estimates when pairs are replaced, so only trust
+            # it to tell us when to recount
+            if self.disk_pairs > self.max_disk_pairs:
+                self.disk_pairs = conn.execute(
+                                'SELECT COUNT(*) FROM osrm_pairs').fetchone()[0]
+                excess = self.disk_pairs - self.max_disk_pairs
+                if excess > 0:
+                    conn.execute('DELETE FROM osrm_pairs WHERE rowid IN ('
+                                 'SELECT rowid FROM osrm_pairs '
+                                 'ORDER BY accessed LIMIT ?)', (excess,))
+                    self.disk_pairs -= excess
+
+    def _read_matrix(self, matrix_key, size):
+        """ A whole matrix from memory or disk, or None if it isn't cached """
+
+        now = time.time()
+        cached = self.matrices.get(matrix_key)
+        with self._connect() as conn:
+            if cached is None:
+                row = conn.execute('SELECT distances, durations '
+                                   'FROM osrm_matrices WHERE matrix_key = ?',
+                                   (matrix_key,)).fetchone()
+                if row is None:
+                    return None
+                cached = tuple(np.frombuffer(blob, dtype=np.float32)
+                                 .reshape(size, size) for blob in row)
+                self.disk_hits += size * size
+                self._remember_matrix(matrix_key, *cached)
+            else:
+                self.matrices.move_to_end(matrix_key)
+                self.hits += size * size
+
+            # One row per matrix, so cheap enough to touch on every hit
+            conn.execute('UPDATE osrm_matrices SET accessed = ? '
+                         'WHERE matrix_key = ?', (now, matrix_key))
+
+        distances, durations = cached
+        return distances.astype(float), durations.astype(float)
+
+    def _fetch_matrix(self, coords, fetch, matrix_key):
+        """ Fetch a whole matrix, and cache it if every pair was routed """
+
+        num_coords = len(coords)
+        self.requests += 1
+        self.misses += num_coords ** 2
+        distances, durations = fetch(coords, list(range(num_coords)),
+                                     list(range(num_coords)))
+        distances = np.array(distances, dtype=float)
+        durations = np.array(durations, dtype=float)
+
+        routable = np.isfinite(distances) & np.isfinite(durations)
+        if routable.all():
+            with self.lock:
+                self._write_matrix(matrix_key,
+                                   distances.astype(np.float32),
+                                   durations.astype(np.float32))
+        return self._penalise(distances, durations, routable)
+
+    def _remember_matrix(self, matrix_key, distances, durations):
+        # A matrix bigger than the whole cap is only kept on disk
+        if distances.size > self.max_memory_pairs:
+            return
+        if matrix_key not in self.matrices:
+            self.memory_matrix_pairs += distances.size
+        self.matrices[matrix_key] = (distances, durations)
+        self.matrices.move_to_end(matrix_key)
+        self._trim_memory()
+
+    def _write_matrix(self, matrix_key, distances, durations):
+        self._remember_matrix(matrix_key, distances, durations)
+
+        size = len(distances)
+        with self._connect() as conn:
+            replaced = conn.execute('SELECT size FROM osrm_matrices '
+                                    'WHERE matrix_key = ?',
+                                    (matrix_key,)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO osrm_matrices '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (matrix_key, size, distances.tobytes(),
+                          durations.tobytes(), time.time()))
+            if replaced is not None:
+                self.disk_matrix_pairs -= replaced[0] ** 2
+            self.disk_matrix_pairs += size * size
+
+            # Drop the least recently used matrices until back under the cap
+            if self.disk_matrix_pairs > self.max_disk_matrix_pairs:
+                oldest = conn.execute('SELECT matrix_key, size '
+                                      'FROM osrm_matrices '
+                                      'ORDER BY accessed').fetchall()
+                dropped = []
+                for old_key, old_size in oldest:
+                    if self.disk_matrix_pairs <= self.max_disk_matrix_pairs:
+                        break
+                    dropped.append((old_key,))
+                    self.disk_matrix_pairs -= old_size ** 2
+                conn.executemany('DELETE FROM osrm_matrices '
+                                 'WHERE matrix_key = ?', dropped)
+
+    def stats(self):
+        """ Hit and miss counts, in pairs, since the process started """
+
+        return {'memory_hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'unroutable': self.unroutable,
+                'osrm_requests': self.requests,
+                'memory_pairs': len(self.pairs) + self.memory_matrix_pairs,
+                'disk_pairs': self.disk_pairs + self.disk_matrix_pairs}
+
+    def clear_memory(self):
+        with self.lock:
+            self.pairs.clear()
+            self.matrices.clear()
+            self.memory_matrix_pairs = 0
+
+
+matrix_cache = MatrixCache()
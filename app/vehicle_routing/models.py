@@ -1,72 +1,90 @@
-import itertools
-import json
 import random
-import requests
 import time
 import uuid
-import zmq
 
 from collections import defaultdict
 from flask import current_app
 
 from app.util import jsprit_to_readable_time
+from app.vehicle_routing.decompose import ClusteredProblem
+from app.vehicle_routing.encoder import encode_request
+from app.vehicle_routing.engine import NativeSolver
+from app.vehicle_routing.haversine import haversine_table
+from app.vehicle_routing.jsprit import jsprit_client
+from app.vehicle_routing.matrix_cache import matrix_cache
+from app.vehicle_routing.osrm import OSRMError, osrm_client
+from app.vehicle_routing.result_cache import route_cache
 
-import datetime as dt
 import numpy as np
 import pandas as pd
 
 
+MATRIX_SOURCES = ('osrm', 'haversine')
+
+
+class DistanceMatrix:
+    """ Distances (km) and durations (mins) between every pair of locations
+    
+    Held as two float32 arrays, with `index` mapping the location ids used by 
+    jsprit ('warehouse', '0', '1', ...) onto their rows and columns. `source` 
+    is 'osrm' or 'haversine', and `is_fallback` is set when it's a haversine 
+    matrix standing in for OSRM.
+    """
+    
+    def __init__(self, location_ids, distances, durations, source='osrm', 
+                 is_fallback=False):
+        self.location_ids = list(location_ids)
+        self.source = source
+        self.is_fallback = is_fallback
+        self.index = {location_id: i for i, location_id 
+                      in enumerate(self.location_ids)}
+        self.distances = np.ascontiguousarray(distances, dtype=np.float32)
+        self.durations = np.ascontiguousarray(durations, dtype=np.float32)
+
+
 class RoutingProblem:
     
     def __init__(self, locations, params):
         self.locations = locations
         self.params = params
+        self.algo_config = {'numberOfIterations': '100', 
+                            'isInfinite': 'false'}
     
     def build_matrix(self):
-        final_matrix = {}    # To store matrix as {(from, to): (distance, time)}
         
         # Store lat/lon as {id: (lat, lon)} to plot on frontend map
         location_map = {str(i): (location['lat'], location['lon'])
                         for i, location in enumerate(self.locations)}
 
-        # OSRM expects lon,lat pairs :/ Start building query string
-        loc_string = [','.join([str(item['lon']), str(item['lat'])])
-                      for item in self.locations]
-        num_locations = len(loc_string)
-        
-        # Add the warehouse to the matrix call string
-        loc_string = ['{},{}'.format(current_app.config['WH_LON'], 
-                                     current_app.config['WH_LAT'])] + loc_string
+        num_locations = len(self.locations)
         location_map['warehouse'] = (current_app.config['WH_LAT'], 
                                      current_app.config['WH_LON'])
-
-        # Call OSRM
-        query = (current_app.config['OSRM_BASE'] 
-                 + ';'.join(loc_string) + current_app.config['OSRM_END'])
-        req = requests.get(query)
-        matrix = req.json()
-        
-        # Process results into units of km and minutes
-        distances = [item/1000 for sublist in matrix.get('distances')
-                    for item in sublist]
-        durations = [item/60 for sublist in matrix.get('durations')
-                    for item in sublist]
-
-        # Compile into the format expected by jsprit server
+        
+        # The warehouse is always the first row of the matrix
+        coords = [location_map['warehouse']] + [(item['lat'], item['lon'])
+                                                for item in self.locations]
+        
+        source = self.get_matrix_source()
+        is_fallback = False
+        if source == 'haversine':
+            distances, durations = haversine_table(coords)
+        else:
+            # Only the pairs that haven't been seen before go to OSRM
+            try:
+                distances, durations = matrix_cache.get_matrix(
+                                                coords, osrm_client.table)
+            except OSRMError:
+                if not current_app.config['OSRM_FALLBACK']:
+                    raise
+                distances, durations = haversine_table(coords)
+                source = 'haversine'
+                is_fallback = True
+        
         location_ids = ['warehouse'] + list(map(str, range(num_locations)))
-        all_location_pairs = itertools.product(location_ids, repeat=2)
-
-        matrix_entries = []
-        for i, loc_pair in enumerate(all_location_pairs):
-            matrix_entries.append({'loc_from': loc_pair[0],
-                                   'loc_to': loc_pair[1],
-                                   'distance': str(distances[i]),
-                                   'time': str(durations[i])
-                                  })
-            final_matrix[(loc_pair[0], loc_pair[1])] = (distances[i], 
-                                                        durations[i])
-        
-        return matrix_entries, final_matrix, location_map
+        matrix = DistanceMatrix(location_ids, distances, durations, source, 
+                                is_fallback)
+        
+        return matrix, location_map
     
     def build_drivers(self):
         
@@ -102,39 +120,88 @@ class RoutingProblem:
 
         return {'drivers': drivers, 'vtypes': vtypes}
     
-    def send_to_jsprit(self, order_string, driver_config, algo_config):
+    def send_to_jsprit(self, matrix, orders, driver_config, algo_config):
         
         problem_id = uuid.uuid4().hex[:10]
         
-        context = zmq.Context()
-        socket = context.socket(zmq.REQ)
-        socket.connect(current_app.config['JSPRIT_SOCKET'])
-
-        today = dt.datetime.now().strftime('%Y_%m_%d')
+        # The server needs the request without whitespace, which the encoder 
+        # does without touching the spaces inside strings
+        chunks = encode_request(matrix, orders, driver_config, algo_config,
+                                current_app.config['JSPRIT_MATRIX_FORMAT'])
         
-        request = {"ordersToSolve": order_string,
-                   "driverConfig": driver_config,
-                   "algoParams": algo_config}
+        return jsprit_client.solve(chunks, problem_id)
+    
+    def get_engine(self):
+        """ 'jsprit' or 'native', from the params or ROUTING_ENGINE. 'auto' 
+        uses the native engine for problems of up to ROUTING_NATIVE_MAX_STOPS 
+        """
         
-        dir_path = current_app.config['REQUEST_PATH']
+        engine = (self.params.get('engine') 
+                  or current_app.config['ROUTING_ENGINE'])
+        if engine == 'auto':
+            if (len(self.locations) 
+                    <= current_app.config['ROUTING_NATIVE_MAX_STOPS']):
+                return 'native'
+            return 'jsprit'
+        return engine
+    
+    def get_matrix_source(self):
+        """ 'osrm' or 'haversine', from the params or ROUTING_MATRIX_SOURCE """
         
-        # TODO: why did we configure the the server to require no whitespace??
-        with open(f'{dir_path}/{today}_{problem_id}.txt', 'w') as outfile:
-            output_json = json.dumps(request)
-            outfile.write(output_json.replace(' ',''))
+        return (self.params.get('matrix') 
+                or current_app.config['ROUTING_MATRIX_SOURCE'])
+    
+    def cache_key(self):
+        return route_cache.key(self.locations, self.params, 
+                               dict(self.algo_config, 
+                                    engine=self.get_engine(),
+                                    matrix=self.get_matrix_source()))
+    
+    def solve_route(self):
+        
+        # Solving the same problem again gives back the same routes
+        cache_key = self.cache_key()
+        cached = route_cache.get(cache_key)
+        if cached is not None:
+            return cached
         
-        socket.send_string(f'{dir_path}/{today}_{problem_id}.txt')
-        response = socket.recv()
+        if self.should_decompose():
+            clustered = ClusteredProblem(self)
+            routes, stats = clustered.solve()
+            is_fallback = clustered.is_fallback
+        else:
+            # First get the distance/time matrix. It's encoded straight into 
+            # the request by send_to_jsprit
+            matrix, location_dict = self.build_matrix()
+            routes, stats = self.solve_with_matrix(matrix, location_dict)
+            is_fallback = matrix.is_fallback
         
-        socket.close()
-        return json.loads(response)
+        # Routes on a stand-in matrix are only good until OSRM is back
+        if not is_fallback:
+            route_cache.set(cache_key, (routes, stats))
+        return routes, stats
     
-    def solve_route(self):
+    def should_decompose(self):
+        """ Whether to split the problem up by ClusteredProblem. Large 
+        problems are, unless the params say otherwise
+        """
+        
+        decompose = self.params.get('decompose', 'auto')
+        if decompose == 'auto':
+            return (len(self.locations) 
+                    > current_app.config['ROUTING_CLUSTER_MIN_STOPS'])
+        return decompose == 'Yes'
+    
+    def solve_with_matrix(self, matrix, location_dict):
+        """ Solve given the output of build_matrix """
+        
+        result = self.solve_raw(matrix)
+        return self.process_results(result, matrix, location_dict)
+    
+    def solve_raw(self, matrix):
+        """ The response from the routing engine, before process_results """
+        
         jsprit_data = {}
-
-        # First get the distance/time matrix
-        matrix, my_matrix, location_dict = self.build_matrix()
-        jsprit_data['matrix'] = matrix
         
         # Now configure the vehicles and vehicle types
         driver_config = self.build_drivers()
@@ -156,121 +223,125 @@ class RoutingProblem:
                                   'service_time': "5"}
         jsprit_data['deliveries'] = deliveries
 
-        algo_config = {'numberOfIterations': '100', 
-                       'isInfinite': 'false'}
-
         send_time = time.time()
-        result = self.send_to_jsprit(jsprit_data, driver_config, algo_config)
+        if self.get_engine() == 'native':
+            result = NativeSolver(matrix, jsprit_data, driver_config).solve()
+        else:
+            result = self.send_to_jsprit(matrix, jsprit_data, driver_config, 
+                                         self.algo_config)
         solve_time = time.time() - send_time
-        routes, stats = self.process_results(result, my_matrix, location_dict)
-        return routes, stats
+        return result
         
     def process_results(self, result, matrix, location_coords):
+        """ The routes and stats for the results template, from the response 
+        of the routing engine
         
-        location_dict = {i: location for 
-                         i, location in enumerate(self.locations)}
+        Each route is turned into arrays of its jobs, so travel from the 
+        matrix, waiting and the clock times are all worked out at once for 
+        the whole route rather than stop by stop.
+        """
         
-        raw_routes = result['routes']
+        warehouse = location_coords['warehouse']
         driver_routes = {}
         all_stats = defaultdict(dict)
         
-        for driver_name, route in raw_routes.items():
-            previous_location = 'warehouse' # Init at the starting location
+        for driver_name, route in result['routes'].items():
             driver_number = int(driver_name.split('_')[1])
-            individual_route = []
-            route_stats = {}
-            for i, job in enumerate(route):
-                
-                details = {'job_id': i,
-                           'location': '',
-                           'departure_time': '',
-                           'arrival_time': '',
-                           'activity': '',
-                           'customer_name': '',
-                           'slot_start': '',
-                           'slot_end': '',
-                           'waiting_time': '',
-                           'lat': '',
-                           'lon': ''}
+            jobs = route[1:-1]
+            
+            is_lunch = np.array([job['tracking'] == 'lunch' for job in jobs],
+                                dtype=bool)
+            departures = np.array([float(job['num_departure']) 
+                                   for job in jobs])
+            
+            # We have a flat 5 minutes for service time, and a 30 minute lunch
+            arrivals = departures - np.where(is_lunch, 30, 5)
+            waiting = np.array([float(job.get('num_arrival', 0)) 
+                                for job in jobs])
+            waiting = np.trunc(departures - 5 - waiting).astype(int)
+            
+            # jsprit gives the arrival back at the depot in seconds
+            returned = float(route[-1]['arrival'].split(':')[0]) / 60
+            clock = jsprit_to_readable_time(np.concatenate(
+                                            [[route[0]['num_departure']],
+                                             departures, arrivals, 
+                                             [returned]])).tolist()
+            departure_times = clock[1:len(jobs) + 1]
+            arrival_times = clock[len(jobs) + 1:-1]
+            
+            individual_route = [{'job_id': 0,
+                                 'location': 'Warehouse',
+                                 'departure_time': clock[0],
+                                 'arrival_time': '',
+                                 'activity': 'Depart',
+                                 'customer_name': 'Depot',
+                                 'slot_start': '',
+                                 'slot_end': '',
+                                 'waiting_time': '',
+                                 'lat': warehouse[0],
+                                 'lon': warehouse[1]}]
+            
+            deliveries = []
+            for i, job in enumerate(jobs):
+                if is_lunch[i]:
+                    individual_route.append({
+                                 'job_id': i + 1,
+                                 'location': '',
+                                 'departure_time': departure_times[i],
+                                 'arrival_time': arrival_times[i],
+                                 'activity': 'Lunch',
+                                 'customer_name': '',
+                                 'slot_start': '',
+                                 'slot_end': '',
+                                 'waiting_time': '',
+                                 'lat': '',
+                                 'lon': ''})
+                    continue
                 
-                if i == 0:
-                    # Leaving the warehouse
-                    details['location'] = 'Warehouse'
-                    details['departure_time'] = jsprit_to_readable_time(
-                                                           job['num_departure']
-                                                           )
-                    details['activity'] = 'Depart'
-                    details['customer_name'] = 'Depot'
-                    details['lat'] = location_coords['warehouse'][0]
-                    details['lon'] = location_coords['warehouse'][1]
-                    
-                elif i == (len(route) - 1):
-                    # Arriving back at the warehouse
-                    details['location'] = 'Warehouse'
-                    details['arrival_time'] = jsprit_to_readable_time(
-                                       float(job['arrival'].split(':')[0]) / 60
-                                       )
-                    details['activity'] = 'Arrive'
-                    details['customer_name'] = 'Depot'
-                    details['lat'] = location_coords['warehouse'][0]
-                    details['lon'] = location_coords['warehouse'][1]
-                    
-                elif job['tracking'] == 'lunch':
-                    details['activity'] = 'Lunch'
-                    details['customer_name'] = ''
-                    details['arrival_time'] = jsprit_to_readable_time(
-                                                      job['num_departure'] - 30
-                                                      )
-                    details['departure_time'] = jsprit_to_readable_time(
-                                                          job['num_departure']
-                                                          )
-                    all_stats[driver_number]['had_lunch'] = True
-                else:
-                    # We have a flat 5 minutes for service time
-                    tracking = int(job['tracking'])
-                    waiting_time = int(float(job['num_departure']) - 5
-                                        - float(job['num_arrival']))
-                    
-                    first_name, surname = (location_dict[tracking]['name']
-                                                                  .split(' '))
-                    
-                    first_name = first_name[0] + '.'
-                    name = first_name + ' ' + surname
-                    details['location'] = name
-                    details['customer_name'] = name
-                    details['departure_time'] = jsprit_to_readable_time(
-                                                           job['num_departure']
-                                                           )
-                    details['arrival_time'] = jsprit_to_readable_time(
-                                                float(job['num_departure']) - 5
-                                                )
-                    details['waiting_time'] = waiting_time
-                    details['activity'] = 'Delivery'
-                    details['slot_start'] = location_dict[tracking]['start']
-                    details['slot_end'] = location_dict[tracking]['end']
-                    details['lat'] = location_coords[job['tracking']][0]
-                    details['lon'] = location_coords[job['tracking']][1]
-                    
-                    # Grab some stats
-                    travel_distance, travel_time = matrix[(previous_location,
-                                                           job['tracking'])]
-                    
-                    all_stats[driver_number]['distance'] = (
-                                    all_stats[driver_number].get('distance', 0) 
-                                    + travel_distance)
-                    all_stats[driver_number]['time'] = (
-                                    all_stats[driver_number].get('time', 0) 
-                                    + travel_time)
-                    all_stats[driver_number]['waiting'] = (
-                                    all_stats[driver_number].get('waiting', 0) 
-                                    + waiting_time)
-                    previous_location = job['tracking']
-                    
-                individual_route.append(details)
-            all_stats[driver_number]['had_lunch'] = (
-                                all_stats[driver_number].get('had_lunch', False)
-                                )
-            all_stats[driver_number]['num_jobs'] = i - 1
+                deliveries.append(i)
+                location = self.locations[int(job['tracking'])]
+                first_name, surname = location['name'].split(' ')
+                name = first_name[0] + '. ' + surname
+                coords = location_coords[job['tracking']]
+                individual_route.append({
+                                 'job_id': i + 1,
+                                 'location': name,
+                                 'departure_time': departure_times[i],
+                                 'arrival_time': arrival_times[i],
+                                 'activity': 'Delivery',
+                                 'customer_name': name,
+                                 'slot_start': location['start'],
+                                 'slot_end': location['end'],
+                                 'waiting_time': int(waiting[i]),
+                                 'lat': coords[0],
+                                 'lon': coords[1]})
+            
+            individual_route.append({'job_id': len(route) - 1,
+                                     'location': 'Warehouse',
+                                     'departure_time': '',
+                                     'arrival_time': clock[-1],
+                                     'activity': 'Arrive',
+                                     'customer_name': 'Depot',
+                                     'slot_start': '',
+                                     'slot_end': '',
+                                     'waiting_time': '',
+                                     'lat': warehouse[0],
+                                     'lon': warehouse[1]})
+            
+            # Travel is counted from the warehouse (row 0 of the matrix) to 
+            # each delivery in turn, not back again
+            if deliveries:
+                rows = np.array([matrix.index[jobs[i]['tracking']] 
+                                 for i in deliveries])
+                previous = np.concatenate([[0], rows[:-1]])
+                stats = all_stats[driver_number]
+                stats['distance'] = matrix.distances[previous, rows].sum(
+                                                            dtype=np.float64)
+                stats['time'] = matrix.durations[previous, rows].sum(
+                                                            dtype=np.float64)
+                stats['waiting'] = waiting[deliveries].sum()
+            all_stats[driver_number]['had_lunch'] = bool(is_lunch.any())
+            all_stats[driver_number]['num_jobs'] = len(route) - 2
             driver_routes[driver_number] = individual_route
         
         # Clean up the stats
@@ -315,6 +386,43 @@ class RoutingProblem:
         
         return True
     
+    @staticmethod
+    def validate_batch_problem(problem):
+        """ Check a problem sent to the batch API has everything needed to 
+        solve it. Unlike the form, customers and drivers go up to
+        ROUTING_BATCH_MAX_STOPS and ROUTING_BATCH_MAX_DRIVERS
+        """
+        
+        location_keys = ['lat', 'lon', 'name', 'start', 'end', 'jsprit_start', 
+                         'jsprit_end']
+        try:
+            locations = problem['locations']
+            params = problem['params']
+            if not locations or not isinstance(locations, list):
+                return False
+            if len(locations) > current_app.config['ROUTING_BATCH_MAX_STOPS']:
+                return False
+            for location in locations:
+                if any(key not in location for key in location_keys):
+                    return False
+                float(location['lat'])
+                float(location['lon'])
+            
+            number_of_drivers = int(params['number_of_drivers'])
+            if not (1 <= number_of_drivers 
+                    <= current_app.config['ROUTING_BATCH_MAX_DRIVERS']):
+                return False
+            if (params['driver_gets_break'] 
+                    not in current_app.config['DRIVER_BREAKS']):
+                return False
+            if params.get('matrix', 'osrm') not in MATRIX_SOURCES:
+                return False
+            
+        except Exception:
+            return False
+        
+        return True
+    
     @staticmethod
     def build_locations(req):
         
@@ -332,8 +440,8 @@ class RoutingProblem:
                                          samples, 
                                          replace=True)
         jsprit_ends = jsprit_starts + 60 * int(req['delivery_slot_length'])
-        starts = list(map(jsprit_to_readable_time, jsprit_starts.tolist()))
-        ends = list(map(jsprit_to_readable_time, jsprit_ends.tolist()))
+        starts = jsprit_to_readable_time(jsprit_starts).tolist()
+        ends = jsprit_to_readable_time(jsprit_ends).tolist()
         
         # We also want to be able to display the name and timeslot on markers
         details = [f'{name}\n{starts[i]}-{ends[i]}' 
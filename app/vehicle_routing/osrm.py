@@ -0,0 +1,133 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import numpy as np
+import requests
+
+
+class OSRMError(Exception):
+    pass
+
+
+class OSRMClient:
+    """ Client for the OSRM table service
+
+    Requests share one keep-alive session. Connection errors and 429/5xx
+    responses are retried with exponential backoff, and every request has a
+    connect and read timeout. Tables with more locations than
+    OSRM_MAX_TABLE_SIZE are split into tiles of sources x destinations,
+    which are fetched concurrently and put back together into one matrix.
+    Each tile only sends the coordinates it needs, so the URL length stays
+    bounded however large the problem is.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            if self.session is not None:
+                return
+            config = current_app.config
+            self.base = config['OSRM_BASE']
+            self.end = config['OSRM_END']
+            self.timeout = (config['OSRM_CONNECT_TIMEOUT'],
+                            config['OSRM_READ_TIMEOUT'])
+            self.max_table_size = config['OSRM_MAX_TABLE_SIZE']
+
+            retry = Retry(total=config['OSRM_RETRIES'],
+                          backoff_factor=config['OSRM_RETRY_BACKOFF'],
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=['GET'])
+            adapter = HTTPAdapter(pool_maxsize=config['OSRM_CONCURRENCY'],
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+            self.executor = ThreadPoolExecutor(
+                                    max_workers=config['OSRM_CONCURRENCY'])
+            self.session = session
+
+    def table(self, coords, sources=None, destinations=None):
+        """ Distances (km) and durations (mins) from sources to destinations
+
+        :param coords:       List of (lat, lon) tuples
+        :param sources:      Indices into coords to route from. All of them
+                             if not given
+        :param destinations: Indices into coords to route to. All of them if
+                             not given
+        :raises OSRMError:   If OSRM can't be reached or can't route a tile
+        """
+
+        self._start()
+        if sources is None:
+            sources = range(len(coords))
+        if destinations is None:
+            destinations = range(len(coords))
+        sources = list(sources)
+        destinations = list(destinations)
+
+        if len(set(sources) | set(destinations)) <= self.max_table_size:
+            return self._request(coords, sources, destinations)
+
+        # Split the sources and destinations so each tile has at most
+        # max_table_size locations in it
+        block = max(self.max_table_size // 2, 1)
+        tiles = [(i, j) for i in range(0, len(sources), block)
+                 for j in range(0, len(destinations), block)]
+        results = self.executor.map(
+                    lambda tile: self._request(
+                                    coords,
+                                    sources[tile[0]:tile[0] + block],
+                                    destinations[tile[1]:tile[1] + block]),
+                    tiles)
+
+        distances = np.empty((len(sources), len(destinations)))
+        durations = np.empty((len(sources), len(destinations)))
+        for (i, j), (tile_distances, tile_durations) in zip(tiles, results):
+            distances[i:i + block, j:j + block] = tile_distances
+            durations[i:i + block, j:j + block] = tile_durations
+
+        return distances, durations
+
+    def _request(self, coords, sources, destinations):
+        """ A single table request covering just the coords it needs """
+
+        needed = sorted(set(sources) | set(destinations))
+        position = {index: i for i, index in enumerate(needed)}
+
+        # OSRM expects lon,lat pairs :/
+        loc_string = ';'.join('{:.6f},{:.6f}'.format(coords[i][1], coords[i][0])
+                              for i in needed)
+        query = self.base + loc_string + self.end
+        if sources != needed or destinations != needed:
+            query += ('&sources='
+                      + ';'.join(str(position[i]) for i in sources)
+                      + '&destinations='
+                      + ';'.join(str(position[i]) for i in destinations))
+
+        try:
+            response = self.session.get(query, timeout=self.timeout)
+            response.raise_for_status()
+            matrix = response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise OSRMError(f'OSRM table request failed: {e}') from e
+
+        if matrix.get('code') != 'Ok':
+            raise OSRMError(f'OSRM could not build the table: '
+                            f'{matrix.get("code")} {matrix.get("message", "")}')
+
+        # Process results into units of km and minutes
+        distances = np.array(matrix['distances'], dtype=float) / 1000
+        durations = np.array(matrix['durations'], dtype=float) / 60
+        return distances, durations
+
+
+osrm_client = OSRMClient()
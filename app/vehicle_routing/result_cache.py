@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from flask import current_app
+
+
+class RouteCache:
+    """ Processed routes and stats for routing problems that were solved
+    before
+
+    Results are keyed by a hash of everything that goes into a solve: the
+    locations, the routing params, the algorithm config and the warehouse.
+    They're stored in a SQLite file at ROUTE_CACHE_PATH, so every worker
+    shares them. Entries expire ROUTE_CACHE_TTL_SECS after they're solved,
+    and past ROUTE_CACHE_MAX_ENTRIES the least recently used are dropped.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _start(self):
+        with self.lock:
+            if self.path is not None:
+                return
+            self.ttl = current_app.config['ROUTE_CACHE_TTL_SECS']
+            self.max_entries = current_app.config['ROUTE_CACHE_MAX_ENTRIES']
+            path = current_app.config['ROUTE_CACHE_PATH']
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with sqlite3.connect(path, timeout=30) as conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS route_results ('
+                             'key TEXT PRIMARY KEY, '
+                             'result BLOB NOT NULL, '
+                             'created REAL NOT NULL, '
+                             'accessed REAL NOT NULL)')
+            self.path = path
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def key(locations, params, algo_config):
+        """ A hash that's the same for any two identical problems """
+
+        problem = {'locations': locations,
+                   'params': params,
+                   'algo_config': algo_config,
+                   'warehouse': [current_app.config['WH_LAT'],
+                                 current_app.config['WH_LON']]}
+        canonical = json.dumps(problem, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, key):
+        """ The cached (routes, stats), or None """
+
+        self._start()
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute('SELECT result FROM route_results '
+                               'WHERE key = ? AND created > ?',
+                               (key, now - self.ttl)).fetchone()
+            if row is not None:
+                conn.execute('UPDATE route_results SET accessed = ? '
+                             'WHERE key = ?', (now, key))
+
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def set(self, key, result):
+        self._start()
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO route_results '
+                         'VALUES (?, ?, ?, ?)',
+                         (key, pickle.dumps(result), now, now))
+            conn.execute('DELETE FROM route_results WHERE created <= ?',
+                         (now - self.ttl,))
+            conn.execute('DELETE FROM route_results WHERE key IN ('
+                         'SELECT key FROM route_results '
+                         'ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                         (self.max_entries,))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+route_cache = RouteCache()
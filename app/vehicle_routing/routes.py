@@ -1,8 +1,15 @@
-from flask import current_app, jsonify, render_template, request, session
+from flask import (current_app, jsonify, render_template, request, session, 
+                   Response, stream_with_context)
 
+from app import csrf
 from app.vehicle_routing import bp
+from app.vehicle_routing.batch import solve_batch
+from app.vehicle_routing.jsprit import JspritError
 from app.vehicle_routing.models import RoutingProblem
+from app.vehicle_routing.osrm import OSRMError
 
+import hmac
+import json
 import time
 
 import numpy as np
@@ -49,11 +56,69 @@ def solve_problem():
     stats = {}
     if locations:
         solver = RoutingProblem(locations, params)
-        routes, stats = solver.solve_route()
+        try:
+            routes, stats = solver.solve_route()
+        except (JspritError, OSRMError) as e:
+            return f'<center><font color="red">{ e }</font></center><br>'
 
     num_drivers = current_app.config['NUM_DRIVERS']
 
     return render_template('vehicle_routing/results_panel.html',
                            num_drivers=num_drivers,
                            routes=routes,
-                           stats=stats)
\ No newline at end of file
+                           stats=stats)
+
+
+@bp.route('/solve_batch', methods=['POST'])
+@csrf.exempt
+def solve_problem_batch():
+    """ Solve a list of problems, streaming back one JSON line per problem 
+    as each is solved, then a line with a summary of the batch
+    
+    Expects JSON of {"problems": [{"locations": [...], "params": {...}}]}, 
+    with locations as made by build_locations and the params of the 
+    create_problem form. Clients aren't browsers with a CSRF token, so 
+    they authenticate with one of ROUTING_BATCH_API_TOKENS instead.
+    """
+    
+    if not is_batch_client(request.headers.get('Authorization', '')):
+        return jsonify({'success': False,
+                        'error': 'A valid API token is needed'}), 401
+    
+    req = request.get_json(silent=True) or {}
+    problems = req.get('problems')
+    max_problems = current_app.config['ROUTING_BATCH_MAX_PROBLEMS']
+    if not isinstance(problems, list) or not problems:
+        return jsonify({'success': False,
+                        'error': 'Expected a list of problems'}), 400
+    if len(problems) > max_problems:
+        return jsonify({'success': False,
+                        'error': f'At most {max_problems} problems can be '
+                                 f'solved in one batch'}), 400
+    
+    routing_problems = []
+    for i, problem in enumerate(problems):
+        if not RoutingProblem.validate_batch_problem(problem):
+            return jsonify({'success': False,
+                            'error': f'Problem {i} is not valid'}), 400
+        routing_problems.append(RoutingProblem(problem['locations'], 
+                                               problem['params']))
+    
+    def generate():
+        for result in solve_batch(routing_problems):
+            yield json.dumps(result) + '\n'
+    
+    return Response(stream_with_context(generate()), 
+                    mimetype='application/x-ndjson')
+
+
+def is_batch_client(authorization):
+    """ Whether an Authorization header has one of ROUTING_BATCH_API_TOKENS 
+    as a bearer token
+    """
+    
+    scheme, _, token = authorization.partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return False
+    return any(hmac.compare_digest(token.encode(), allowed.encode()) 
+               for allowed in current_app.config['ROUTING_BATCH_API_TOKENS'])
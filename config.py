@@ -32,6 +32,10 @@ class Config:
     
     SCHEDULER_API_ENABLED = True
     
+    # Stage timings are logged as JSON lines at this level. Set to WARNING 
+    # to turn them off
+    METRICS_LOG_LEVEL = os.environ.get('METRICS_LOG_LEVEL', 'INFO')
+    
     # VEHICLE ROUTING PARAMS
     
     MIN_LAT = 53.384
@@ -48,15 +52,121 @@ class Config:
     DRIVER_BREAKS = ['Yes', 'No']
     
     START_TIMES = [540, 600, 660, 720, 780, 840, 900] # Mins past midnight
+    
+    # 'jsprit' solves routes on the jsprit server, 'native' in-process, and 
+    # 'auto' in-process for problems of up to ROUTING_NATIVE_MAX_STOPS
+    ROUTING_ENGINE = os.environ.get('ROUTING_ENGINE', 'jsprit')
+    ROUTING_NATIVE_MAX_STOPS = 30
+    
+    # Most problems that can be sent to /routing/solve_batch at once, and 
+    # the most stops and drivers each one can have
+    ROUTING_BATCH_MAX_PROBLEMS = 500
+    ROUTING_BATCH_MAX_STOPS = 1000
+    ROUTING_BATCH_MAX_DRIVERS = 50
+    
+    # Batch clients send one of these as "Authorization: Bearer <token>". 
+    # Comma separated in the environment. With none set the API is closed
+    ROUTING_BATCH_API_TOKENS = [token.strip() for token in 
+                                os.environ.get('ROUTING_BATCH_API_TOKENS', 
+                                               '').split(',') 
+                                if token.strip()]
+
+    # Problems with more stops than ROUTING_CLUSTER_MIN_STOPS are split into
+    # clusters of about ROUTING_CLUSTER_SIZE stops, solved
+    # ROUTING_CLUSTER_WORKERS at a time. A minute between time windows
+    # counts as ROUTING_CLUSTER_TIME_WEIGHT km when clustering
+    ROUTING_CLUSTER_MIN_STOPS = 150
+    ROUTING_CLUSTER_SIZE = 100
+    ROUTING_CLUSTER_WORKERS = 4
+    ROUTING_CLUSTER_TIME_WEIGHT = 0.02
+    
+    # Customers a cluster can't fit are offered to a neighbouring cluster, 
+    # which is solved again in full with them added. At most this many 
+    # clusters are re-solved, taking up to this many extra customers each
+    ROUTING_CLUSTER_REPAIR_CLUSTERS = 4
+    ROUTING_CLUSTER_REPAIR_MOVES = 20
 
     OSRM_BASE = os.environ.get('OSRM_BASE')
     OSRM_END = '?annotations=distance,duration'
     
+    # Tables with more locations than the OSRM server's --max-table-size are 
+    # fetched in tiles, OSRM_CONCURRENCY at a time over a pooled session
+    OSRM_MAX_TABLE_SIZE = int(os.environ.get('OSRM_MAX_TABLE_SIZE', 250))
+    OSRM_CONCURRENCY = 4
+    OSRM_CONNECT_TIMEOUT = 5
+    OSRM_READ_TIMEOUT = 30
+    OSRM_RETRIES = 3
+    OSRM_RETRY_BACKOFF = 0.5
+
+    # Matrices come from OSRM, or from great-circle distances with
+    # ROUTING_MATRIX_SOURCE = 'haversine' (or 'matrix' in the routing params).
+    # If OSRM fails and OSRM_FALLBACK is set, the haversine matrix is used
+    # instead and the routes aren't cached
+    ROUTING_MATRIX_SOURCE = os.environ.get('ROUTING_MATRIX_SOURCE', 'osrm')
+    OSRM_FALLBACK = True
+
+    # Road distance over straight line distance, and the average speed (km/h)
+    # of journeys of up to each distance (km). The last band is for any
+    # distance
+    HAVERSINE_CIRCUITY = 1.3
+    HAVERSINE_SPEED_BANDS = [(2, 18), (10, 30), (None, 50)]
+    
+    # OSRM distances/durations are cached for each pair of points, with the 
+    # points rounded to OSRM_CACHE_PRECISION decimal places (~1m). The most 
+    # recently used pairs are kept in memory and on disk, up to these caps. 
+    # Matrices of more than OSRM_CACHE_PAIR_MAX_STOPS points are cached 
+    # whole instead, up to OSRM_CACHE_DISK_MATRIX_PAIRS entries on disk. 
+    # Pairs found in memory are marked as used on disk every TOUCH_SECS
+    OSRM_CACHE_PATH = os.path.join(basedir, 'app/cache/osrm_matrix.db')
+    OSRM_CACHE_PRECISION = 5
+    OSRM_CACHE_MEMORY_PAIRS = 250000
+    OSRM_CACHE_DISK_PAIRS = 5000000
+    OSRM_CACHE_PAIR_MAX_STOPS = 250
+    OSRM_CACHE_DISK_MATRIX_PAIRS = 25000000
+    OSRM_CACHE_TOUCH_SECS = 3600
+    
+    # Distance (km) and duration (mins) given to pairs OSRM can't route, 
+    # far enough that the solver leaves a stop off rather than use them
+    OSRM_UNROUTABLE_KM = 10000
+    OSRM_UNROUTABLE_MINS = 10000
+    
+    # Solved routes are kept so that solving the same problem again is 
+    # instant. Shared by all workers through a SQLite file
+    ROUTE_CACHE_PATH = os.path.join(basedir, 'app/cache/routes.db')
+    ROUTE_CACHE_TTL_SECS = 3600
+    ROUTE_CACHE_MAX_ENTRIES = 500
+    
     LEAFLET_SERVER = os.environ.get('LEAFLET_ROUTING_SERVER')
     MAPBOX_KEY = os.environ.get('MAPBOX_KEY')
     JSPRIT_SOCKET = os.environ.get('JSPRIT_SOCKET')
+    
+    # Connections kept open to the jsprit server, i.e. the most solves that 
+    # can be waiting on it at once, and how long to wait for each one
+    JSPRIT_POOL_SIZE = 4
+    JSPRIT_TIMEOUT_SECS = int(os.environ.get('JSPRIT_TIMEOUT_SECS', 60))
     REQUEST_PATH = os.path.join(basedir, 'app/requests')
     
+    # 'path' writes each request to REQUEST_PATH and sends jsprit the file 
+    # path. 'inline' sends it in the message itself, zlib compressed if 
+    # JSPRIT_COMPRESS is set, but needs a jsprit server that reads the 
+    # two-part inline message
+    JSPRIT_TRANSPORT = os.environ.get('JSPRIT_TRANSPORT', 'path')
+    JSPRIT_COMPRESS = False
+    
+    # 'entries' sends the matrix as the list of {loc_from, loc_to, distance, 
+    # time} objects. 'dense' sends base64 float32 arrays, which is much 
+    # smaller and quicker to build for big problems but needs server support
+    JSPRIT_MATRIX_FORMAT = os.environ.get('JSPRIT_MATRIX_FORMAT', 'entries')
+    
+    # Also keep a copy of inline requests in REQUEST_PATH for debugging. 
+    # Files there are pruned to the newest MAX_FILES, up to MAX_AGE_DAYS old,
+    # at most once every PRUNE_SECS, so that writes don't each have to scan 
+    # the directory. Requests written in between can go over MAX_FILES
+    JSPRIT_AUDIT = os.environ.get('JSPRIT_AUDIT') == '1'
+    JSPRIT_AUDIT_MAX_FILES = 1000
+    JSPRIT_AUDIT_MAX_AGE_DAYS = 7
+    JSPRIT_AUDIT_PRUNE_SECS = 300
+    
     @staticmethod
     def load_customer_names():
         """ Pre-load the static customer names for the routing problems """
@@ -97,6 +207,33 @@ class Config:
     # How often to generate new machine data and update in real-time on frontend
     UPDATE_CYCLE_SECS = 3
     
+    # Most machine status streams open at once per process, how many 
+    # unsent updates each can fall behind by before it's resynced, and how 
+    # often to send a keep-alive when nothing has changed
+    LIVE_STATUS_MAX_STREAMS = 100
+    LIVE_STATUS_STREAM_BUFFER = 5
+    LIVE_STATUS_HEARTBEAT_SECS = 15
+    
+    # History plots cover PLOT_DEFAULT_DAYS unless asked for another range, 
+    # at the finest of hourly, daily or weekly with up to PLOT_MAX_POINTS 
+    # points per machine
+    PLOT_DEFAULT_DAYS = 7
+    PLOT_MAX_POINTS = 200
+    PLOT_RANGES = {2: '2 Days', 7: '1 Week', 28: '4 Weeks', 84: '12 Weeks'}
+    
+    # Number of processes to run independent schedule solver chains across. 
+    # 1 runs a single chain in the request thread
+    SOLVER_WORKERS = int(os.environ.get('SOLVER_WORKERS', 1))
+    
+    # Background processes for queued schedule solves, and the most solves 
+    # that can be waiting or running at once before new ones are turned away.
+    # Solve jobs are only known to the web process that accepted them, so the
+    # app must be served from a single process (with as many threads as 
+    # needed, e.g. gunicorn -w 1 --threads 8). With more, polls that land on 
+    # another process get a 404
+    SOLVE_JOB_WORKERS = int(os.environ.get('SOLVE_JOB_WORKERS', 2))
+    SOLVE_JOB_QUEUE_DEPTH = 10
+    
     SHIFT_PATTERNS = ['6-2', '2-10', '6-2 and 2-10']
     
     # Hard-code the general shift pattern hours. Normally these could be 
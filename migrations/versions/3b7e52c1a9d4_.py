@@ -0,0 +1,69 @@
+"""machine history rollups
+
+Revision ID: 3b7e52c1a9d4
+Revises: ffe27d6ee645
+Create Date: 2026-10-18 20:05:12.418305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b7e52c1a9d4'
+down_revision = 'ffe27d6ee645'
+branch_labels = None
+depends_on = None
+
+
+# Start of each rollup's period, as SQLAlchemy stores datetimes in SQLite
+PERIOD_SQL = {
+    'hour': "strftime('%Y-%m-%d %H:00:00.000000', h.datetime)",
+    'day': "strftime('%Y-%m-%d 00:00:00.000000', h.datetime)",
+    'week': ("strftime('%Y-%m-%d 00:00:00.000000', h.datetime, "
+             "'-' || ((strftime('%w', h.datetime) + 6) % 7) || ' days')")
+    }
+
+
+def upgrade():
+    op.create_table('machine_rollups',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('machine_id', sa.Integer(), nullable=True),
+    sa.Column('resolution', sa.String(length=4), nullable=True),
+    sa.Column('period_start', sa.DateTime(), nullable=True),
+    sa.Column('product_count', sa.Integer(), nullable=True),
+    sa.Column('down_count', sa.Integer(), nullable=True),
+    sa.Column('down_secs', sa.Integer(), nullable=True),
+    sa.Column('hours', sa.Integer(), nullable=True),
+    sa.Column('oee', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['machine_id'], ['machines.id'], name=op.f('fk_machine_rollups_machine_id_machines'), ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_machine_rollups')),
+    sa.UniqueConstraint('machine_id', 'resolution', 'period_start', name=op.f('uq_machine_rollups_machine_id'))
+    )
+    with op.batch_alter_table('machine_rollups', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_machine_rollups_machine_id'), ['machine_id'], unique=False)
+        batch_op.create_index('ix_machine_rollups_resolution_period_start', ['resolution', 'period_start'], unique=False)
+
+    # Roll up the history there is so far
+    for resolution, period_start in PERIOD_SQL.items():
+        op.execute(f"""
+            INSERT INTO machine_rollups (machine_id, resolution, period_start,
+                                         product_count, down_count, down_secs,
+                                         hours, oee)
+            SELECT h.machine_id, '{resolution}', {period_start},
+                   SUM(h.product_count), SUM(h.down_count), SUM(h.down_secs),
+                   COUNT(*),
+                   100.0 * SUM(h.product_count)
+                   / (s.ideal_run_rate * 60 * COUNT(*))
+            FROM machine_history h
+            JOIN machine_stats s ON s.machine_id = h.machine_id
+            GROUP BY h.machine_id, {period_start}
+            """)
+
+
+def downgrade():
+    with op.batch_alter_table('machine_rollups', schema=None) as batch_op:
+        batch_op.drop_index('ix_machine_rollups_resolution_period_start')
+        batch_op.drop_index(batch_op.f('ix_machine_rollups_machine_id'))
+
+    op.drop_table('machine_rollups')
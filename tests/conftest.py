@@ -0,0 +1,168 @@
+import heapq
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+import zmq
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+from config import Config
+
+
+@pytest.fixture
+def app(tmp_path):
+    """ A bare app with the project's config, caches under tmp_path """
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config.update(OSRM_CACHE_PATH=str(tmp_path / 'osrm_matrix.db'),
+                      ROUTE_CACHE_PATH=str(tmp_path / 'routes.db'),
+                      REQUEST_PATH=str(tmp_path / 'requests'),
+                      OSRM_RETRIES=0)
+    with app.app_context():
+        yield app
+
+
+class OSRMStandIn:
+    """ Serves the OSRM table service over HTTP from straight line distances
+
+    Points at a latitude of UNROUTABLE_LAT or above can't be routed to or
+    from, and come back as null like OSRM gives them. Every request is
+    recorded in `calls` as (locations, sources, destinations) counts.
+    """
+
+    UNROUTABLE_LAT = 89
+
+    def __init__(self):
+        self.calls = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                points = [tuple(map(float, item.split(',')))
+                          for item in url.path.rsplit('/', 1)[1].split(';')]
+                query = parse_qs(url.query)
+                sources = stand_in._indices(query, 'sources', len(points))
+                destinations = stand_in._indices(query, 'destinations',
+                                                 len(points))
+                stand_in.calls.append((len(points), len(sources),
+                                       len(destinations)))
+
+                distances = [[stand_in.distance(points[i], points[j])
+                              for j in destinations] for i in sources]
+                durations = [[None if item is None else item / 10
+                              for item in row] for row in distances]
+                body = json.dumps({'code': 'Ok',
+                                   'distances': distances,
+                                   'durations': durations}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base = (f'http://127.0.0.1:{self.server.server_address[1]}'
+                     f'/table/v1/driving/')
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def _indices(query, name, num_points):
+        if name not in query:
+            return list(range(num_points))
+        return [int(item) for item in query[name][0].split(';')]
+
+    @classmethod
+    def distance(cls, a, b):
+        """ Metres between two lon,lat points, or None if unroutable """
+
+        (lon_a, lat_a), (lon_b, lat_b) = a, b
+        if max(lat_a, lat_b) >= cls.UNROUTABLE_LAT:
+            return None
+        return 111000 * math.hypot(lat_a - lat_b, (lon_a - lon_b) * 0.6)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def osrm(app):
+    stand_in = OSRMStandIn()
+    app.config['OSRM_BASE'] = stand_in.base
+    yield stand_in
+    stand_in.close()
+
+
+class JspritStandIn:
+    """ A jsprit server on a ROUTER socket, run in a thread
+
+    Each request's frames are passed to `handler`, which returns the reply
+    frame and how many seconds to wait before sending it, or None to never
+    reply. Replies are sent in the order they fall due, so slow requests
+    don't hold up quicker ones. The default handler replies straight away
+    with the last frame upper cased. Every request is recorded in
+    `requests` as (identity, frames).
+    """
+
+    def __init__(self, port=None):
+        self.handler = lambda frames: (0, frames[-1].upper())
+        self.requests = []
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        if port is None:
+            port = self.socket.bind_to_random_port('tcp://127.0.0.1')
+        else:
+            self.socket.bind(f'tcp://127.0.0.1:{port}')
+        self.port = port
+        self.address = f'tcp://127.0.0.1:{port}'
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        due = []
+        while self.running:
+            if self.socket.poll(5, zmq.POLLIN):
+                identity, empty, *frames = self.socket.recv_multipart()
+                self.requests.append((identity, frames))
+                reply = self.handler(frames)
+                if reply is not None:
+                    delay, body = reply
+                    heapq.heappush(due, (time.monotonic() + delay,
+                                         len(self.requests), identity, body))
+            while due and due[0][0] <= time.monotonic():
+                x, y, identity, body = heapq.heappop(due)
+                self.socket.send_multipart([identity, b'', body])
+        self.socket.close()
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.context.term()
+
+
+@pytest.fixture
+def jsprit(app):
+    stand_in = JspritStandIn()
+    app.config.update(JSPRIT_SOCKET=stand_in.address,
+                      JSPRIT_TIMEOUT_SECS=2,
+                      JSPRIT_POOL_SIZE=4)
+    yield stand_in
+    stand_in.close()
@@ -0,0 +1,149 @@
+import random
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from config import Config
+from app.vehicle_routing.decompose import ClusteredProblem, GridIndex
+from app.vehicle_routing.models import RoutingProblem
+
+
+@pytest.mark.parametrize('k', [1, 3, 10])
+def test_nearest_matches_brute_force(k):
+    rng = np.random.default_rng(1)
+    points = rng.uniform(0, 30, (500, 2))
+    index = GridIndex(points, cell_size=2)
+
+    # Queries inside the points, and off the edge of them
+    for query in rng.uniform(-10, 40, (100, 2)):
+        expected = np.argsort(np.hypot(*(points - query).T), kind='stable')
+        assert index.nearest(query, k) == expected[:k].tolist()
+
+
+def test_nearest_with_fewer_points_than_k():
+    points = np.array([[0, 0], [5, 5], [1, 1]])
+
+    assert GridIndex(points, cell_size=2).nearest([0, 0], 10) == [0, 2, 1]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_allot_drivers_hands_out_every_driver(seed):
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(1, 200, rng.integers(1, 10)).tolist()
+    num_drivers = len(sizes) + int(rng.integers(0, 30))
+
+    drivers = ClusteredProblem._allot_drivers(sizes, num_drivers)
+
+    assert sum(drivers) == num_drivers
+    assert min(drivers) >= 1
+
+    # Each cluster gets its share, rounded either way, unless that's < 1
+    shares = np.array(sizes) / sum(sizes) * num_drivers
+    assert (np.abs(np.array(drivers) - np.maximum(shares, 1)) < 1 + 1e-9).all()
+
+
+class FakeClusters(ClusteredProblem):
+    """ Clusters solved by `serves(members, solves)`, which gives the
+    members served given how many times that cluster has been solved
+    """
+
+    def __init__(self, num_customers, serves):
+        super().__init__(SimpleNamespace(locations=[{}] * num_customers,
+                                         params={}))
+        self.serves = serves
+        self.solves = Counter()
+
+    def _solve_cluster(self, members, num_drivers):
+        cluster = members[0]
+        served = self.serves(members, self.solves[cluster])
+        self.solves[cluster] += 1
+        route = [{'tracking': str(members.index(member))} for member in served]
+        return {'members': members,
+                'drivers': num_drivers,
+                'result': {'routes': {'driver_1': route}}}
+
+
+# Customers 0-3 are cluster A, and 4-7 cluster B. Customer 3 is out by B, 
+# and 7 out by A, so each is offered to the other cluster
+POINTS = np.array([[0, 0], [0, 1], [1, 0], [9, 0],
+                   [10, 0], [10, 1], [11, 0], [1, 1]], dtype=float)
+
+
+def repair(app, problem):
+    clusters = [problem._solve_cluster(members, 1)
+                for members in ([0, 1, 2, 3], [4, 5, 6, 7])]
+    before = list(clusters)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        return before, problem._repair(executor, clusters, POINTS)
+
+
+def served(clusters):
+    return [member for cluster in clusters for member in cluster['members']
+            if member not in ClusteredProblem._unassigned(cluster)]
+
+
+def test_repair_keeps_a_cluster_that_serves_more(app):
+    # Customers 3 and 7 don't fit in their own clusters, but do elsewhere
+    problem = FakeClusters(8, lambda members, solves: [
+                            member for member in members
+                            if solves or member not in (3, 7)])
+
+    before, after = repair(app, problem)
+
+    assert after[0] is not before[0] and after[1] is not before[1]
+    assert sorted(served(after)) == list(range(8))
+
+
+def test_repair_drops_a_cluster_that_serves_no_more(app):
+    # Nothing fits in B when it's solved again
+    problem = FakeClusters(8, lambda members, solves: (
+                            [] if solves and members[0] == 4 else
+                            [member for member in members
+                             if solves or member not in (3, 7)]))
+
+    before, after = repair(app, problem)
+
+    assert after[1] is before[1]
+    assert sorted(served(after)) == [0, 1, 2, 4, 5, 6, 7]
+
+
+def test_repair_never_serves_a_customer_twice(app):
+    # Solved again, a cluster fits in everything it's given, including any
+    # of its own customers it couldn't fit the first time
+    problem = FakeClusters(8, lambda members, solves: [
+                            member for member in members
+                            if solves or member not in (3, 7)])
+
+    before, after = repair(app, problem)
+
+    counts = Counter(served(after))
+    assert max(counts.values()) == 1
+
+
+def test_clustered_routes_deliver_each_customer_once(app):
+    app.config.update(CUSTOMER_NAMES=Config.load_customer_names(),
+                      ROUTING_CLUSTER_SIZE=50,
+                      ROUTE_CACHE_TTL_SECS=0)
+    np.random.seed(7)
+    random.seed(7)
+    params = {'number_of_customers': '100',
+              'delivery_slot_length': '1',
+              'number_of_drivers': '6',
+              'driver_gets_break': 'Yes',
+              'engine': 'native',
+              'matrix': 'haversine'}
+    locations = (RoutingProblem.build_locations(params)
+                 + RoutingProblem.build_locations(params))
+
+    problem = ClusteredProblem(RoutingProblem(locations, params))
+    routes, stats = problem.solve()
+
+    delivered = Counter((stop['lat'], stop['lon'])
+                        for route in routes.values() for stop in route
+                        if stop['activity'] == 'Delivery')
+    assert max(delivered.values()) == 1
+    assert len(delivered) + len(problem.unassigned) == len(locations)
@@ -0,0 +1,132 @@
+import numpy as np
+import pytest
+
+from app.vehicle_routing.engine import NativeSolver
+from app.vehicle_routing.models import DistanceMatrix
+
+
+NUM_CUSTOMERS = 12
+
+
+def make_problem(capacity=40, num_drivers=3):
+    """ A fixed instance: 12 customers around a warehouse in a 20km square,
+    with two hour time windows and a lunch break for every driver
+    """
+
+    rng = np.random.default_rng(3)
+    points = np.vstack([[10, 10], rng.uniform(0, 20, (NUM_CUSTOMERS, 2))])
+    distances = 1.3 * np.hypot(*(points[:, None] - points[None]).transpose(2, 0, 1))
+    durations = distances / 30 * 60
+    location_ids = ['warehouse'] + [str(i) for i in range(NUM_CUSTOMERS)]
+    matrix = DistanceMatrix(location_ids, distances, durations)
+
+    starts = rng.choice([540, 600, 660, 720, 780, 840, 900], NUM_CUSTOMERS)
+    orders = {'deliveries': {str(i): {'r_id': str(i),
+                                      'r_tw_from': str(start),
+                                      'r_tw_to': str(start + 120),
+                                      'dname_skill': 'default',
+                                      'service_time': '5'}
+                             for i, start in enumerate(starts.tolist())}}
+    drivers = [{'lunch_start': '720',
+                'lunch_end': '780',
+                'end_time': '1080',
+                'skills': ['default', f'driver_{x + 1}'],
+                'start_time': '510',
+                'vehicle_type': '0',
+                'lunch_duration': '30',
+                'departure_loc': 'warehouse',
+                'driver_name': f'driver_{x + 1}'}
+               for x in range(num_drivers)]
+    vtypes = [{'type_id': '0',
+               'fixed_cost': '100',
+               'capacities': [[0, capacity], [1, 10]],
+               'cost_per_km': '0.12',
+               'cost_per_wait': '0.17',
+               'cost_per_min': '0.17'}]
+    return matrix, orders, {'drivers': drivers, 'vtypes': vtypes}
+
+
+def total_cost(solver, routes):
+    cost = 0
+    for route, vehicle in zip(routes, solver.vehicles):
+        if route:
+            prev, nxt = solver._edges(route, vehicle)
+            cost += vehicle['costs'][prev, nxt].sum() + vehicle['fixed_cost']
+    return cost
+
+
+def deliveries(route):
+    return [job for job in route[1:-1] if job['tracking'] != 'lunch']
+
+
+@pytest.mark.parametrize('capacity', [40, 5, 3])
+def test_every_customer_served_at_most_once(capacity):
+    response = NativeSolver(*make_problem(capacity)).solve()
+
+    served = [job['tracking'] for route in response['routes'].values()
+              for job in deliveries(route)]
+    assert len(served) == len(set(served))
+    assert (sorted(served + response['unassigned'], key=int)
+            == [str(i) for i in range(NUM_CUSTOMERS)])
+
+
+@pytest.mark.parametrize('capacity', [40, 5, 3])
+def test_routes_keep_to_time_windows_and_capacity(capacity):
+    matrix, orders, driver_config = make_problem(capacity)
+    response = NativeSolver(matrix, orders, driver_config).solve()
+
+    assert response['routes']
+    for name, route in response['routes'].items():
+        assert len(deliveries(route)) <= capacity
+
+        t = route[0]['num_departure']
+        assert t >= 510
+        for job in route[1:-1]:
+            assert job['num_arrival'] >= t - 1e-6
+            if job['tracking'] == 'lunch':
+                assert 720 <= job['num_arrival'] <= 780
+                assert job['num_departure'] == job['num_arrival'] + 30
+            else:
+                delivery = orders['deliveries'][job['tracking']]
+                begin = job['num_departure'] - 5
+                assert begin >= float(delivery['r_tw_from']) - 1e-6
+                assert begin <= float(delivery['r_tw_to']) + 1e-6
+                assert job['num_arrival'] <= begin + 1e-6
+            t = job['num_departure']
+
+        # Back at the depot, in seconds, before the end of the shift, with
+        # lunch taken unless the route is over before the break opens
+        returned = float(route[-1]['arrival'].split(':')[0]) / 60
+        assert returned <= 1080 + 1e-6
+        lunches = sum(job['tracking'] == 'lunch' for job in route)
+        assert lunches == 1 or (lunches == 0 and returned <= 720 + 1e-6)
+
+
+def test_tight_capacity_leaves_customers_unassigned():
+    response = NativeSolver(*make_problem(capacity=3)).solve()
+
+    assert len(response['unassigned']) >= NUM_CUSTOMERS - 3 * 3
+
+
+@pytest.mark.parametrize('capacity', [40, 5])
+def test_improvement_moves_never_increase_cost(capacity):
+    solver = NativeSolver(*make_problem(capacity))
+    costs = []
+
+    def record(move):
+        def wrapped(routes):
+            before = total_cost(solver, routes)
+            is_moved = move(routes)
+            if is_moved:
+                costs.append((move.__name__, before,
+                              total_cost(solver, routes)))
+            return is_moved
+        return wrapped
+
+    solver._two_opt = record(solver._two_opt)
+    solver._relocate = record(solver._relocate)
+    solver.solve()
+
+    assert costs
+    for name, before, after in costs:
+        assert after < before + 1e-9, name
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import threading
+import time
+import zlib
+
+import pytest
+
+from app.vehicle_routing.jsprit import JspritClient, JspritTimeout
+
+from conftest import JspritStandIn
+
+
+@pytest.fixture
+def client(jsprit):
+    client = JspritClient()
+    yield client
+    if client.context is not None:
+        client.context.destroy(linger=0)
+
+
+def test_request_gets_its_reply(client, jsprit):
+    assert client.request(b'hello') == b'HELLO'
+    assert jsprit.requests[0][1] == [b'hello']
+
+
+def test_socket_reused_between_requests(client, jsprit):
+    client.request(b'one')
+    client.request(b'two')
+
+    assert jsprit.requests[0][0] == jsprit.requests[1][0]
+
+
+def test_late_reply_not_taken_for_the_next_one(client, jsprit):
+    jsprit.handler = lambda frames: ((0.3 if frames[-1] == b'slow' else 0),
+                                     frames[-1].upper())
+
+    with pytest.raises(JspritTimeout):
+        client.request(b'slow', timeout=0.1)
+    time.sleep(0.4)
+
+    # The timed out socket was thrown away, so its reply never arrives here
+    assert client.request(b'next') == b'NEXT'
+    assert jsprit.requests[0][0] != jsprit.requests[1][0]
+
+
+def test_no_reply_times_out(client, jsprit):
+    jsprit.handler = lambda frames: None
+
+    start = time.monotonic()
+    with pytest.raises(JspritTimeout):
+        client.request(b'hello', timeout=0.2)
+    assert 0.2 <= time.monotonic() - start < 1
+
+
+def test_reconnects_after_server_restarts(client, jsprit):
+    assert client.request(b'before') == b'BEFORE'
+    jsprit.close()
+
+    with pytest.raises(JspritTimeout):
+        client.request(b'down', timeout=0.2)
+
+    restarted = JspritStandIn(jsprit.port)
+    try:
+        assert client.request(b'after', timeout=5) == b'AFTER'
+    finally:
+        restarted.close()
+
+
+def test_concurrent_requests_share_the_pool(app, client, jsprit):
+    jsprit.handler = lambda frames: (0.2, frames[-1].upper())
+    payloads = [f'request {i}'.encode() for i in range(8)]
+    replies = {}
+
+    def send(payload):
+        with app.app_context():
+            replies[payload] = client.request(payload)
+
+    threads = [threading.Thread(target=send, args=(payload,))
+               for payload in payloads]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    assert replies == {payload: payload.upper() for payload in payloads}
+
+    # Two rounds of four at once, over no more sockets than the pool size
+    assert elapsed < 0.2 * 8 / 2
+    assert len({identity for identity, frames in jsprit.requests}) <= 4
+
+
+def test_busy_pool_times_out(app, client, jsprit):
+    app.config['JSPRIT_POOL_SIZE'] = 1
+    jsprit.handler = lambda frames: (0.5, frames[-1].upper())
+
+    def send():
+        with app.app_context():
+            client.request(b'slow')
+
+    slow = threading.Thread(target=send)
+    slow.start()
+    time.sleep(0.1)
+
+    with pytest.raises(JspritTimeout, match='busy'):
+        client.request(b'waiting', timeout=0.1)
+    slow.join()
+
+
+def test_wait_for_a_connection_counts_against_the_timeout(app, client,
+                                                        jsprit):
+    app.config['JSPRIT_POOL_SIZE'] = 1
+    jsprit.handler = lambda frames: (0.5, frames[-1].upper())
+
+    def send():
+        with app.app_context():
+            client.request(b'slow')
+
+    slow = threading.Thread(target=send)
+    slow.start()
+    time.sleep(0.1)
+
+    # The slot frees up after about 0.4 seconds, leaving too little of the
+    # timeout for the reply
+    start = time.monotonic()
+    with pytest.raises(JspritTimeout, match='within 0.8 seconds'):
+        client.request(b'waiting', timeout=0.8)
+    assert time.monotonic() - start < 1
+    slow.join()
+
+
+def test_request_async_keeps_the_loop_running(client, jsprit):
+    jsprit.handler = lambda frames: (0.2, frames[-1].upper())
+
+    async def main():
+        ticks = []
+
+        async def tick():
+            while len(ticks) < 100:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.ensure_future(tick())
+        replies = await asyncio.gather(*(client.request_async(payload)
+                                         for payload in (b'a', b'b', b'c')))
+        ticker.cancel()
+        return replies, ticks
+
+    replies, ticks = asyncio.run(main())
+
+    assert replies == [b'A', b'B', b'C']
+    assert len(ticks) > 5
+
+
+def test_request_async_timeout(client, jsprit):
+    jsprit.handler = lambda frames: None
+
+    with pytest.raises(JspritTimeout):
+        asyncio.run(client.request_async(b'hello', timeout=0.1))
+
+
+def test_solve_inline_compressed(app, client, jsprit):
+    app.config.update(JSPRIT_TRANSPORT='inline', JSPRIT_COMPRESS=True)
+    jsprit.handler = lambda frames: (0, b'{"routes": {}}')
+
+    assert client.solve([b'{"problem"', b': 1}'], 'abc') == {'routes': {}}
+
+    header, payload = jsprit.requests[0][1]
+    assert json.loads(header) == {'problem_id': 'abc', 'encoding': 'zlib'}
+    assert zlib.decompress(payload) == b'{"problem": 1}'
+
+
+def test_solve_by_path(app, client, jsprit):
+    app.config['JSPRIT_TRANSPORT'] = 'path'
+    jsprit.handler = lambda frames: (0, b'{"routes": {}}')
+
+    client.solve(iter([b'{"problem"', b': 1}']), 'abc')
+
+    [path] = jsprit.requests[0][1]
+    with open(path, 'rb') as infile:
+        assert infile.read() == b'{"problem": 1}'
+
+
+def test_solve_inline_audited(app, client, jsprit, tmp_path):
+    app.config.update(JSPRIT_TRANSPORT='inline', JSPRIT_COMPRESS=False,
+                      JSPRIT_AUDIT=True)
+    jsprit.handler = lambda frames: (0, b'{"routes": {}}')
+
+    client.solve(iter([b'{"problem"', b': 1}']), 'abc')
+
+    header, payload = jsprit.requests[0][1]
+    assert json.loads(header) == {'problem_id': 'abc', 'encoding': 'identity'}
+    assert payload == b'{"problem": 1}'
+    [path] = (tmp_path / 'requests').iterdir()
+    assert path.read_bytes() == b'{"problem": 1}'
+
+
+def test_requests_pruned_once_per_interval(app, client, tmp_path):
+    app.config.update(JSPRIT_AUDIT_MAX_FILES=1, JSPRIT_AUDIT_PRUNE_SECS=3600)
+    client._start()
+    request_path = tmp_path / 'requests'
+
+    for problem_id in ('a', 'b', 'c'):
+        client._write_request([b'{}'], problem_id)
+    assert len(list(request_path.iterdir())) == 3
+
+    client.last_pruned -= 3600
+    client._write_request([b'{}'], 'd')
+    assert [path.name[-5:] for path in request_path.iterdir()] == ['d.txt']
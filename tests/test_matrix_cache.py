@@ -0,0 +1,156 @@
+import sqlite3
+import time
+
+import numpy as np
+import pytest
+
+from app.vehicle_routing.matrix_cache import MatrixCache
+from app.vehicle_routing.osrm import OSRMClient
+
+
+def make_coords(num_coords, seed=0):
+    rng = np.random.default_rng(seed)
+    return [(round(lat, 6), round(lon, 6)) for lat, lon in
+            zip(rng.uniform(53.38, 53.57, num_coords).tolist(),
+                rng.uniform(-2.40, -2.06, num_coords).tolist())]
+
+
+def expected(coords):
+    distances = np.array([[np.hypot(a[0] - b[0], (a[1] - b[1]) * 0.6) * 111
+                           for b in coords] for a in coords])
+    return distances, distances * 100 / 60
+
+
+def count(app, table):
+    with sqlite3.connect(app.config['OSRM_CACHE_PATH']) as conn:
+        return conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+
+@pytest.fixture
+def cache():
+    return MatrixCache()
+
+
+@pytest.fixture
+def client(osrm):
+    return OSRMClient()
+
+
+def test_warm_matrix_served_from_memory(cache, client, osrm):
+    coords = make_coords(20)
+
+    distances, durations = cache.get_matrix(coords, client.table)
+    assert len(osrm.calls) == 1
+    np.testing.assert_allclose(distances, expected(coords)[0])
+    np.testing.assert_allclose(durations, expected(coords)[1])
+
+    again = cache.get_matrix(coords, client.table)
+    assert len(osrm.calls) == 1
+    np.testing.assert_array_equal(again[0], distances)
+    assert cache.stats()['memory_hits'] == 400
+
+
+def test_new_location_fetches_its_row_and_column(cache, client, osrm):
+    coords = make_coords(21)
+    cache.get_matrix(coords[:20], client.table)
+
+    distances, durations = cache.get_matrix(coords, client.table)
+
+    # The new row in full, then its column for the other 20 rows
+    assert osrm.calls[1:] == [(21, 1, 21), (21, 20, 1)]
+    np.testing.assert_allclose(distances, expected(coords)[0])
+
+
+def test_pairs_survive_a_restart(app, cache, client, osrm):
+    coords = make_coords(20)
+    distances, durations = cache.get_matrix(coords, client.table)
+
+    restarted = MatrixCache()
+    again = restarted.get_matrix(coords, client.table)
+
+    assert len(osrm.calls) == 1
+    assert restarted.stats()['disk_hits'] == 400
+    np.testing.assert_allclose(again[0], distances)
+
+
+def test_memory_hits_mark_pairs_used_on_disk(app, cache, client, osrm):
+    app.config['OSRM_CACHE_TOUCH_SECS'] = 0
+    coords = make_coords(5)
+    cache.get_matrix(coords, client.table)
+    with sqlite3.connect(app.config['OSRM_CACHE_PATH']) as conn:
+        before = conn.execute('SELECT MAX(accessed) FROM osrm_pairs').fetchone()[0]
+
+    time.sleep(0.01)
+    cache.get_matrix(coords, client.table)
+
+    with sqlite3.connect(app.config['OSRM_CACHE_PATH']) as conn:
+        oldest = conn.execute('SELECT MIN(accessed) FROM osrm_pairs').fetchone()[0]
+    assert len(osrm.calls) == 1
+    assert oldest > before
+
+
+def test_unroutable_pairs_are_penalised_and_not_cached(app, cache, client,
+                                                       osrm):
+    coords = make_coords(10) + [(89.5, -2.2)]
+
+    distances, durations = cache.get_matrix(coords, client.table)
+
+    assert (distances[-1, :] == app.config['OSRM_UNROUTABLE_KM']).all()
+    assert (distances[:, -1] == app.config['OSRM_UNROUTABLE_KM']).all()
+    assert (durations[-1, :] == app.config['OSRM_UNROUTABLE_MINS']).all()
+    np.testing.assert_allclose(distances[:-1, :-1],
+                               expected(coords[:-1])[0])
+    assert count(app, 'osrm_pairs') == 100
+    assert cache.stats()['unroutable'] == 21
+
+    # Asked for again, in case OSRM can route them by then
+    cache.get_matrix(coords, client.table)
+    assert len(osrm.calls) == 3
+
+
+def test_large_matrices_are_cached_whole(app, cache, client, osrm):
+    app.config['OSRM_CACHE_PAIR_MAX_STOPS'] = 10
+    coords = make_coords(30)
+
+    distances, durations = cache.get_matrix(coords, client.table)
+    assert count(app, 'osrm_pairs') == 0
+    assert count(app, 'osrm_matrices') == 1
+
+    again = cache.get_matrix(coords, client.table)
+    cache.clear_memory()
+    from_disk = cache.get_matrix(coords, client.table)
+
+    assert len(osrm.calls) == 1
+    np.testing.assert_allclose(again[0], distances, rtol=1e-6)
+    np.testing.assert_allclose(from_disk[1], durations, rtol=1e-6)
+    assert cache.stats()['memory_hits'] == 900
+    assert cache.stats()['disk_hits'] == 900
+
+
+def test_large_matrices_evicted_least_recently_used(app, cache, client, osrm):
+    app.config['OSRM_CACHE_PAIR_MAX_STOPS'] = 10
+    app.config['OSRM_CACHE_DISK_MATRIX_PAIRS'] = 2 * 30 * 30
+    first, second, third = (make_coords(30, seed) for seed in range(3))
+
+    cache.get_matrix(first, client.table)
+    cache.get_matrix(second, client.table)
+    cache.get_matrix(first, client.table)
+    cache.get_matrix(third, client.table)
+    assert count(app, 'osrm_matrices') == 2
+
+    cache.clear_memory()
+    cache.get_matrix(first, client.table)
+    assert len(osrm.calls) == 3
+    cache.get_matrix(second, client.table)
+    assert len(osrm.calls) == 4
+
+
+def test_large_matrix_with_unroutable_pairs_not_cached(app, cache, client,
+                                                       osrm):
+    app.config['OSRM_CACHE_PAIR_MAX_STOPS'] = 10
+    coords = make_coords(20) + [(89.5, -2.2)]
+
+    distances, durations = cache.get_matrix(coords, client.table)
+
+    assert np.isfinite(distances).all()
+    assert count(app, 'osrm_matrices') == 0
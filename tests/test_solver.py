@@ -0,0 +1,68 @@
+import random
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from app.manufacturing.models import Solver
+
+
+NUM_WEEKS = 2
+PRODUCTS = [1, 2, 3, 4]
+
+
+def make_problem():
+    """ A small synthetic problem: three machines on day and night shifts
+    over two weeks, with a ramp of demand for four products
+    """
+
+    rng = np.random.default_rng(5)
+    num_hours = NUM_WEEKS * 168
+
+    day = np.zeros(24)
+    day[6:22] = 1
+    night = np.zeros(24)
+    night[:6] = night[22:] = 1
+    shifts = {1: np.tile(day, 7 * NUM_WEEKS),
+              2: np.tile(day, 7 * NUM_WEEKS),
+              3: np.tile(night, 7 * NUM_WEEKS)}
+
+    weekly = {product_id: rng.integers(5, 20, NUM_WEEKS)
+              for product_id in PRODUCTS}
+    forecast = {product_id: np.concatenate([[0], np.interp(
+                                np.arange(num_hours), [0, num_hours - 1],
+                                [0, demand.sum()])])
+                for product_id, demand in weekly.items()}
+
+    return SimpleNamespace(
+        machines=[SimpleNamespace(id=machine_id) for machine_id in shifts],
+        products=PRODUCTS,
+        machine_products={1: [1, 2], 2: [2, 3, 4], 3: [1, 4]},
+        productivity_map={machine_id: shift * rng.uniform(0.05, 0.2)
+                          for machine_id, shift in shifts.items()},
+        daterange=[str(x) for x in range(num_hours)],
+        forecast=forecast)
+
+
+@pytest.mark.parametrize('batch_size', [1, 16])
+def test_validated_solve_matches_rebuild(batch_size):
+    random.seed(11)
+    np.random.seed(11)
+    solver = Solver(make_problem())
+    solver.iterations = 3000
+    solver.batch_size = batch_size
+    solver.validate_costs = True
+
+    # Any incremental cost that disagrees with the full cost raises
+    solver.run_solver()
+    assert solver.accepted_moves
+    if batch_size > 1:
+        assert solver.scored_moves
+
+    production = solver.wip_production.copy()
+    solver._get_initial_productivity()
+    np.testing.assert_allclose(production, solver.wip_production, atol=1e-9)
+
+    for wip, cost in enumerate(solver.wip_cost_contributions):
+        assert np.isclose(cost, solver._soft_solution_costs(
+                                            wip, solver.wip_production[wip]))